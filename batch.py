@@ -0,0 +1,130 @@
+"""
+Many independent games stepped at once, for reinforcement learning.
+"""
+import board
+
+import numpy as np
+
+
+class BoardBatch:
+    """
+    N games stepped with a single call, their planes, legal actions masks and rewards in numpy arrays.
+    The games themselves are a list of Board objects played one after the other, only their outputs are batched.
+
+    The actions are integers from_square * num_squares + to_square (squares as y * width + x),
+    pawns reaching the last rank become queens. The legal actions of each game are given in a boolean mask.
+
+    After every step the finished games are reset automatically. Their result is kept in last_results
+    (1 whites won, -1 blacks won, 0 draw) and the planes of their final position in terminal_planes.
+    """
+    def __init__(self, n, width=8, height=8, max_plies=512, dtype=np.float32):
+        self.n = n
+        self.width = width
+        self.height = height
+        self.max_plies = max_plies
+        self.num_squares = width * height
+        self.num_actions = self.num_squares * self.num_squares
+        self.rows = np.arange(n)
+
+        self.boards = [None] * n
+        self.planes = np.zeros((n, board.NUM_PLANES, height, width), dtype=dtype)
+        self.terminal_planes = np.zeros_like(self.planes)
+        self.masks = np.zeros((n, self.num_actions), dtype=bool)
+        self.action_moves = np.full((n, self.num_actions), -1, dtype=np.int32)    # Encoded move of each legal action
+        # Entries set by the last refresh, the only ones to clear in the next one
+        self.legal_rows = np.zeros(0, dtype=np.int64)
+        self.legal_actions = np.zeros(0, dtype=np.int64)
+
+        self.rewards = np.zeros(n, dtype=np.float32)
+        self.dones = np.zeros(n, dtype=bool)
+        self.last_results = np.zeros(n, dtype=np.int8)
+        self.games_played = 0
+        self.reset()
+
+
+    def reset(self):
+        """Starts all the games again. Returns the planes and the legal actions masks."""
+        self.boards = [board.Board(self.width, self.height, silent=True) for _ in range(self.n)]
+        self.refresh(range(self.n), [b.legal_move_array() for b in self.boards])
+        return self.planes, self.masks
+
+
+    def step(self, actions):
+        """
+        Performs one action in every game.
+
+        Returns the planes, the legal actions masks, the rewards and the done flags.
+        The reward is for the team that has just moved: 1 for a checkmate, 0 otherwise.
+        """
+        actions = np.asarray(actions)
+        moves = self.action_moves[self.rows, actions]
+        if (moves < 0).any():
+            raise ValueError("Illegal actions in the games " + str(np.flatnonzero(moves < 0).tolist()))
+
+        self.rewards[:] = 0
+        self.dones[:] = False
+        legal = []
+        for i, b in enumerate(self.boards):
+            b.push(int(moves[i]))
+            legal.append(b.legal_move_array())
+
+        finished = []
+        for i, b in enumerate(self.boards):
+            result = self.game_result(b, legal[i])
+            if result is None: continue
+            finished.append(i)
+            self.dones[i] = True
+            self.last_results[i] = result
+            if result != 0: self.rewards[i] = 1
+            b.to_planes(out=self.terminal_planes[i])
+
+        # Automatic reset of the finished games
+        for i in finished:
+            self.boards[i] = board.Board(self.width, self.height, silent=True)
+            legal[i] = self.boards[i].legal_move_array()
+        self.games_played += len(finished)
+
+        self.refresh(range(self.n), legal)
+        return self.planes, self.masks, self.rewards, self.dones
+
+
+    def game_result(self, b, legal):
+        """Returns None if the game goes on, otherwise 1 if whites won, -1 if blacks won or 0 if it's a draw"""
+        if len(legal) == 0:
+            if b.in_check(): return 1 if b.playing == 'B' else -1
+            return 0
+        # The rules of Board.outcome() without generating the legal moves again
+        if b.turn >= self.max_plies or b.halfmove_clock >= 100: return 0
+        if b.is_insufficient_material() or b.is_repetition(3): return 0
+        return None
+
+
+    def refresh(self, indices, legal):
+        """Updates the arrays of the given games. legal are the legal moves arrays of all the games."""
+        for i in indices:
+            b = self.boards[i]
+            b.to_planes(out=self.planes[i])
+
+        # All the masks are rebuilt in one vectorized assignment
+        counts = np.fromiter((len(m) for m in legal), dtype=np.int64, count=len(legal))
+        rows = np.repeat(self.rows, counts)
+        moves = np.concatenate(legal) if len(legal) else np.zeros(0, dtype=np.int32)
+        # Promotions to other pieces than the queen are left out
+        keep = ((moves >> 16) == 0) | ((moves >> 16) == board.PROMOTION_CODES['Q'])
+        rows = rows[keep]
+        moves = moves[keep]
+        actions = (moves & 0xFF) * self.num_squares + ((moves >> 8) & 0xFF)
+
+        self.masks[self.legal_rows, self.legal_actions] = False
+        self.action_moves[self.legal_rows, self.legal_actions] = -1
+        self.masks[rows, actions] = True
+        self.action_moves[rows, actions] = moves
+        self.legal_rows = rows
+        self.legal_actions = actions
+
+
+    def sample_actions(self, rng=None):
+        """Random legal action for every game, useful as a baseline agent"""
+        rng = np.random.default_rng() if rng is None else rng
+        scores = rng.random(self.masks.shape) * self.masks
+        return scores.argmax(axis=1)
@@ -0,0 +1,170 @@
+"""
+Bitboard helpers used by the board as its internal position representation.
+
+A bitboard is a python integer where the bit n is set when the square n is occupied.
+Squares are indexed as y * width + x, so in the default board the coordinate (0,0) is the bit 0
+and the whites start on the lowest bits.
+
+The attack tables only depend on the size of the board, so they are computed once per size
+and shared by every board of that size (see get_geometry).
+"""
+
+PIECE_TYPES = ('P', 'H', 'B', 'T', 'Q', 'K')
+
+# The first 4 directions increase the square index and the last 4 decrease it
+DIRECTIONS = ((1,0), (0,1), (1,1), (-1,1), (-1,0), (0,-1), (-1,-1), (1,-1))
+STRAIGHT_DIRS = (0, 1, 4, 5)
+DIAGONAL_DIRS = (2, 3, 6, 7)
+
+KNIGHT_STEPS = ((1,2), (2,1), (2,-1), (1,-2), (-1,-2), (-2,-1), (-2,1), (-1,2))
+KING_STEPS = ((0,1), (1,0), (0,-1), (-1,0), (1,1), (-1,-1), (1,-1), (-1,1))
+
+
+def lsb(bb):
+    """Index of the lowest set bit. The bitboard can't be empty."""
+    return (bb & -bb).bit_length() - 1
+
+
+def msb(bb):
+    """Index of the highest set bit. The bitboard can't be empty."""
+    return bb.bit_length() - 1
+
+
+def popcount(bb):
+    return bin(bb).count('1')
+
+
+def iter_bits(bb):
+    """Yields the indices of the set bits from the lowest to the highest"""
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+class Geometry:
+    """
+    Precomputed attack tables for a board of a given size.
+    Use get_geometry() instead of building it directly so the tables are shared.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.num_squares = width * height
+        self.full = (1 << self.num_squares) - 1
+        self.coords = [(sq % width, sq // width) for sq in range(self.num_squares)]
+
+        self.knight = [self.steps_mask(sq, KNIGHT_STEPS) for sq in range(self.num_squares)]
+        self.king = [self.steps_mask(sq, KING_STEPS) for sq in range(self.num_squares)]
+        # Squares attacked by a pawn of the given team placed in the square
+        self.pawn = ([self.steps_mask(sq, ((-1,1), (1,1))) for sq in range(self.num_squares)],
+                     [self.steps_mask(sq, ((-1,-1), (1,-1))) for sq in range(self.num_squares)])
+        # Squares reached from a square following a direction until the border (the square excluded)
+        self.rays = [[self.ray_mask(sq, d) for sq in range(self.num_squares)] for d in DIRECTIONS]
+        self.rook_rays = [self.rays[0][sq] | self.rays[1][sq] | self.rays[4][sq] | self.rays[5][sq]
+            for sq in range(self.num_squares)]
+        self.bishop_rays = [self.rays[2][sq] | self.rays[3][sq] | self.rays[6][sq] | self.rays[7][sq]
+            for sq in range(self.num_squares)]
+
+        # Squares strictly between two aligned squares, indexed by a * num_squares + b (0 if not aligned)
+        self.between = [0] * (self.num_squares * self.num_squares)
+        for a in range(self.num_squares):
+            for step in DIRECTIONS:
+                x, y = self.coords[a]
+                path = 0
+                x += step[0]; y += step[1]
+                while self.in_boundaries(x, y):
+                    b = self.square(x, y)
+                    self.between[a * self.num_squares + b] = path
+                    path |= 1 << b
+                    x += step[0]; y += step[1]
+
+
+    def square(self, x, y):
+        return y * self.width + x
+
+
+    def in_boundaries(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+
+    def steps_mask(self, sq, steps):
+        x, y = self.coords[sq]
+        mask = 0
+        for dx, dy in steps:
+            if self.in_boundaries(x + dx, y + dy):
+                mask |= 1 << self.square(x + dx, y + dy)
+        return mask
+
+
+    def ray_mask(self, sq, step):
+        x, y = self.coords[sq]
+        mask = 0
+        x += step[0]; y += step[1]
+        while self.in_boundaries(x, y):
+            mask |= 1 << self.square(x, y)
+            x += step[0]; y += step[1]
+        return mask
+
+
+    def ray_attacks(self, sq, d, occupied):
+        """Squares attacked from sq in the direction index d, stopping at the first occupied square (included)"""
+        ray = self.rays[d][sq]
+        blockers = ray & occupied
+        if blockers:
+            if d < 4: blocker = (blockers & -blockers).bit_length() - 1
+            else: blocker = blockers.bit_length() - 1
+            ray ^= self.rays[d][blocker]
+        return ray
+
+
+    def rook_attacks(self, sq, occupied):
+        # Same as ray_attacks on the 4 straight directions, inlined as it's the hottest path
+        rays = self.rays
+        ray = rays[0][sq]
+        blockers = ray & occupied
+        if blockers: ray ^= rays[0][(blockers & -blockers).bit_length() - 1]
+        attacks = ray
+        ray = rays[1][sq]
+        blockers = ray & occupied
+        if blockers: ray ^= rays[1][(blockers & -blockers).bit_length() - 1]
+        attacks |= ray
+        ray = rays[4][sq]
+        blockers = ray & occupied
+        if blockers: ray ^= rays[4][blockers.bit_length() - 1]
+        attacks |= ray
+        ray = rays[5][sq]
+        blockers = ray & occupied
+        if blockers: ray ^= rays[5][blockers.bit_length() - 1]
+        return attacks | ray
+
+
+    def bishop_attacks(self, sq, occupied):
+        rays = self.rays
+        ray = rays[2][sq]
+        blockers = ray & occupied
+        if blockers: ray ^= rays[2][(blockers & -blockers).bit_length() - 1]
+        attacks = ray
+        ray = rays[3][sq]
+        blockers = ray & occupied
+        if blockers: ray ^= rays[3][(blockers & -blockers).bit_length() - 1]
+        attacks |= ray
+        ray = rays[6][sq]
+        blockers = ray & occupied
+        if blockers: ray ^= rays[6][blockers.bit_length() - 1]
+        attacks |= ray
+        ray = rays[7][sq]
+        blockers = ray & occupied
+        if blockers: ray ^= rays[7][blockers.bit_length() - 1]
+        return attacks | ray
+
+
+_geometries = {}
+
+def get_geometry(width, height):
+    """Returns the shared attack tables for the given board size, building them the first time"""
+    geometry = _geometries.get((width, height))
+    if geometry is None:
+        geometry = Geometry(width, height)
+        _geometries[(width, height)] = geometry
+    return geometry
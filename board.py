@@ -1,92 +1,238 @@
 import piece
+import bitboard
+import instrument
+import zobrist
+
+import re
+import struct
 
 import numpy as np
 
 
+# Planes of the tensor representation (see Board.to_planes)
+PIECE_PLANES = 12       # Whites P, H, B, T, Q, K and then blacks
+PLANE_TURN = 12         # Ones if whites are on turn
+PLANE_CASTLING = 13     # 4 planes: whites king side, whites queen side, blacks king side, blacks queen side
+PLANE_EP = 17           # The "en passant" square
+PLANE_HALFMOVES = 18    # Halfmove clock (moves since the last capture or pawn move)
+PLANE_FULLMOVES = 19    # Move number, starting at 1 and increased after the blacks move
+NUM_PLANES = 20
+
+# Methods counted and timed with Board.enable_profiling() by default
+PROFILED_METHODS = ('attempt_movement', 'legal_moves', 'push', 'is_valid_piece_movement', 'refresh_attacks')
+
+# Moves are encoded as integers: from_square | to_square << 8 | promotion << 16
+# so the squares have to fit in 8 bits
+MAX_SQUARES = 256
+PROMOTION_TYPES = (None, 'H', 'B', 'T', 'Q')
+PROMOTION_CODES = {'H':1, 'B':2, 'T':3, 'Q':4}
+
+def encode_move(from_sq, to_sq, promotion=None):
+    """Squares are indices (y * width + x). promotion is the piece type the pawn becomes, if any."""
+    if promotion is None: return from_sq | to_sq << 8
+    return from_sq | to_sq << 8 | PROMOTION_CODES[promotion] << 16
+
+def move_from(move):
+    return move & 0xFF
+
+def move_to(move):
+    return (move >> 8) & 0xFF
+
+def move_promotion(move):
+    return PROMOTION_TYPES[move >> 16]
+
+
+# Piece letters used in the standard notation (SAN) and their piece types
+SAN_TYPES = {'N':'H', 'B':'B', 'R':'T', 'Q':'Q', 'K':'K'}
+SAN_LETTERS = {'H':'N', 'B':'B', 'T':'R', 'Q':'Q', 'K':'K', 'P':''}
+SAN_PATTERN = re.compile(r'^([NBRQK])?([a-w])?(\d+)?x?([a-w])(\d+)(?:=?([NBRQ]))?$')
+
+# Packed position (see Board.pack): occupancy bitboard, 4 bits per piece in square order (team << 3 | type index),
+# castling rights, "en passant" square (255 if none), halfmove clock and turn
+PACK_FORMAT = '<Q16sBBHI'
+PACKED_SIZE = struct.calcsize(PACK_FORMAT)
+
+# Reasons of the end of a game given by Board.outcome()
+CHECKMATE = 'checkmate'
+STALEMATE = 'stalemate'
+FIFTY_MOVES = 'fifty_moves'
+INSUFFICIENT_MATERIAL = 'insufficient_material'
+REPETITION = 'repetition'
+
+
+def parse_placement(placement):
+    """
+    Pieces of the first field of a FEN (the rows from the blacks' side, e.g. 'rnbqk/ppppp/5/PPPPP/RNBQK').
+    Returns the width, the height and a list of (x, y, piece_type, is_whites).
+    """
+    rows = placement.split('/')
+    height = len(rows)
+    placed = []
+    width = 0
+    for i, row in enumerate(rows):
+        y = height - 1 - i
+        x = 0
+        for number, letter in re.findall(r'(\d+)|([a-zA-Z])', row):
+            if number:
+                x += int(number)
+                continue
+            if letter.upper() not in SAN_TYPES and letter.upper() != 'P': raise ValueError("Invalid FEN piece: " + letter)
+            placed.append((x, y, SAN_TYPES.get(letter.upper(), 'P'), letter.isupper()))
+            x += 1
+        width = max(width, x)
+    return width, height, placed
+
+
+def ordered_pieces(placed):
+    """Piece objects of a list of (x, y, piece_type, is_whites), whites first and sorted as in starting_pieces()"""
+    order = {'K':0, 'Q':1, 'B':2, 'H':3, 'T':4, 'P':5}
+    return [piece.Piece(x, y, t, is_whites) for x, y, t, is_whites in
+        sorted(placed, key=lambda p: (not p[3], order[p[2]]))]
+
+
+class Layout:
+    """
+    Starting position and rules of a chess variant: the placement of the pieces (as in a FEN),
+    whether the pawns can move two squares from their first row (and be captured "en passant"),
+    whether the kings can castle and the piece types a pawn can be promoted to.
+    """
+    def __init__(self, placement, double_step=True, castling=True, promotions=('Q', 'T', 'B', 'H')):
+        self.placement = placement
+        self.width, self.height, self.placed = parse_placement(placement)
+        self.double_step = double_step
+        self.castling = castling
+        self.promotions = tuple(promotions)
+        self.promotion_codes = tuple(sorted((PROMOTION_CODES[t] for t in promotions), reverse=True))
+
+
+    def pieces(self):
+        return ordered_pieces(self.placed)
+
+
+# Known variants. The boards of these sizes start with them by default (see DEFAULT_LAYOUTS)
+LAYOUTS = {
+    'chess': Layout('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR'),
+    'gardner': Layout('rnbqk/ppppp/5/PPPPP/RNBQK', double_step=False, castling=False),
+    'los_alamos': Layout('rnqknr/pppppp/6/6/PPPPPP/RNQKNR', double_step=False, castling=False,
+        promotions=('Q', 'T', 'H')),
+}
+DEFAULT_LAYOUTS = {(8, 8): 'chess', (5, 5): 'gardner', (6, 6): 'los_alamos'}   # Other sizes follow the chess rules
+
+
+def get_layout(layout):
+    """Layout object of a name in LAYOUTS, a placement (see parse_placement) or a Layout"""
+    if isinstance(layout, Layout): return layout
+    if layout in LAYOUTS: return LAYOUTS[layout]
+    return Layout(layout)
+
+
 class Board:
     """
     Chess board.
 
     Width and height are 8x8 by default.
 
-    Pieces attribute is None by default, which means regular starting pieces by the chess rules.
-    A list of pieces can be given to start the game with those, but the number and positions must be the same as default.
+    Pieces attribute is None by default, which means the starting pieces of the layout (see Layout): the one given,
+    or the default one of the size (DEFAULT_LAYOUTS: chess in 8x8, Gardner in 5x5 and Los Alamos in 6x6).
+    The layout can be a name of LAYOUTS or a placement as in a FEN, and then the size is taken from it.
+    A list of pieces can be given to start the game with those, with the rules of the layout.
     There is no comprobation to check if the pieces are legal which can result in bugs as default behaviour will try to be applied.
 
     There is a redundancy in the internal data representation as there are two different data structures holding references to the pieces.
     This data redundancy is done for optimization purposes due to the way methods can perform in the implementation.
+
+    The position is also kept in bitboards (see the bitboard module), one per team and one per piece type.
+    These are the ones used by the rule checks, the table and the pieces array are kept updated for the users of get_table() and get_pieces().
     """
-    def __init__(self,width=8,height=8,pieces=None,silent=False):
+    def __init__(self,width=8,height=8,pieces=None,silent=False,profile=None,layout=None):
+        if layout is not None:
+            layout = get_layout(layout)
+            width, height = layout.width, layout.height
+        elif (width, height) in DEFAULT_LAYOUTS: layout = LAYOUTS[DEFAULT_LAYOUTS[(width, height)]]
+        self.layout = layout    # None for the sizes without a default layout, that use the chess rules
+        rules = layout or LAYOUTS['chess']
+        self.double_step = rules.double_step
+        self.castling_allowed = rules.castling
+        self.promotion_codes = rules.promotion_codes
+        if width * height > MAX_SQUARES: raise ValueError("Only boards of up to %d squares are supported" % MAX_SQUARES)
         self.size = piece.Vec2(width, height)
+        self.geometry = bitboard.get_geometry(width, height)
+        self.zobrist = zobrist.get_keys(width, height)
+        self.key = 0
 
         # Table object with the references to the pieces
         self.table = np.full((width,height),None)
 
-        if pieces is None and (width, height) == (8,8):
-            pcs = Board.starting_pieces()
+        if pieces is None and layout is not None:
+            pcs = layout.pieces()
             self.pieces = np.array(pcs)
-            self.redo_table()
-        else: self.pieces = np.array(pieces)
+        else: self.pieces = np.array(pieces if pieces is not None else [], dtype=object)
+        self.evaluator = None   # See set_evaluator
+        self.psq = None
+        self.redo_table()
 
         self.silent = silent
         self.playing = 'W'      # Playing 'W' for whites, 'B' for blacks
         self.turn = 0
         self.is_check = False
         self.forward = piece.Vec2(0,1)
-
-        self.piece_ind = {   # Indices of the pieces in the list
-            'wK':(0,),  'wQ':(1,),  'wB':(2, 3),  'wH':(4, 5),  'wT':(6, 7),  'wP':(8, 9, 10,11,12,13,14,15),
-            'bK':(16,), 'bQ':(17,), 'bB':(18,19), 'bH':(20,21), 'bT':(22,23), 'bP':(24,25,26,27,28,29,30,31)
-        }
+        self.ep_square = -1         # Square index that can be captured "en passant", -1 if none
+        self.halfmove_clock = 0     # Moves since the last capture or pawn move
+        self.history = []           # Undo entries of the moves done with push()
+        self.castling = 0
+        self.setup_castling()
+        self.key = self.compute_key()   # Zobrist key of the position, kept updated on every change
+
+        self.profiler = None
+        if profile or (profile is None and instrument.profile): self.enable_profiling()
+
+        # Indices of the pieces in the list, with the default pieces:
+        # 'wK':(0,), 'wQ':(1,), 'wB':(2,3), 'wH':(4,5), 'wT':(6,7), 'wP':(8,...,15), 'bK':(16,), 'bQ':(17,), ...
+        self.piece_ind = self.index_pieces()
     
     @staticmethod
-    def starting_pieces():
+    def starting_pieces(layout='chess'):
         """
-        Returns a list of Piece objects with the starting positions as in the chess rules.
+        Returns a list of Piece objects with the starting positions of a layout (see get_layout), the chess rules by default.
+        The whites go first: kings, queens, bishops, knights, towers and pawns, and then the blacks in the same order.
         """
-        pcs = []
-        # Whites
-        pcs.append(piece.Piece(4,0,'K',True)) # King
-        pcs.append(piece.Piece(3,0,'Q',True)) # Queen
-
-        pcs.append(piece.Piece(2,0,'B',True)) # Bishops
-        pcs.append(piece.Piece(5,0,'B',True))
-        pcs.append(piece.Piece(1,0,'H',True)) # Knights
-        pcs.append(piece.Piece(6,0,'H',True))
-        pcs.append(piece.Piece(0,0,'T',True)) # Towers
-        pcs.append(piece.Piece(7,0,'T',True))
-
-        for i in range(8): pcs.append(piece.Piece(i,1,'P',True)) # Pawns
-
-        # Blacks
-        pcs.append(piece.Piece(4,7,'K',False)) # King
-        pcs.append(piece.Piece(3,7,'Q',False)) # Queen
-
-        pcs.append(piece.Piece(2,7,'B',False)) # Bishops
-        pcs.append(piece.Piece(5,7,'B',False))
-        pcs.append(piece.Piece(1,7,'H',False)) # Knights
-        pcs.append(piece.Piece(6,7,'H',False))
-        pcs.append(piece.Piece(0,7,'T',False)) # Towers
-        pcs.append(piece.Piece(7,7,'T',False))
-
-        for i in range(8): pcs.append(piece.Piece(i,6,'P',False)) # Pawns
-
-        # [WHITES] 0:K, 1:Q, 2-3:Bs, 4-5:Hs, 6-7:Ts, 8-15:Ps
-        # [BLACKS] 16:K, 17:Q, 18-19:Bs, 20-21:Hs, 22-23:Ts, 24-31:Ps
-
-        return pcs
+        # Chess: [WHITES] 0:K, 1:Q, 2-3:Bs, 4-5:Hs, 6-7:Ts, 8-15:Ps
+        #        [BLACKS] 16:K, 17:Q, 18-19:Bs, 20-21:Hs, 22-23:Ts, 24-31:Ps
+        return get_layout(layout).pieces()
     
 
     def redo_table(self):
         """
-        This method completely updates the reference table from the list of pieces.
+        This method completely updates the reference table and the bitboards from the list of pieces.
         """
         self.table = np.full(self.size.tup(),None)
-        for p in self.pieces:
-                self.table[p.pos.x,p.pos.y] = p
-
-
-    def attempt_movement(self,from_coord,to_coord):
+        self.square_coords = [piece.Vec2(x, y) for x, y in self.geometry.coords]
+        self.piece_list = list(self.pieces)     # Faster to index than the numpy array
+        self.squares = [-1] * self.geometry.num_squares    # Index of the piece in each square, -1 if empty
+        self.team_bb = [0, 0]
+        self.piece_bb = dict.fromkeys(bitboard.PIECE_TYPES, 0)
+        for i, p in enumerate(self.piece_list):
+            if not p.is_alive: continue
+            self.table[p.pos.x,p.pos.y] = p
+            sq = self.geometry.square(p.pos.x, p.pos.y)
+            self.squares[sq] = i
+            self.team_bb[p.team] |= 1 << sq
+            self.piece_bb[p.piece_type] |= 1 << sq
+
+        # Squares attacked by every piece (0 if dead). The changes of the position only mark the squares
+        # involved and the affected attacks are recomputed the next time they are needed (see refresh_attacks)
+        self.attacks = [0] * len(self.piece_list)
+        self.team_indices = ([], [])
+        for i, p in enumerate(self.piece_list):
+            self.team_indices[p.team].append(i)
+            if p.is_alive: self.attacks[i] = self.piece_attacks(i, self.geometry.square(p.pos.x, p.pos.y))
+        self.team_attacks = [-1, -1]    # Union of the attacks of each team, -1 until it's needed again
+        self.changed_squares = 0        # Squares whose occupancy changed
+        self.stale_squares = 0          # Squares with a piece that moved there, came back or was promoted
+        if self.psq is not None: self.refresh_evaluation()
+
+
+    def attempt_movement(self,from_coord,to_coord,promotion='Q'):
         """
         This is the intended method to move a piece and check if it follows the rules.
         
@@ -94,6 +240,8 @@ class Board:
         If the movement is performed, the turn changes.
 
         from_coord and to_coord are tuples or Vec2 objects.
+        Castling is done moving the king two squares. promotion is the piece type a pawn reaching the last rank becomes.
+        Use outcome() to know if the game has finished after the movement.
         """
         if type(from_coord) is tuple:
             from_coord = piece.Vec2(from_coord[0],from_coord[1])
@@ -103,51 +251,20 @@ class Board:
         if not self.is_legal_movement(from_coord, to_coord):
             return False
 
-        # Check if it's a capture and perform it
-        target = self.get_piece_at(to_coord)
-        if target is not None: target.kill()
-
-        self.move_piece(from_coord,to_coord)
-
-        #TODO is check / checkmate
-        king = self.get_specific_pieces('K', 'W' if self.playing == 'B' else 'B')[0]
-        if self.is_under_attack(king.pos, self.playing):
-            print("yes")
-            king_locked = True
-            king_steps = ((0,1),(1,0),(0,-1),(-1,0),(1,1),(-1,-1),(1,-1),(-1,1))
-            for step in king_steps:
-                coord = piece.Vec2(king.pos.x + step[0], king.pos.y + step[1])
-                if not self.is_in_boundaries(coord):
-                    # King can't move here
-                    continue
-                tg_piece = self.get_piece_at(coord)
-                if tg_piece is not None and self.is_on_team(tg_piece, 'W' if king.is_whites() else 'B'):
-                    # Can't move to a square occupied by the same team
-                    continue
-                if self.is_under_attack(coord, self.playing):
-                    # Can't move to a square under attack
-                    continue
-                
-                # No restrictions found, king can move
-                king_locked = False
-                break
-
-            # TODO check other moves that could save the king (e.g. castling, piece intercepting attack, another check)
-            #if king_locked and len(attackers) == 1: for attacker: can_be_intercepted(king, attacker)
-
-            if king_locked:
-                if not self.silent: print("Checkmate!")
-                exit()
-                
-
-            if not self.silent: print("Check!")
-        
-        #TODO is tables
-        #TODO king captured??
+        move = self.coords_to_move(from_coord, to_coord)
+        if self.get_piece_at(from_coord).piece_type == 'P' and (to_coord.y == 0 or to_coord.y == self.size.y - 1):
+            if PROMOTION_CODES.get(promotion) not in self.promotion_codes:
+                if not self.silent: print("Invalid move: Can't promote to that piece!")
+                return False
+            move |= PROMOTION_CODES[promotion] << 16
+        self.push(move)
 
-        self.turn += 1
-        self.forward.y *= -1
-        self.playing = 'W' if self.playing == 'B' else 'B'
+        if not self.silent:
+            result = self.outcome()
+            if result is None:
+                if self.in_check(): print("Check!")
+            elif result[1] == CHECKMATE: print("Checkmate!")
+            else: print("Draw by " + result[1].replace('_', ' '))
 
         return True
 
@@ -166,14 +283,492 @@ class Board:
         if not self.is_valid_piece_movement(from_coord, to_coord):
             if not self.silent: print("Ilegal move: This piece can't do that!")
             return False
-        # TODO check the king is safe
-        #if not self.check_misc_rules(from_coord, to_coord):
-            #if not self.silent: print("Ilegal move: This move can't be done.")
-            #return False
+        if not self.is_king_safe_after(from_coord, to_coord):
+            if not self.silent: print("Ilegal move: The king would be under attack!")
+            return False
 
         return True
 
     
+    def is_king_safe_after(self, from_coord, to_coord):
+        """Returns True if the king of the moving team is not under attack after the movement (that must be valid)."""
+        g = self.geometry
+        from_sq = g.square(from_coord.x, from_coord.y)
+        to_sq = g.square(to_coord.x, to_coord.y)
+        p = self.piece_list[self.squares[from_sq]]
+        own = self.team_bb[p.team]
+
+        captured = (1 << to_sq) if self.squares[to_sq] >= 0 else 0
+        if p.piece_type == 'P' and to_sq == self.ep_square:
+            captured = 1 << (to_sq - (g.width if p.team == 0 else -g.width))
+        occupied = ((self.team_bb[0] | self.team_bb[1]) & ~captured & ~(1 << from_sq)) | (1 << to_sq)
+
+        if p.piece_type == 'K': king_sq = to_sq
+        else:
+            kings = self.piece_bb['K'] & own
+            if not kings: return True
+            king_sq = bitboard.lsb(kings)
+        return not self.attackers_to(king_sq, 1 - p.team, occupied, captured)
+
+
+    def setup_castling(self):
+        """
+        Sets the castling rights from the kings and towers that haven't moved yet.
+        A king can castle with the towers in the corners of its row, if the layout allows castling.
+        """
+        rights = 0
+        for p in self.piece_list if self.castling_allowed else ():
+            if not (p.is_alive and p.piece_type == 'K' and p.first_move): continue
+            for x, right in ((self.size.x - 1, 1), (0, 2)):
+                rook = self.get_piece_at((x, p.pos.y))
+                if (rook is not None and rook.piece_type == 'T' and rook.team == p.team
+                    and rook.first_move and abs(x - p.pos.x) > 1):
+                    rights |= right << (2 * p.team)
+        self.set_castling(rights)
+
+
+    def set_castling(self, rights):
+        """
+        Sets the castling rights bitmask: 1 whites king side, 2 whites queen side, 4 blacks king side, 8 blacks queen side.
+        The king side is the one with the tower at the highest x.
+        """
+        g = self.geometry
+        self.key ^= self.zobrist.castling[self.castling] ^ self.zobrist.castling[rights]
+        self.castling = rights
+        self.castle_info = ([], [])     # Per team: (right, king from, king to, tower from, tower to)
+        self.castle_clear = [0] * g.num_squares   # Rights lost when a piece moves from or to each square
+        for team in (0, 1):
+            kings = self.piece_bb['K'] & self.team_bb[team]
+            if not kings: continue
+            k_from = bitboard.lsb(kings)
+            kx, ky = g.coords[k_from]
+            for x, right in ((g.width - 1, 1), (0, 2)):
+                right <<= 2 * team
+                if not rights & right: continue
+                side = 1 if x > kx else -1
+                r_from = g.square(x, ky)
+                self.castle_info[team].append((right, k_from, g.square(kx + 2*side, ky), r_from, g.square(kx + side, ky)))
+                self.castle_clear[k_from] |= right
+                self.castle_clear[r_from] |= right
+
+
+    def can_castle(self, team, k_from, k_to, r_from, r_to):
+        """Checks that the path between the king and the tower is empty and the king doesn't go through attacked squares"""
+        g = self.geometry
+        occupied = self.team_bb[0] | self.team_bb[1]
+        n = g.num_squares
+        if g.between[k_from * n + r_from] & occupied: return False
+        if ((1 << k_to) | (1 << r_to)) & occupied & ~((1 << k_from) | (1 << r_from)): return False
+        path = g.between[k_from * n + k_to] | (1 << k_to) | (1 << k_from)
+        return not self.attacked_by(1 - team) & path
+
+
+    def in_check(self):
+        """Returns True if the king of the team on turn is under attack"""
+        team = 0 if self.playing == 'W' else 1
+        kings = self.piece_bb['K'] & self.team_bb[team]
+        if not kings: return False
+        return self.attacked_by(1 - team) & kings != 0
+
+
+    def has_legal_moves(self):
+        """Returns True if the team on turn can move. Stops at the first legal move found."""
+        for move in self.legal_moves(): return True
+        return False
+
+
+    def is_checkmate(self):
+        return self.in_check() and not self.has_legal_moves()
+
+
+    def is_stalemate(self):
+        return not self.in_check() and not self.has_legal_moves()
+
+
+    def is_insufficient_material(self):
+        """
+        Returns True if no sequence of moves can end in a checkmate: only kings are left,
+        or kings and one knight or bishop, or kings and bishops all on squares of the same color.
+        """
+        pbb = self.piece_bb
+        if pbb['P'] or pbb['T'] or pbb['Q']: return False
+        minors = pbb['H'] | pbb['B']
+        if not minors & (minors - 1): return True
+        if pbb['H']: return False
+        # Only bishops, the squares of a color are the ones with an even x + y
+        width = self.geometry.width
+        colors = set((sq % width + sq // width) % 2 for sq in bitboard.iter_bits(pbb['B']))
+        return len(colors) == 1
+
+
+    def outcome(self):
+        """
+        Returns None if the game goes on. Otherwise returns (result, reason), where result is 1 if whites won,
+        -1 if blacks won and 0 if it's a draw, and reason is CHECKMATE, STALEMATE, FIFTY_MOVES,
+        INSUFFICIENT_MATERIAL or REPETITION (threefold, counted over the moves done with push()).
+        """
+        if not self.has_legal_moves():
+            if self.in_check(): return (1 if self.playing == 'B' else -1, CHECKMATE)
+            return (0, STALEMATE)
+        if self.halfmove_clock >= 100: return (0, FIFTY_MOVES)
+        if self.is_insufficient_material(): return (0, INSUFFICIENT_MATERIAL)
+        if self.is_repetition(3): return (0, REPETITION)
+        return None
+
+
+    def legal_moves(self, captures_only=False):
+        """
+        Generator with all the legal moves of the team on turn, encoded as integers (see encode_move).
+        Pins, checks, castling, "en passant" and promotions are taken into account, so all of them can be performed.
+
+        With captures_only=True only the captures and the promotions are generated (quiescence search).
+        """
+        g = self.geometry
+        n = g.num_squares
+        pbb = self.piece_bb
+        us = 0 if self.playing == 'W' else 1
+        them = 1 - us
+        own = self.team_bb[us]
+        opp = self.team_bb[them]
+        occupied = own | opp
+        not_own = opp if captures_only else g.full & ~own
+        attackers_to = self.attackers_to
+
+        kings = pbb['K'] & own
+        king_sq = -1
+        checkers = 0
+        target = g.full
+        pinned = 0
+        if kings:
+            king_sq = (kings & -kings).bit_length() - 1
+            enemy_attacks = self.attacked_by(them)
+            moves = g.king[king_sq] & not_own
+            if enemy_attacks & kings:
+                checkers = attackers_to(king_sq, them, occupied)
+                # King steps, checked without the king so it can't hide behind itself from a ray
+                no_king = occupied ^ kings
+                while moves:
+                    low = moves & -moves
+                    to = low.bit_length() - 1
+                    if not attackers_to(to, them, no_king):
+                        yield king_sq | to << 8
+                    moves ^= low
+            else:
+                # Without check no ray ends in the king, so the attack map is exact
+                moves &= ~enemy_attacks
+                while moves:
+                    low = moves & -moves
+                    yield king_sq | (low.bit_length() - 1) << 8
+                    moves ^= low
+
+            if checkers:
+                if checkers & (checkers - 1): return   # Double check, only the king can move
+                checker = (checkers & -checkers).bit_length() - 1
+                target = checkers | g.between[king_sq * n + checker]
+
+            # Pieces pinned to the king and the squares where they can move
+            pin_rays = {}
+            snipers = ((g.rook_rays[king_sq] & (pbb['T'] | pbb['Q']))
+                | (g.bishop_rays[king_sq] & (pbb['B'] | pbb['Q']))) & opp
+            while snipers:
+                low = snipers & -snipers
+                path = g.between[king_sq * n + low.bit_length() - 1]
+                blockers = path & occupied
+                if blockers and not blockers & (blockers - 1) and blockers & own:
+                    pinned |= blockers
+                    pin_rays[blockers.bit_length() - 1] = path | low
+                snipers ^= low
+
+        # Knights, bishops, towers and queens
+        for piece_type in ('H', 'B', 'T', 'Q'):
+            pieces = pbb[piece_type] & own
+            while pieces:
+                low = pieces & -pieces
+                sq = low.bit_length() - 1
+                pieces ^= low
+                if piece_type == 'H':
+                    if low & pinned: continue
+                    moves = g.knight[sq]
+                elif piece_type == 'B': moves = g.bishop_attacks(sq, occupied)
+                elif piece_type == 'T': moves = g.rook_attacks(sq, occupied)
+                else: moves = g.rook_attacks(sq, occupied) | g.bishop_attacks(sq, occupied)
+                moves &= not_own & target
+                if low & pinned: moves &= pin_rays[sq]
+                while moves:
+                    to_low = moves & -moves
+                    yield sq | (to_low.bit_length() - 1) << 8
+                    moves ^= to_low
+
+        # Pawns
+        step = g.width if us == 0 else -g.width
+        start_y = (1 if us == 0 else g.height - 2) if self.double_step else -1
+        last_y = g.height - 1 if us == 0 else 0
+        pawns = pbb['P'] & own
+        while pawns:
+            low = pawns & -pawns
+            sq = low.bit_length() - 1
+            pawns ^= low
+            allowed = target & pin_rays[sq] if low & pinned else target
+
+            to_list = []
+            to = sq + step
+            if 0 <= to < n and not (occupied >> to) & 1:
+                if (allowed >> to) & 1 and (not captures_only or to // g.width == last_y): to_list.append(to)
+                two = to + step
+                if not captures_only and sq // g.width == start_y and 0 <= two < n and not (occupied >> two) & 1 and (allowed >> two) & 1:
+                    to_list.append(two)
+            captures = g.pawn[us][sq] & opp & allowed
+            while captures:
+                to_low = captures & -captures
+                to_list.append(to_low.bit_length() - 1)
+                captures ^= to_low
+
+            ep = self.ep_square
+            if ep >= 0 and (g.pawn[us][sq] >> ep) & 1:
+                captured = ep - step
+                if not checkers or (target >> ep) & 1 or (checkers >> captured) & 1:
+                    # The pawns leaving the row could uncover an attack to the king
+                    after = (occupied ^ low ^ (1 << captured)) | (1 << ep)
+                    if king_sq < 0 or not ((g.rook_attacks(king_sq, after) & (pbb['T'] | pbb['Q']) & opp)
+                        or (g.bishop_attacks(king_sq, after) & (pbb['B'] | pbb['Q']) & opp)):
+                        to_list.append(ep)
+
+            for to in to_list:
+                if to // g.width == last_y:
+                    for code in self.promotion_codes:
+                        yield sq | to << 8 | code << 16
+                else: yield sq | to << 8
+
+        # Castling
+        if self.castling and not checkers and not captures_only:
+            for right, k_from, k_to, r_from, r_to in self.castle_info[us]:
+                if self.castling & right and k_from == king_sq and self.can_castle(us, k_from, k_to, r_from, r_to):
+                    yield k_from | k_to << 8
+
+
+    def legal_move_list(self):
+        """List with all the legal moves (see legal_moves)"""
+        return list(self.legal_moves())
+
+
+    def legal_move_array(self):
+        """Numpy int32 array with all the legal moves (see legal_moves)"""
+        return np.fromiter(self.legal_moves(), dtype=np.int32)
+
+
+    def book_moves(self, book):
+        """Moves of the opening book (see book.Book) in this position: list of (move, games, wins, draws, losses)"""
+        return book.lookup(self)
+
+
+    def book_move(self, book, rng=None, temperature=1.0):
+        """Random move of the opening book weighted by how often it was played, None if out of the book"""
+        return book.sample(self, rng, temperature)
+
+
+    def play_book(self, book, max_plies=20, rng=None, temperature=1.0):
+        """
+        Plays random book moves (see book_move) until the position leaves the book or max_plies are played,
+        so games can start from different openings. Returns the number of moves played.
+        """
+        for plies in range(max_plies):
+            move = book.sample(self, rng, temperature)
+            if move is None: return plies
+            self.push(move)
+        return max_plies
+
+
+    def coords_to_move(self, from_coord, to_coord, promotion=None):
+        """Encodes a movement given with tuples or Vec2 objects"""
+        if type(from_coord) is not tuple: from_coord = from_coord.tup()
+        if type(to_coord) is not tuple: to_coord = to_coord.tup()
+        return encode_move(self.geometry.square(*from_coord), self.geometry.square(*to_coord), promotion)
+
+
+    def square_name(self, sq):
+        """Name of a square index in the standard notation, e.g. 'e4'"""
+        x, y = self.geometry.coords[sq]
+        return chr(ord('a') + x) + str(y + 1)
+
+
+    def move_to_uci(self, move):
+        """Encoded move in coordinates notation, e.g. 'e2e4' or 'e7e8q'"""
+        promotion = PROMOTION_TYPES[move >> 16]
+        s = self.square_name(move & 0xFF) + self.square_name((move >> 8) & 0xFF)
+        return s + SAN_LETTERS[promotion].lower() if promotion else s
+
+
+    def parse_uci(self, text):
+        """Returns the encoded legal move written in coordinates notation (e.g. 'e2e4'), raises ValueError if it isn't legal"""
+        for move in self.legal_moves():
+            if self.move_to_uci(move) == text.strip().lower(): return move
+        raise ValueError("Illegal move: " + text)
+
+
+    def parse_san(self, san):
+        """
+        Returns the encoded legal move written in standard algebraic notation (e.g. 'Nf3', 'exd5', 'O-O', 'e8=Q+').
+        Raises ValueError if it can't be parsed or there isn't exactly one legal move matching it.
+        """
+        text = san.rstrip('+#!?')
+        g = self.geometry
+        if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+            team = 0 if self.playing == 'W' else 1
+            long = len(text) == 5
+            for right, k_from, k_to, r_from, r_to in self.castle_info[team]:
+                if (r_from < k_from) == long:
+                    move = k_from | k_to << 8
+                    if move in self.legal_move_list(): return move
+            raise ValueError("Illegal castling: " + san)
+
+        match = SAN_PATTERN.match(text)
+        if match is None: raise ValueError("Invalid move notation: " + san)
+        letter, from_file, from_rank, to_file, to_rank, promotion = match.groups()
+        piece_type = SAN_TYPES[letter] if letter else 'P'
+        to_sq = g.square(ord(to_file) - ord('a'), int(to_rank) - 1)
+        promotion = PROMOTION_CODES[SAN_TYPES[promotion]] if promotion else 0
+
+        found = -1
+        for move in self.legal_moves():
+            if (move >> 8) & 0xFF != to_sq or move >> 16 != promotion: continue
+            from_sq = move & 0xFF
+            if self.piece_list[self.squares[from_sq]].piece_type != piece_type: continue
+            x, y = g.coords[from_sq]
+            if from_file is not None and x != ord(from_file) - ord('a'): continue
+            if from_rank is not None and y != int(from_rank) - 1: continue
+            if found >= 0: raise ValueError("Ambiguous move: " + san)
+            found = move
+        if found < 0: raise ValueError("Illegal move: " + san)
+        return found
+
+
+    def move_to_coords(self, move):
+        """Returns the origin and destination tuples and the promotion type (or None) of an encoded move"""
+        return self.geometry.coords[move & 0xFF], self.geometry.coords[(move >> 8) & 0xFF], PROMOTION_TYPES[move >> 16]
+
+
+    def push(self, move):
+        """
+        Performs an encoded move (captures, castling, "en passant" and promotion included) and changes the turn.
+        It doesn't check if the move is legal, use the moves given by legal_moves().
+
+        An undo entry is saved so the move can be reverted with pop() instead of copying the board.
+        """
+        g = self.geometry
+        from_sq = move & 0xFF
+        to_sq = (move >> 8) & 0xFF
+        promotion = move >> 16
+        p = self.piece_list[self.squares[from_sq]]
+        piece_type = p.piece_type
+        flags = 1 if p.first_move else 0
+        key = self.key
+        self.key ^= self.ep_key()
+
+        captured = self.squares[to_sq]
+        captured_sq = to_sq
+        if captured >= 0: self.kill_square(to_sq)
+        elif piece_type == 'P' and to_sq == self.ep_square:
+            captured_sq = to_sq - (g.width if p.team == 0 else -g.width)
+            captured = self.squares[captured_sq]
+            self.kill_square(captured_sq)
+        self.move_square(from_sq, to_sq)
+
+        if piece_type == 'K' and (to_sq - from_sq == 2 or from_sq - to_sq == 2) and to_sq // g.width == from_sq // g.width:
+            for right, k_from, k_to, r_from, r_to in self.castle_info[p.team]:
+                if k_from == from_sq and k_to == to_sq:
+                    if self.piece_list[self.squares[r_from]].first_move: flags |= 2
+                    self.move_square(r_from, r_to)
+                    break
+        if promotion: self.set_piece_type(to_sq, PROMOTION_TYPES[promotion])
+
+        self.history.append((move, captured, captured_sq, flags, self.castling, self.ep_square, self.halfmove_clock, key))
+
+        castling = self.castling & ~(self.castle_clear[from_sq] | self.castle_clear[to_sq])
+        if castling != self.castling:
+            self.key ^= self.zobrist.castling[self.castling] ^ self.zobrist.castling[castling]
+            self.castling = castling
+        if piece_type == 'P' and abs(to_sq - from_sq) == 2 * g.width: self.ep_square = (from_sq + to_sq) // 2
+        else: self.ep_square = -1
+        if captured >= 0 or piece_type == 'P': self.halfmove_clock = 0
+        else: self.halfmove_clock += 1
+
+        self.turn += 1
+        self.forward.y *= -1
+        self.playing = 'W' if self.playing == 'B' else 'B'
+        self.key ^= self.zobrist.blacks_turn ^ self.ep_key()
+
+
+    def pop(self):
+        """Reverts the last move done with push() and returns it"""
+        move, captured, captured_sq, flags, castling, ep_square, halfmove_clock, key = self.history.pop()
+        g = self.geometry
+        from_sq = move & 0xFF
+        to_sq = (move >> 8) & 0xFF
+
+        self.turn -= 1
+        self.forward.y *= -1
+        self.playing = 'W' if self.playing == 'B' else 'B'
+
+        if move >> 16: self.set_piece_type(to_sq, 'P')
+        p = self.piece_list[self.squares[to_sq]]
+        if p.piece_type == 'K' and (to_sq - from_sq == 2 or from_sq - to_sq == 2) and to_sq // g.width == from_sq // g.width:
+            for right, k_from, k_to, r_from, r_to in self.castle_info[p.team]:
+                if k_from == from_sq and k_to == to_sq:
+                    self.move_square(r_to, r_from)
+                    self.piece_list[self.squares[r_from]].first_move = bool(flags & 2)
+                    break
+        self.move_square(to_sq, from_sq)
+        p.first_move = bool(flags & 1)
+        if captured >= 0: self.revive_square(captured, captured_sq)
+
+        self.castling = castling
+        self.ep_square = ep_square
+        self.halfmove_clock = halfmove_clock
+        self.key = key
+        return move
+
+
+    def ep_key(self):
+        """
+        Part of the zobrist key given by the "en passant" square.
+        It's only counted if a pawn on turn can do the capture, so it doesn't break the repetitions.
+        """
+        ep = self.ep_square
+        if ep < 0: return 0
+        team = 0 if self.playing == 'W' else 1
+        if not self.geometry.pawn[1 - team][ep] & self.piece_bb['P'] & self.team_bb[team]: return 0
+        return self.zobrist.ep[ep % self.geometry.width]
+
+
+    def compute_key(self):
+        """Computes the zobrist key of the position from scratch (the board keeps it updated in self.key)"""
+        key = 0
+        for sq, ind in enumerate(self.squares):
+            if ind >= 0:
+                p = self.piece_list[ind]
+                key ^= self.zobrist.pieces[p.team][p.piece_type][sq]
+        if self.playing == 'B': key ^= self.zobrist.blacks_turn
+        return key ^ self.zobrist.castling[self.castling] ^ self.ep_key()
+
+
+    def is_repetition(self, count=3):
+        """
+        Returns True if the current position has happened at least count times (3 for the threefold repetition rule),
+        comparing the zobrist keys of the moves done with push() since the last capture or pawn move.
+        """
+        key = self.key
+        found = 1
+        history = self.history
+        i = len(history) - 2
+        stop = max(0, len(history) - self.halfmove_clock)
+        while i >= stop:
+            if history[i][7] == key:
+                found += 1
+                if found >= count: return True
+            i -= 2
+        return False
+
+
     def is_piece_on_turn(self, coord):
         """Only returns true if there is a moveable piece in the coordinate given in the turn."""
         p = self.table[coord.tup()]
@@ -192,173 +787,168 @@ class Board:
         if not self.is_in_boundaries(to_coord):
             return False
         
-        p = self.get_piece_at(from_coord)
-        if self.get_piece_at(to_coord) is not None:
-            if self.get_piece_at(to_coord).team == p.team:  # Moving to a same team piece
-                # TODO check if its castling
-                return False
+        width = self.size.x
+        from_sq = from_coord.y * width + from_coord.x
+        to_sq = to_coord.y * width + to_coord.x
+        p = self.piece_list[self.squares[from_sq]]
+        target = self.squares[to_sq]
+        if target >= 0 and self.piece_list[target].team == p.team:  # Moving to a same team piece
+            return False
 
-        movement = to_coord - from_coord
+        dx = to_coord.x - from_coord.x
+        dy = to_coord.y - from_coord.y
+        adx = dx if dx >= 0 else -dx
+        ady = dy if dy >= 0 else -dy
         piece_type = p.piece_type
         
         # BISHOP
         if piece_type == 'B':
-            return (abs(movement.x) == abs(movement.y) and 
-                self.check_in_path(from_coord, piece.Vec2(movement.x/abs(movement.x), movement.y/abs(movement.x)), abs(movement.x)))
+            return adx == ady and adx > 0 and self.is_path_clear(from_sq, dx // adx, dy // ady, adx)
         
         # KNIGHT
         if piece_type == 'H':
-            absolute = piece.Vec2(abs(movement.x), abs(movement.y))
-            return ((absolute.x == 1 or absolute.x == 2)
-                and (absolute.y == 1 or absolute.y == 2)
-                and (absolute.x != absolute.y))
+            return (adx == 1 and ady == 2) or (adx == 2 and ady == 1)
         
         # ROOK
         if piece_type == 'T':
-            absolute = piece.Vec2(abs(movement.x), abs(movement.y))
-            leng = movement.x + movement.y
-            unit = piece.Vec2(movement.x/movement.x,0) if movement.x != 0 else piece.Vec2(0,movement.y/movement.y)
-            if ((absolute.x == 0 or absolute.y == 0)
-                and (absolute.x > 0 or absolute.y > 0)):
-                length = absolute.x + absolute.y
-                step = piece.Vec2(movement.x/length,movement.y/length)
-                return self.check_in_path(from_coord, step, length)
+            if (adx == 0 or ady == 0) and (adx > 0 or ady > 0):
+                length = adx + ady
+                return self.is_path_clear(from_sq, dx // length, dy // length, length)
+            return False
         
         # QUEEN
         if piece_type == 'Q':
-            absolute = piece.Vec2(abs(movement.x), abs(movement.y))
-            if absolute.x == absolute.y:
-                return self.check_in_path(from_coord, piece.Vec2(movement.x/absolute.x, movement.y/absolute.x), absolute.x)
-            elif ((absolute.x == 0 or absolute.y == 0) and (absolute.x > 0 or absolute.y > 0)):
-                length = absolute.x + absolute.y
-                step = piece.Vec2(movement.x/length,movement.y/length)
-                return self.check_in_path(from_coord, step, length)
+            if adx == ady and adx > 0:
+                return self.is_path_clear(from_sq, dx // adx, dy // adx, adx)
+            elif (adx == 0 or ady == 0) and (adx > 0 or ady > 0):
+                length = adx + ady
+                return self.is_path_clear(from_sq, dx // length, dy // length, length)
+            return False
 
         # KING
         if piece_type == 'K':
-            absolute = piece.Vec2(abs(movement.x), abs(movement.y))
-            
-            # Check castling
-            if p.first_move and absolute.x == 2:
-                cr_x = 0 if to_coord.x == 2 else 7
-                castling_rook = self.get_piece_at((cr_x,to_coord.y))
-                if (castling_rook is not None) and castling_rook.first_move:
-                    unit = piece.Vec2(int(movement.x/absolute.x), 0)
-                    lng = abs(castling_rook.pos.x - from_coord.x)
-                    if self.check_in_path(from_coord, unit, lng):
-                        atk = 'B' if p.is_whites() else 'W'
-                        if not (self.is_under_attack(from_coord, t) or self.is_under_attack(to_coord, t)):
-                            # TODO: the movement should be outside this "checking" method
-                            self.move_piece(piece.Vec2(cr_x, to_coord.y), piece.Vec2((3 if cr_x == 0 else 5),to_coord.y))
-                            return True
-
-            return (absolute.x + absolute.y == 1) or (absolute.x == 1 and absolute.y == 1)
+            # Check castling (the rook is moved when the movement is performed)
+            if adx == 2 and ady == 0:
+                for right, k_from, k_to, r_from, r_to in self.castle_info[p.team]:
+                    if (self.castling & right) and k_from == from_sq and k_to == to_sq:
+                        return self.can_castle(p.team, k_from, k_to, r_from, r_to)
+                return False
+
+            return adx <= 1 and ady <= 1
         
         # PAWN
         if piece_type == 'P':
-            if movement == self.forward:    # 1 forward move
-                return self.get_piece_at(to_coord) is None
+            forward = self.forward.y
+            if dx == 0 and dy == forward:    # 1 forward move
+                return target < 0
 
-            elif movement.y == self.forward.y and abs(movement.x) == 1: # Diagonal capture movement
-                return self.get_piece_at(to_coord) is not None
+            elif dy == forward and adx == 1: # Diagonal capture movement, also "en passant"
+                return target >= 0 or self.ep_square == to_sq
 
-            elif movement == (self.forward * 2):    # 2 forward initial move
-                return (((p.is_whites() and from_coord.y == 1)  # TODO optimize with the new variable
-                    or (p.is_blacks() and from_coord.y == self.size.y - 2))
-                    and self.get_piece_at(to_coord) is None) # TODO check if there is piece on 2-forw path
-            
-            #TODO check "en passant" case
-            #TODO check pawn promotion
+            elif dx == 0 and dy == 2 * forward and self.double_step:    # 2 forward initial move
+                return (((p.team == 0 and from_coord.y == 1)
+                    or (p.team == 1 and from_coord.y == self.size.y - 2))
+                    and target < 0
+                    and self.squares[from_sq + forward * width] < 0)
 
-            else: return False
+            return False
         
         return False
     
 
+    def is_path_clear(self, from_sq, dx, dy, num_steps):
+        """
+        Integer fast path of check_in_path: returns True if there is no piece between the square index
+        and the square num_steps away following the unit step (dx, dy). Both squares must be in the board.
+        """
+        squares = self.squares
+        step = dy * self.size.x + dx
+        sq = from_sq + step
+        for i in range(1, num_steps):
+            if squares[sq] >= 0:
+                return False
+            sq += step
+        return True
+
+
     def check_in_path(self, start, vec_step, num_steps):
         """Given a start, a step vector and a number of steps, returns True if there is no piece in the calculated path"""
-        print("Trying " + str(start) + " using " + str(vec_step) + " " + str(num_steps) + " times")
-        current = start
+        if instrument.debug: instrument.logger.debug("Trying %s using %s %d times", start, vec_step, num_steps)
+        x, y = start.x, start.y
+        dx, dy = vec_step.x, vec_step.y
+        width = self.size.x
+        squares = self.squares
         for i in range(1, num_steps):
-            current += vec_step
-            if self.get_piece_at(current) is not None:
+            x += dx
+            y += dy
+            if squares[y * width + x] >= 0:
                 return False
         return True
 
     
     def is_under_attack(self, coord, attackers):
         """Checks if the given coordinate is currently under attack from the attacking team"""
-        # Performance oriented implementation (checks surroundings instead of checking all pieces)
-        
-        # Check the diagonals and lines of the coordinate
-        diag_steps = ((1,1),(1,-1),(-1,1),(-1,-1))
-        stra_steps = ((0,1),(1,0),(0,-1),(-1,0))
-
-        # Check for diagonal attacks (queen, bishop, pawn* and king*)
-        for step in diag_steps:
-            found,dist = self.first_in_path(coord, piece.Vec2(step[0], step[1]))
-            print(found)
-
-            if found is not None:
-                # Check team
-                if (found.is_whites() and attackers == 'W') or (not found.is_whites() and attackers == 'B'):
-                    # Check type
-                    if found.piece_type == 'Q' or found.piece_type == 'B':
-                        return True
-                    elif (found.piece_type == 'P' and dist == 1 
-                        and ((step[1] == 1 and found.is_blacks()) or (step[1] == -1 and found.is_whites()))):
-                        return True
-                    elif found.piece_type == 'K' and dist == 1:
-                        return True
-
-        
-        # Check for vertical/horizontal attacks (queen, rook and king*)
-        for step in stra_steps:
-            found,dist = self.first_in_path(coord, piece.Vec2(step[0], step[1]))
-            print(found)
+        if type(coord) is tuple: sq = coord[1] * self.size.x + coord[0]
+        else: sq = coord.y * self.size.x + coord.x
+        return (self.attacked_by(0 if attackers == 'W' else 1) >> sq) & 1 == 1
 
-            if found is not None:
-                # Check team
-                if (found.is_whites() and attackers == 'W') or (not found.is_whites() and attackers == 'B'):
-                    # Check type
-                    if found.piece_type == 'T' or found.piece_type == 'Q':
-                        return True
-                    elif found.piece_type == 'K' and dist == 1:
-                        return True
 
+    def attackers_to(self, sq, team, occupied=None, ignore=0):
+        """
+        Returns a bitboard with the pieces of the team (0 whites, 1 blacks) attacking the square index.
+        A different occupancy can be given to check the attacks as if some pieces were moved,
+        and the pieces in the ignore bitboard are not counted as attackers (e.g. captured pieces).
+        """
+        g = self.geometry
+        pbb = self.piece_bb
+        if occupied is None: occupied = self.team_bb[0] | self.team_bb[1]
+        them = self.team_bb[team] & occupied & ~ignore
 
-        # Check knights
-        knghs = self.get_specific_pieces('K', attackers)
-        for kngh in knghs:
-            rel = abs(kngh.pos - coord)
-            if (rel.x == 1 and rel.y == 2) or (rel.x == 2 and rel.y == 1):
-                return True
+        attackers = ((g.knight[sq] & pbb['H'])
+            | (g.king[sq] & pbb['K'])
+            | (g.pawn[1 - team][sq] & pbb['P']))    # A pawn attacks sq if a rival pawn in sq would attack it
+        rooks = pbb['T'] | pbb['Q']
+        if rooks & them: attackers |= g.rook_attacks(sq, occupied) & rooks
+        bishops = pbb['B'] | pbb['Q']
+        if bishops & them: attackers |= g.bishop_attacks(sq, occupied) & bishops
 
-
-        return False
+        return attackers & them
 
 
     def first_in_path(self, from_coord, step):
         """Returns the first found piece in the path and its distance. Doesn't count the starting coord."""
-        piece = None
+        width, height = self.size.x, self.size.y
+        squares = self.squares
+        dx, dy = step.x, step.y
+        x, y = from_coord.x + dx, from_coord.y + dy
         l = 1
-        checking_coord = from_coord + step
-        while self.is_in_boundaries(checking_coord):
-            piece = self.get_piece_at(checking_coord)
-            if piece is not None:
+        while 0 <= x < width and 0 <= y < height:
+            ind = squares[y * width + x]
+            if ind >= 0:
                 # Found a piece
-                break
+                return self.piece_list[ind], l
 
-            checking_coord += step
+            x += dx
+            y += dy
             l += 1
 
-        return piece, l
+        return None, l
 
     
     def get_piece_at(self, coord):
         """*coord*: can be a tuple or a Vec2"""
-        if type(coord) is tuple: return self.table[coord]
-        return self.table[coord.tup()]
+        if type(coord) is tuple: ind = self.squares[coord[1] * self.size.x + coord[0]]
+        else: ind = self.squares[coord.y * self.size.x + coord.x]
+        if ind < 0: return None
+        return self.piece_list[ind]
+
+
+    def index_pieces(self):
+        """Returns a dictionary with the indices in the pieces list of each team ('w', 'b') and piece type, e.g. 'wK'"""
+        inds = {team + t: [] for team in ('w', 'b') for t in bitboard.PIECE_TYPES}
+        for i, p in enumerate(self.piece_list):
+            inds[('w' if p.is_whites() else 'b') + p.piece_type].append(i)
+        return {k: tuple(v) for k, v in inds.items()}
 
 
     def get_specific_pieces(self, piece_type, piece_team):
@@ -382,11 +972,176 @@ class Board:
 
         from_coord and to_coord are Vec2 objects.
         """
-        piece = self.table[from_coord.x,from_coord.y]
-        self.table[from_coord.x,from_coord.y] = None
-        piece.move(to_coord)
-        if self.is_in_boundaries(to_coord):
-            self.table[to_coord.x,to_coord.y] = piece
+        from_sq = from_coord.y * self.size.x + from_coord.x
+        if not self.is_in_boundaries(to_coord):
+            ind = self.squares[from_sq]
+            piece = self.piece_list[ind] if ind >= 0 else None
+            self.table[from_coord.x,from_coord.y] = None
+            piece.move(to_coord)
+            self.remove_square(from_sq)
+            return
+
+        to_sq = to_coord.y * self.size.x + to_coord.x
+        if self.squares[to_sq] >= 0:
+            # The replaced piece is excluded from the table
+            self.remove_square(to_sq)
+        self.move_square(from_sq, to_sq)
+
+
+    def move_square(self, from_sq, to_sq):
+        """Fast path of move_piece using square indices. The destination must be empty."""
+        ind = self.squares[from_sq]
+        p = self.piece_list[ind]
+        bit = (1 << from_sq) | (1 << to_sq)
+        self.team_bb[p.team] ^= bit
+        self.piece_bb[p.piece_type] ^= bit
+        self.squares[from_sq] = -1
+        self.squares[to_sq] = ind
+        keys = self.zobrist.pieces[p.team][p.piece_type]
+        self.key ^= keys[from_sq] ^ keys[to_sq]
+
+        coord = self.square_coords[to_sq]
+        self.table[p.pos.x, p.pos.y] = None
+        self.table[coord.x, coord.y] = p
+        p.move(coord)
+        self.changed_squares |= bit
+        self.stale_squares |= 1 << to_sq
+        if self.psq is not None:
+            values = self.psq[p.team][p.piece_type]
+            self.psq_score += values[to_sq] - values[from_sq]
+
+
+    def remove_square(self, sq):
+        """Takes the piece in the square index out of the bitboards and the table without killing it"""
+        ind = self.squares[sq]
+        p = self.piece_list[ind]
+        self.team_bb[p.team] ^= 1 << sq
+        self.piece_bb[p.piece_type] ^= 1 << sq
+        self.squares[sq] = -1
+        self.key ^= self.zobrist.pieces[p.team][p.piece_type][sq]
+        x, y = self.geometry.coords[sq]
+        self.table[x, y] = None
+        self.attacks[ind] = 0
+        self.changed_squares |= 1 << sq
+        if self.psq is not None:
+            self.psq_score -= self.psq[p.team][p.piece_type][sq]
+            self.phase -= self.evaluator.phase_weights[p.piece_type]
+        return p
+
+
+    def revive_square(self, ind, sq):
+        """Puts back the dead piece with the index given in the square index"""
+        p = self.piece_list[ind]
+        coord = self.square_coords[sq]
+        p.revive_to(coord)
+        self.squares[sq] = ind
+        self.team_bb[p.team] |= 1 << sq
+        self.piece_bb[p.piece_type] |= 1 << sq
+        self.key ^= self.zobrist.pieces[p.team][p.piece_type][sq]
+        self.table[coord.x, coord.y] = p
+        self.changed_squares |= 1 << sq
+        self.stale_squares |= 1 << sq
+        if self.psq is not None:
+            self.psq_score += self.psq[p.team][p.piece_type][sq]
+            self.phase += self.evaluator.phase_weights[p.piece_type]
+
+
+    def set_piece_type(self, sq, piece_type):
+        """Changes the type of the piece in the square index (pawn promotion)"""
+        p = self.piece_list[self.squares[sq]]
+        self.piece_bb[p.piece_type] ^= 1 << sq
+        self.piece_bb[piece_type] ^= 1 << sq
+        keys = self.zobrist.pieces[p.team]
+        self.key ^= keys[p.piece_type][sq] ^ keys[piece_type][sq]
+        if self.psq is not None:
+            values = self.psq[p.team]
+            self.psq_score += values[piece_type][sq] - values[p.piece_type][sq]
+            weights = self.evaluator.phase_weights
+            self.phase += weights[piece_type] - weights[p.piece_type]
+        p.piece_type = piece_type
+        self.stale_squares |= 1 << sq
+
+
+    def set_evaluator(self, evaluator):
+        """
+        Keeps the piece-square score of the evaluator (see evaluation.Evaluator) and the game phase
+        updated with every change of the position, so evaluating it costs O(1). None stops it.
+        """
+        self.evaluator = evaluator
+        self.psq = evaluator.psq if evaluator is not None else None
+        if evaluator is not None: self.refresh_evaluation()
+
+
+    def refresh_evaluation(self):
+        """Recomputes the piece-square score and the phase from the bitboards"""
+        self.psq_score = 0
+        self.phase = 0
+        for team in (0, 1):
+            for piece_type, bb in self.piece_bb.items():
+                values = self.psq[team][piece_type]
+                for sq in bitboard.iter_bits(bb & self.team_bb[team]):
+                    self.psq_score += values[sq]
+                    self.phase += self.evaluator.phase_weights[piece_type]
+
+
+    def piece_attacks(self, ind, sq):
+        """Bitboard with the squares attacked by the piece with the given index placed in the square index"""
+        p = self.piece_list[ind]
+        t = p.piece_type
+        g = self.geometry
+        if t == 'P': return g.pawn[p.team][sq]
+        if t == 'H': return g.knight[sq]
+        if t == 'K': return g.king[sq]
+        occupied = self.team_bb[0] | self.team_bb[1]
+        if t == 'B': return g.bishop_attacks(sq, occupied)
+        if t == 'T': return g.rook_attacks(sq, occupied)
+        return g.rook_attacks(sq, occupied) | g.bishop_attacks(sq, occupied)
+
+
+    def refresh_attacks(self):
+        """
+        Recomputes the attacks of the pieces in the stale squares and of the bishops, towers and queens
+        whose attacks reach a square whose occupancy changed. The rest of the attacks are still valid.
+        """
+        pbb = self.piece_bb
+        attacks = self.attacks
+        squares = self.squares
+        changed = self.changed_squares
+        update = self.stale_squares
+        if changed:
+            sliders = pbb['B'] | pbb['T'] | pbb['Q']
+            while sliders:
+                low = sliders & -sliders
+                if attacks[squares[low.bit_length() - 1]] & changed: update |= low
+                sliders ^= low
+        update &= self.team_bb[0] | self.team_bb[1]
+        while update:
+            low = update & -update
+            sq = low.bit_length() - 1
+            ind = squares[sq]
+            attacks[ind] = self.piece_attacks(ind, sq)
+            update ^= low
+        self.changed_squares = self.stale_squares = 0
+        self.team_attacks[0] = self.team_attacks[1] = -1
+
+
+    def attacked_by(self, team):
+        """Bitboard with all the squares attacked by the team (0 whites, 1 blacks)"""
+        if self.changed_squares or self.stale_squares: self.refresh_attacks()
+        union = self.team_attacks[team]
+        if union < 0:
+            union = 0
+            attacks = self.attacks
+            for i in self.team_indices[team]: union |= attacks[i]
+            self.team_attacks[team] = union
+        return union
+
+
+    def attack_count(self, sq, team):
+        """Number of pieces of the team (0 whites, 1 blacks) attacking the square index"""
+        if self.changed_squares or self.stale_squares: self.refresh_attacks()
+        attacks = self.attacks
+        return sum((attacks[i] >> sq) & 1 for i in self.team_indices[team])
     
 
     def is_in_boundaries(self, coord):
@@ -395,9 +1150,12 @@ class Board:
 
     def kill_at(self, coord):
         """The given coordinate must be inside the table"""
-        elem = self.table[coord.tup()]
-        self.table[coord.tup()] = None
-        elem.kill()
+        self.kill_square(coord.y * self.size.x + coord.x)
+
+
+    def kill_square(self, sq):
+        """Fast path of kill_at using a square index"""
+        self.remove_square(sq).kill()
     
 
     def to_string(self):
@@ -409,7 +1167,7 @@ class Board:
         for e in self.pieces:
             if not e.is_alive == True:
                 sd += e.piece_type + '|'
-        s = '  1 2 3 4 5 6 7 8\n'
+        s = '  ' + ' '.join(str(y + 1) for y in range(self.size.y)) + '\n'
         for y in range(self.table.shape[0]):
             s += chr(ord('A')+y) + " "
             for x in range(self.table.shape[1]):
@@ -426,6 +1184,235 @@ class Board:
         return ''.join(s) + sd + "]"
     
     
+    def to_planes(self, dtype=np.uint8, out=None):
+        """
+        Returns the position as a dense array of shape (NUM_PLANES, height, width), where [c, y, x] is the square (x, y).
+        The piece, turn, castling and "en passant" planes are 0 or 1, the move counters hold their value
+        (limited to 255 with uint8).
+
+        out can be a preallocated array (e.g. batch[i] of a batch buffer) to write the planes into it without allocations.
+        """
+        g = self.geometry
+        if out is None: out = np.zeros((NUM_PLANES, g.height, g.width), dtype=dtype)
+        nbytes = (g.num_squares + 7) // 8
+        raw = b''.join((self.piece_bb[t] & self.team_bb[team]).to_bytes(nbytes, 'little')
+            for team in (0, 1) for t in bitboard.PIECE_TYPES)
+        bits = np.unpackbits(np.frombuffer(raw, dtype=np.uint8), bitorder='little').reshape(PIECE_PLANES, nbytes * 8)
+        out[:PIECE_PLANES] = bits[:, :g.num_squares].reshape(PIECE_PLANES, g.height, g.width)
+
+        out[PLANE_TURN] = self.playing == 'W'
+        for i in range(4):
+            out[PLANE_CASTLING + i] = (self.castling >> i) & 1
+        out[PLANE_EP] = 0
+        if self.ep_square >= 0:
+            x, y = g.coords[self.ep_square]
+            out[PLANE_EP, y, x] = 1
+        limit = 255 if out.dtype == np.uint8 else None
+        out[PLANE_HALFMOVES] = self.halfmove_clock if limit is None else min(self.halfmove_clock, limit)
+        fullmoves = self.turn // 2 + 1
+        out[PLANE_FULLMOVES] = fullmoves if limit is None else min(fullmoves, limit)
+        return out
+
+
+    @staticmethod
+    def from_planes(planes, silent=True):
+        """
+        Builds a board from the array given by to_planes().
+        The pieces are listed in the same order as starting_pieces(): kings, queens, bishops, knights, towers and pawns.
+        """
+        planes = np.asarray(planes)
+        height, width = planes.shape[1:]
+        flat = planes[:PIECE_PLANES].reshape(PIECE_PLANES, width * height) != 0
+        placed = []
+        for team in (0, 1):
+            for i, t in enumerate(bitboard.PIECE_TYPES):
+                for sq in np.flatnonzero(flat[team * 6 + i]):
+                    placed.append((int(sq) % width, int(sq) // width, t, team == 0))
+
+        castling = 0
+        for i in range(4):
+            if planes[PLANE_CASTLING + i].any(): castling |= 1 << i
+        ep = np.flatnonzero(planes[PLANE_EP])
+        blacks_turn = not planes[PLANE_TURN].any()
+        turn = 2 * (int(planes[PLANE_FULLMOVES].flat[0]) - 1) + blacks_turn
+        return Board.from_position(width, height, placed, turn, castling, int(ep[0]) if len(ep) else -1,
+            int(planes[PLANE_HALFMOVES].flat[0]), silent)
+
+
+    @staticmethod
+    def from_position(width, height, placed, turn=0, castling=0, ep_square=-1, halfmove_clock=0, silent=True, layout=None):
+        """
+        Builds a board from a description of the position.
+        placed is a list of (x, y, piece_type, is_whites), the pieces are listed in the same order as starting_pieces():
+        kings, queens, bishops, knights, towers and pawns.
+        The rules are the ones of the layout, by default the one of the size (see DEFAULT_LAYOUTS).
+        """
+        pcs = ordered_pieces(placed)
+        for p in pcs:
+            # Only the kings and towers that can still castle count as not moved
+            if p.piece_type == 'K': p.first_move = bool(castling & (3 << 2 * p.team))
+            elif p.piece_type == 'T':
+                right = (1 if p.pos.x == width - 1 else 2 if p.pos.x == 0 else 0) << 2 * p.team
+                p.first_move = bool(castling & right)
+
+        b = Board(width, height, pcs, silent, layout=layout)
+        # Only the rights of the kings and towers that are really there (see setup_castling) are kept
+        b.set_castling(castling & b.castling)
+        b.ep_square = ep_square
+        b.halfmove_clock = halfmove_clock
+        b.set_turn(turn)
+        return b
+
+
+    @staticmethod
+    def from_fen(fen, silent=True, layout=None):
+        """
+        Builds a board from a position in FEN notation, e.g. the starting position:
+        'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+        The size of the board is taken from the rows, so other sizes can be used too (see from_position for the rules).
+        """
+        fields = fen.split()
+        if len(fields) < 2: raise ValueError("Invalid FEN: " + fen)
+        width, height, placed = parse_placement(fields[0])
+
+        castling = 0
+        for letter in (fields[2] if len(fields) > 2 else '-'):
+            if letter in 'KQkq': castling |= {'K':1, 'Q':2, 'k':4, 'q':8}[letter]
+        ep_square = -1
+        if len(fields) > 3 and fields[3] != '-':
+            ep_square = (int(fields[3][1:]) - 1) * width + ord(fields[3][0]) - ord('a')
+        halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        fullmoves = int(fields[5]) if len(fields) > 5 else 1
+        turn = 2 * (fullmoves - 1) + (fields[1] == 'b')
+        return Board.from_position(width, height, placed, turn, castling, ep_square, halfmove_clock, silent, layout)
+
+
+    def to_fen(self):
+        """Position in FEN notation (see from_fen)"""
+        g = self.geometry
+        rows = []
+        for y in range(g.height - 1, -1, -1):
+            row = ''
+            empty = 0
+            for x in range(g.width):
+                ind = self.squares[g.square(x, y)]
+                if ind < 0:
+                    empty += 1
+                    continue
+                if empty: row += str(empty)
+                empty = 0
+                p = self.piece_list[ind]
+                letter = SAN_LETTERS[p.piece_type] or 'P'
+                row += letter if p.team == 0 else letter.lower()
+            if empty: row += str(empty)
+            rows.append(row)
+        castling = ''.join(letter for i, letter in enumerate('KQkq') if self.castling & (1 << i)) or '-'
+        ep = self.square_name(self.ep_square) if self.ep_square >= 0 else '-'
+        return '/'.join(rows) + ' ' + ('w' if self.playing == 'W' else 'b') + ' ' + castling + ' ' + ep + ' ' \
+            + str(self.halfmove_clock) + ' ' + str(self.turn // 2 + 1)
+
+
+    def pack(self):
+        """
+        Returns the position in PACKED_SIZE (32) bytes, see PACK_FORMAT.
+        Boards of up to 64 squares with up to 32 pieces can be packed.
+        """
+        g = self.geometry
+        occupied = self.team_bb[0] | self.team_bb[1]
+        if g.num_squares > 64: raise ValueError("Only boards of up to 64 squares can be packed")
+        codes = 0
+        shift = 0
+        for sq in bitboard.iter_bits(occupied):
+            p = self.piece_list[self.squares[sq]]
+            codes |= (p.team << 3 | bitboard.PIECE_TYPES.index(p.piece_type)) << shift
+            shift += 4
+        if shift > 128: raise ValueError("Only positions with up to 32 pieces can be packed")
+        return struct.pack(PACK_FORMAT, occupied, codes.to_bytes(16, 'little'), self.castling,
+            self.ep_square if self.ep_square >= 0 else 255, min(self.halfmove_clock, 0xFFFF), self.turn)
+
+
+    @staticmethod
+    def unpack(data, width=8, height=8, silent=True):
+        """Builds a board from the bytes given by pack() (or a record of a dataset, see dataset.py)"""
+        occupied, codes, castling, ep_square, halfmove_clock, turn = struct.unpack(PACK_FORMAT, bytes(data))
+        codes = int.from_bytes(codes, 'little')
+        placed = []
+        for sq in bitboard.iter_bits(occupied):
+            code = codes & 0xF
+            codes >>= 4
+            placed.append((sq % width, sq // width, bitboard.PIECE_TYPES[code & 7], code >> 3 == 0))
+        return Board.from_position(width, height, placed, turn, castling, -1 if ep_square == 255 else ep_square,
+            halfmove_clock, silent)
+
+
+    def perft(self, depth):
+        """Number of positions reached playing all the legal moves up to the given depth (move generation test)"""
+        if depth <= 0: return 1
+        moves = self.legal_move_list()
+        if depth == 1: return len(moves)
+        nodes = 0
+        for move in moves:
+            self.push(move)
+            nodes += self.perft(depth - 1)
+            self.pop()
+        return nodes
+
+
+    def divide(self, depth):
+        """Like perft, but returns a dictionary with the positions reached after each legal move (in coordinates notation)"""
+        result = {}
+        for move in self.legal_move_list():
+            self.push(move)
+            result[self.move_to_uci(move)] = self.perft(depth - 1)
+            self.pop()
+        return result
+
+
+    def set_turn(self, turn):
+        """Sets the turn number (plies played), updating the team on turn"""
+        self.turn = turn
+        self.playing = 'W' if turn % 2 == 0 else 'B'
+        self.forward.y = 1 if turn % 2 == 0 else -1
+        self.key = self.compute_key()
+
+
+    def enable_profiling(self, methods=PROFILED_METHODS, profiler=None):
+        """
+        Starts counting the calls and the cumulative time of the given methods, see stats().
+        A profiler can be given to share the counters between several boards.
+        """
+        if self.profiler is None: self.profiler = profiler if profiler is not None else instrument.Profiler()
+        self.profiler.attach(self, methods)
+
+
+    def disable_profiling(self):
+        if self.profiler is not None:
+            self.profiler.detach(self, list(self.profiler.calls))
+            self.profiler = None
+
+
+    def __getstate__(self):
+        # The profiling wrappers are bound to this board, the copies get their own ones in __setstate__
+        state = dict(vars(self))
+        if self.profiler is not None:
+            for name in self.profiler.calls: state.pop(name, None)
+        return state
+
+
+    def __setstate__(self, state):
+        vars(self).update(state)
+        if self.profiler is not None: self.profiler.attach(self, list(self.profiler.calls))
+
+
+    def stats(self):
+        """
+        Returns a snapshot of the profiled methods: for each one the calls, the total seconds and the mean microseconds.
+        It's empty if the profiling isn't enabled (see enable_profiling or the CHESSAI_PROFILE environment variable).
+        """
+        if self.profiler is None: return {}
+        return self.profiler.snapshot()
+
+
     def get_table(self):
         return self.table
     
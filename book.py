@@ -0,0 +1,172 @@
+"""
+Opening book built from the games of PGN files.
+
+Every move played in the first plies of the games is counted by position (its zobrist key, Board.key)
+with the results for the team that played it. The book is saved sorted by key, so it's read through
+numpy.memmap and the moves of a position are found with a binary search without loading the file.
+
+Usage: python book.py games.pgn.bz2 book.bin [--plies 20] [--min-games 2] [-p processes]
+"""
+import board
+import pgn
+
+import collections
+import multiprocessing
+import os
+import struct
+import time
+
+import numpy as np
+
+
+MAGIC = b'CHESSBK1'
+HEADER_FORMAT = '<8sQ'      # Magic and number of entries
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# The keys are saved apart (before the entries) so the binary search reads a contiguous array
+ENTRY_DTYPE = np.dtype([('move', '<u4'), ('games', '<u4'), ('wins', '<u4'), ('draws', '<u4'), ('losses', '<u4')])
+
+
+def count_moves(texts, max_plies=20):
+    """
+    Counts the moves of the first plies of the games (PGN texts). Returns a dictionary
+    {(key, move): [games, wins, draws, losses]} with the results for the team that moved, and the games read.
+    The games with moves that can't be done are skipped.
+    """
+    counts = {}
+    games = 0
+    for text in texts:
+        game = pgn.parse_game(text)
+        if game.result not in ('1-0', '0-1', '1/2-1/2'): continue
+        white_result = {'1-0': 1, '0-1': -1, '1/2-1/2': 0}[game.result]
+        b = board.Board(silent=True)
+        seen = []
+        try:
+            for san in game.moves[:max_plies]:
+                move = b.parse_san(san)
+                seen.append((b.key, move, white_result if b.playing == 'W' else -white_result))
+                b.push(move)
+        except ValueError:
+            continue
+        games += 1
+        for key, move, result in seen:
+            entry = counts.get((key, move))
+            if entry is None: entry = counts[(key, move)] = [0, 0, 0, 0]
+            entry[0] += 1
+            entry[2 - result] += 1
+    return counts, games
+
+
+def build(path, output, max_plies=20, min_games=1, processes=None, chunk_size=256):
+    """
+    Builds the book of the games of a PGN file (see pgn.py, plain, .gz or .bz2) and saves it to output.
+    Only the moves played in at least min_games games are kept.
+    Returns a dictionary with the games read, the entries saved and the seconds.
+    """
+    start = time.perf_counter()
+    totals = {}
+    games = 0
+
+    def add(result):
+        nonlocal games
+        counts, read = result
+        games += read
+        for key, values in counts.items():
+            entry = totals.get(key)
+            if entry is None: totals[key] = values
+            else:
+                for i in range(4): entry[i] += values[i]
+
+    chunks = pgn.chunked(pgn.iter_game_texts(path), chunk_size)
+    if processes == 1:
+        for chunk in chunks: add(count_moves(chunk, max_plies))
+    else:
+        processes = processes or os.cpu_count() or 1
+        with multiprocessing.Pool(processes) as pool:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(count_moves, (chunk, max_plies)))
+                while len(pending) >= 2 * processes: add(pending.popleft().get())
+            while pending: add(pending.popleft().get())
+
+    entries = [(key, move, values) for (key, move), values in totals.items() if values[0] >= min_games]
+    write(output, entries)
+    return {'games': games, 'entries': len(entries), 'seconds': time.perf_counter() - start}
+
+
+def write(output, entries):
+    """Saves a list of (key, move, [games, wins, draws, losses]) sorted by key and then by games (descending)"""
+    keys = np.array([e[0] for e in entries], dtype='<u8')
+    data = np.zeros(len(entries), dtype=ENTRY_DTYPE)
+    if entries:
+        data['move'] = [e[1] for e in entries]
+        stats = np.array([e[2] for e in entries], dtype=np.uint32)
+        data['games'] = stats[:, 0]
+        data['wins'] = stats[:, 1]
+        data['draws'] = stats[:, 2]
+        data['losses'] = stats[:, 3]
+    order = np.lexsort((-data['games'].astype(np.int64), keys))
+    with open(output, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, len(entries)))
+        f.write(keys[order].tobytes())
+        f.write(data[order].tobytes())
+
+
+class Book:
+    """Opening book file opened with numpy.memmap. Only the pages touched by the lookups are read."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, count = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+        if magic != MAGIC: raise ValueError("Not an opening book file: " + path)
+        self.size = count
+        if count:
+            self.keys = np.memmap(path, dtype='<u8', mode='r', offset=HEADER_SIZE, shape=(count,))
+            self.entries = np.memmap(path, dtype=ENTRY_DTYPE, mode='r', offset=HEADER_SIZE + 8 * count, shape=(count,))
+        else:
+            self.keys = np.zeros(0, dtype='<u8')
+            self.entries = np.zeros(0, dtype=ENTRY_DTYPE)
+
+
+    def __len__(self):
+        return self.size
+
+
+    def lookup(self, b):
+        """
+        Book moves of the position of the board, most played first: a list of (move, games, wins, draws, losses)
+        with the results for the team on turn. Moves that aren't legal in the board (key collisions) are left out.
+        """
+        key = np.uint64(b.key)
+        first = int(np.searchsorted(self.keys, key, 'left'))
+        last = int(np.searchsorted(self.keys, key, 'right'))
+        if first == last: return []
+        legal = set(b.legal_moves())
+        return [tuple(int(v) for v in entry) for entry in self.entries[first:last] if int(entry['move']) in legal]
+
+
+    def sample(self, b, rng=None, temperature=1.0):
+        """
+        Random book move of the position, chosen with probability proportional to games ** (1 / temperature)
+        (temperature 0 gives the most played move). Returns None if the position isn't in the book.
+        """
+        moves = self.lookup(b)
+        if not moves: return None
+        if temperature == 0: return moves[0][0]
+        rng = np.random.default_rng() if rng is None else rng
+        weights = np.array([m[1] for m in moves], dtype=np.float64) ** (1.0 / temperature)
+        return moves[rng.choice(len(moves), p=weights / weights.sum())][0]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Builds an opening book from the games of a PGN file")
+    parser.add_argument('path')
+    parser.add_argument('output')
+    parser.add_argument('--plies', type=int, default=20, help="Plies of every game added to the book")
+    parser.add_argument('--min-games', type=int, default=1, help="Games a move must appear in to be kept")
+    parser.add_argument('-p', '--processes', type=int, default=None, help="Worker processes (all the cores by default)")
+    args = parser.parse_args()
+
+    stats = build(args.path, args.output, args.plies, args.min_games, args.processes)
+    print("%d games, %d entries in %.1fs" % (stats['games'], stats['entries'], stats['seconds']))
@@ -0,0 +1,196 @@
+"""
+Files of training positions: packed positions (see Board.pack) with their labels, read through numpy.memmap.
+
+The file starts with a header of HEADER_SIZE bytes: the magic bytes, the format version and a JSON description
+(board size, number of records and the numpy dtype of the labels), followed by fixed size records.
+Reading a file doesn't load it: the records are a memory mapped array, so any position can be accessed directly
+and batches of random positions can be decoded into planes for training.
+
+    with dataset.DatasetWriter('positions.bin') as writer:
+        writer.add(board_object, value=0.5)
+    reader = dataset.DatasetReader('positions.bin')
+    planes, labels = reader.batch(np.random.randint(len(reader), size=256))
+"""
+import board
+import bitboard
+
+import json
+import struct
+
+import numpy as np
+
+
+MAGIC = b'CHESSPOS'
+VERSION = 1
+HEADER_SIZE = 512
+
+# The fields of Board.pack as a numpy dtype, 32 bytes
+POSITION_DTYPE = np.dtype([('occupancy', '<u8'), ('pieces', 'u1', 16), ('castling', 'u1'), ('ep_square', 'u1'),
+    ('halfmove_clock', '<u2'), ('turn', '<u4')])
+# Default labels: the result of the game for the team on turn, a value and the move played (encoded)
+LABEL_DTYPE = np.dtype([('result', 'i1'), ('value', '<f4'), ('move', '<i4')])
+
+
+def record_dtype(label_dtype):
+    return np.dtype([('position', POSITION_DTYPE), ('label', label_dtype)])
+
+
+def read_header(f):
+    """Returns the description of the file (a dictionary) from its header"""
+    header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a positions dataset file")
+    version, length = struct.unpack('<II', header[len(MAGIC):len(MAGIC) + 8])
+    if version != VERSION: raise ValueError("Unsupported dataset version: " + str(version))
+    start = len(MAGIC) + 8
+    return json.loads(header[start:start + length].decode())
+
+
+def write_header(f, info):
+    text = json.dumps(info).encode()
+    header = MAGIC + struct.pack('<II', VERSION, len(text)) + text
+    if len(header) > HEADER_SIZE: raise ValueError("The description of the dataset doesn't fit in the header")
+    f.seek(0)
+    f.write(header.ljust(HEADER_SIZE, b'\0'))
+
+
+class DatasetWriter:
+    """
+    Writes positions with labels to a file. The records are buffered and written in blocks,
+    the number of records is saved in the header when the writer is closed.
+
+    label_dtype is the numpy dtype of the labels (LABEL_DTYPE by default), any structured dtype can be used.
+    """
+    def __init__(self, path, width=8, height=8, label_dtype=LABEL_DTYPE, buffer_size=4096):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.label_dtype = np.dtype(label_dtype)
+        self.dtype = record_dtype(self.label_dtype)
+        self.buffer = np.zeros(buffer_size, dtype=self.dtype)
+        self.buffered = 0
+        self.count = 0
+        self.file = open(path, 'wb')
+        write_header(self.file, self.info())
+
+
+    def info(self):
+        return {'width': self.width, 'height': self.height, 'count': self.count,
+            'label_dtype': self.label_dtype.descr}
+
+
+    def add(self, b, **labels):
+        """Adds the position of the board with the labels given by name (the missing ones are 0)"""
+        self.add_packed(b.pack(), **labels)
+
+
+    def add_packed(self, packed, **labels):
+        record = self.buffer[self.buffered]
+        record['position'] = np.frombuffer(packed, dtype=POSITION_DTYPE)[0]
+        record['label'] = 0
+        for name, value in labels.items(): record['label'][name] = value
+        self.buffered += 1
+        if self.buffered == len(self.buffer): self.flush()
+
+
+    def flush(self):
+        self.file.write(self.buffer[:self.buffered].tobytes())
+        self.count += self.buffered
+        self.buffered = 0
+
+
+    def close(self):
+        if self.file is None: return
+        self.flush()
+        write_header(self.file, self.info())
+        self.file.close()
+        self.file = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DatasetReader:
+    """
+    Memory mapped view of a dataset file. records is a numpy array of the records (fields 'position' and 'label'),
+    read from the disk only when they are accessed.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f: info = read_header(f)
+        self.width = info['width']
+        self.height = info['height']
+        self.label_dtype = np.dtype([tuple(field) for field in info['label_dtype']])
+        self.dtype = record_dtype(self.label_dtype)
+        self.records = np.memmap(path, dtype=self.dtype, mode='r', offset=HEADER_SIZE, shape=(info['count'],)) \
+            if info['count'] else np.zeros(0, dtype=self.dtype)
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def board(self, i, silent=True):
+        """Board of the record i"""
+        return board.Board.unpack(self.records[i]['position'].tobytes(), self.width, self.height, silent)
+
+
+    def labels(self, indices):
+        return self.records['label'][indices]
+
+
+    def planes(self, indices, dtype=np.float32, out=None):
+        """Planes of the positions of the records (see Board.to_planes), decoded together with numpy"""
+        return decode_planes(self.records['position'][indices], self.width, self.height, dtype, out)
+
+
+    def batch(self, indices, dtype=np.float32):
+        """Planes and labels of the records, e.g. a random batch for training"""
+        indices = np.asarray(indices)
+        return self.planes(indices, dtype), self.labels(indices)
+
+
+def decode_planes(positions, width=8, height=8, dtype=np.float32, out=None):
+    """
+    Planes (n, NUM_PLANES, height, width) of an array of packed positions (POSITION_DTYPE),
+    the same ones given by Board.to_planes.
+    """
+    positions = np.asarray(positions, dtype=POSITION_DTYPE)
+    n = len(positions)
+    num_squares = width * height
+    if out is None: out = np.zeros((n, board.NUM_PLANES, height, width), dtype=dtype)
+    else: out[:] = 0
+
+    occupancy = positions['occupancy'].astype('<u8').view(np.uint8).reshape(n, 8)
+    bits = np.unpackbits(occupancy, axis=1, bitorder='little')[:, :num_squares].astype(bool)
+    # Nibble i is the piece of the i-th occupied square
+    nibbles = np.empty((n, 32), dtype=np.uint8)
+    nibbles[:, 0::2] = positions['pieces'] & 0xF
+    nibbles[:, 1::2] = positions['pieces'] >> 4
+    rows, squares = np.nonzero(bits)
+    ranks = np.cumsum(bits, axis=1)[rows, squares] - 1
+    codes = nibbles[rows, ranks]
+    planes = (codes >> 3) * len(bitboard.PIECE_TYPES) + (codes & 7)
+    out[rows, planes, squares // width, squares % width] = 1
+
+    turn = positions['turn'].astype(np.int64)
+    out[:, board.PLANE_TURN] = (turn % 2 == 0)[:, None, None]
+    for i in range(4):
+        out[:, board.PLANE_CASTLING + i] = ((positions['castling'] >> i) & 1)[:, None, None]
+    ep = positions['ep_square'].astype(np.int64)
+    has_ep = np.flatnonzero(ep != 255)
+    out[has_ep, board.PLANE_EP, ep[has_ep] // width, ep[has_ep] % width] = 1
+    limit = 255 if out.dtype == np.uint8 else None
+    halfmoves = positions['halfmove_clock'].astype(np.int64)
+    fullmoves = turn // 2 + 1
+    if limit is not None:
+        halfmoves = np.minimum(halfmoves, limit)
+        fullmoves = np.minimum(fullmoves, limit)
+    out[:, board.PLANE_HALFMOVES] = halfmoves[:, None, None]
+    out[:, board.PLANE_FULLMOVES] = fullmoves[:, None, None]
+    return out
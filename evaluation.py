@@ -0,0 +1,192 @@
+"""
+Static evaluation of positions: material and piece-square tables, blended by the game phase.
+
+Every piece adds a middlegame and an endgame value that depend on its square. The board keeps the sum of them
+updated on every change (see Board.set_evaluator), so evaluate() costs the same in any position.
+evaluate_planes() scores a whole batch of positions given as planes (see Board.to_planes) with numpy.
+"""
+import board
+import bitboard
+
+import numpy as np
+
+
+MIDDLEGAME_VALUES = {'P':100, 'H':320, 'B':330, 'T':500, 'Q':900, 'K':0}
+ENDGAME_VALUES = {'P':120, 'H':300, 'B':330, 'T':520, 'Q':920, 'K':0}
+
+# Weight of the pieces in the game phase, all of them together is the middlegame
+PHASE_WEIGHTS = {'P':0, 'H':1, 'B':1, 'T':2, 'Q':4, 'K':0}
+
+# Piece-square tables for the whites, written as the board is seen: the first row is the 8th rank
+PAWN_TABLE = (
+    (  0,  0,  0,  0,  0,  0,  0,  0),
+    ( 50, 50, 50, 50, 50, 50, 50, 50),
+    ( 10, 10, 20, 30, 30, 20, 10, 10),
+    (  5,  5, 10, 25, 25, 10,  5,  5),
+    (  0,  0,  0, 20, 20,  0,  0,  0),
+    (  5, -5,-10,  0,  0,-10, -5,  5),
+    (  5, 10, 10,-20,-20, 10, 10,  5),
+    (  0,  0,  0,  0,  0,  0,  0,  0))
+KNIGHT_TABLE = (
+    (-50,-40,-30,-30,-30,-30,-40,-50),
+    (-40,-20,  0,  0,  0,  0,-20,-40),
+    (-30,  0, 10, 15, 15, 10,  0,-30),
+    (-30,  5, 15, 20, 20, 15,  5,-30),
+    (-30,  0, 15, 20, 20, 15,  0,-30),
+    (-30,  5, 10, 15, 15, 10,  5,-30),
+    (-40,-20,  0,  5,  5,  0,-20,-40),
+    (-50,-40,-30,-30,-30,-30,-40,-50))
+BISHOP_TABLE = (
+    (-20,-10,-10,-10,-10,-10,-10,-20),
+    (-10,  0,  0,  0,  0,  0,  0,-10),
+    (-10,  0,  5, 10, 10,  5,  0,-10),
+    (-10,  5,  5, 10, 10,  5,  5,-10),
+    (-10,  0, 10, 10, 10, 10,  0,-10),
+    (-10, 10, 10, 10, 10, 10, 10,-10),
+    (-10,  5,  0,  0,  0,  0,  5,-10),
+    (-20,-10,-10,-10,-10,-10,-10,-20))
+TOWER_TABLE = (
+    (  0,  0,  0,  0,  0,  0,  0,  0),
+    (  5, 10, 10, 10, 10, 10, 10,  5),
+    ( -5,  0,  0,  0,  0,  0,  0, -5),
+    ( -5,  0,  0,  0,  0,  0,  0, -5),
+    ( -5,  0,  0,  0,  0,  0,  0, -5),
+    ( -5,  0,  0,  0,  0,  0,  0, -5),
+    ( -5,  0,  0,  0,  0,  0,  0, -5),
+    (  0,  0,  0,  5,  5,  0,  0,  0))
+QUEEN_TABLE = (
+    (-20,-10,-10, -5, -5,-10,-10,-20),
+    (-10,  0,  0,  0,  0,  0,  0,-10),
+    (-10,  0,  5,  5,  5,  5,  0,-10),
+    ( -5,  0,  5,  5,  5,  5,  0, -5),
+    (  0,  0,  5,  5,  5,  5,  0, -5),
+    (-10,  5,  5,  5,  5,  5,  0,-10),
+    (-10,  0,  5,  0,  0,  0,  0,-10),
+    (-20,-10,-10, -5, -5,-10,-10,-20))
+KING_MIDDLEGAME_TABLE = (
+    (-30,-40,-40,-50,-50,-40,-40,-30),
+    (-30,-40,-40,-50,-50,-40,-40,-30),
+    (-30,-40,-40,-50,-50,-40,-40,-30),
+    (-30,-40,-40,-50,-50,-40,-40,-30),
+    (-20,-30,-30,-40,-40,-30,-30,-20),
+    (-10,-20,-20,-20,-20,-20,-20,-10),
+    ( 20, 20,  0,  0,  0,  0, 20, 20),
+    ( 20, 30, 10,  0,  0, 10, 30, 20))
+KING_ENDGAME_TABLE = (
+    (-50,-40,-30,-20,-20,-30,-40,-50),
+    (-30,-20,-10,  0,  0,-10,-20,-30),
+    (-30,-10, 20, 30, 30, 20,-10,-30),
+    (-30,-10, 30, 40, 40, 30,-10,-30),
+    (-30,-10, 30, 40, 40, 30,-10,-30),
+    (-30,-10, 20, 30, 30, 20,-10,-30),
+    (-30,-30,  0,  0,  0,  0,-30,-30),
+    (-50,-30,-30,-30,-30,-30,-30,-50))
+
+MIDDLEGAME_TABLES = {'P':PAWN_TABLE, 'H':KNIGHT_TABLE, 'B':BISHOP_TABLE, 'T':TOWER_TABLE, 'Q':QUEEN_TABLE,
+    'K':KING_MIDDLEGAME_TABLE}
+ENDGAME_TABLES = dict(MIDDLEGAME_TABLES, K=KING_ENDGAME_TABLE)
+
+# The middlegame and endgame values are added together as mg + eg * 2**32 (the endgame sum never gets near 2**31)
+PACK_SHIFT = 32
+
+
+def table_value(table, x, y, width, height):
+    """Value of the table for a white piece in (x, y). Tables of other sizes are scaled to the board."""
+    rows = len(table)
+    columns = len(table[0])
+    row = rows - 1 - (y * (rows - 1) * 2 + height - 1) // (2 * (height - 1)) if height > 1 else rows - 1
+    column = (x * (columns - 1) * 2 + width - 1) // (2 * (width - 1)) if width > 1 else 0
+    return table[row][column]
+
+
+class Evaluator:
+    """
+    Values of every piece type in every square for a board size.
+
+    values and tables are pairs (middlegame, endgame) of dictionaries by piece type: the material values
+    and the piece-square tables for the whites (the first row is the last rank, they are mirrored for the blacks).
+    phase_weights gives how much each piece type counts towards the middlegame.
+    """
+    def __init__(self, width=8, height=8, values=None, tables=None, phase_weights=None):
+        self.width = width
+        self.height = height
+        values = values or (MIDDLEGAME_VALUES, ENDGAME_VALUES)
+        tables = tables or (MIDDLEGAME_TABLES, ENDGAME_TABLES)
+        self.phase_weights = dict(phase_weights or PHASE_WEIGHTS)
+        # Phase of the starting material: 2 of every minor and tower and 1 queen per team
+        self.max_phase = max(1, 4 * (self.phase_weights['H'] + self.phase_weights['B'] + self.phase_weights['T'])
+            + 2 * self.phase_weights['Q'])
+
+        # psq[team][piece_type][square], packed middlegame and endgame values, negative for the blacks
+        self.psq = ({}, {})
+        # Same values as planes in the order of Board.to_planes, to evaluate batches
+        self.middlegame_planes = np.zeros((board.PIECE_PLANES, height, width), dtype=np.int64)
+        self.endgame_planes = np.zeros_like(self.middlegame_planes)
+        self.phase_planes = np.zeros(board.PIECE_PLANES, dtype=np.int64)
+        for team in (0, 1):
+            sign = 1 if team == 0 else -1
+            for i, piece_type in enumerate(bitboard.PIECE_TYPES):
+                plane = team * len(bitboard.PIECE_TYPES) + i
+                packed = []
+                for sq in range(width * height):
+                    x, y = sq % width, sq // width
+                    if team == 1: y = height - 1 - y    # Mirrored
+                    mg = values[0][piece_type] + table_value(tables[0][piece_type], x, y, width, height)
+                    eg = values[1][piece_type] + table_value(tables[1][piece_type], x, y, width, height)
+                    packed.append(sign * (mg + (eg << PACK_SHIFT)))
+                    self.middlegame_planes[plane, sq // width, x] = sign * mg
+                    self.endgame_planes[plane, sq // width, x] = sign * eg
+                self.psq[team][piece_type] = packed
+                self.phase_planes[plane] = self.phase_weights[piece_type]
+
+
+    def blend(self, packed, phase):
+        """Score for the whites of a packed middlegame and endgame sum in the given phase"""
+        eg = (packed + (1 << (PACK_SHIFT - 1))) >> PACK_SHIFT
+        mg = packed - (eg << PACK_SHIFT)
+        if phase > self.max_phase: phase = self.max_phase
+        return (mg * phase + eg * (self.max_phase - phase)) // self.max_phase
+
+
+    def evaluate_planes(self, planes):
+        """
+        Scores of a batch of positions given as planes of shape (n, NUM_PLANES, height, width),
+        for the team on turn in each one. They are the same as the ones of evaluate().
+        """
+        pieces = np.asarray(planes)[:, :board.PIECE_PLANES].astype(np.int64)
+        mg = np.einsum('nphw,phw->n', pieces, self.middlegame_planes)
+        eg = np.einsum('nphw,phw->n', pieces, self.endgame_planes)
+        phase = np.minimum(pieces.sum(axis=(2, 3)) @ self.phase_planes, self.max_phase)
+        scores = (mg * phase + eg * (self.max_phase - phase)) // self.max_phase
+        whites = np.asarray(planes)[:, board.PLANE_TURN, 0, 0] > 0
+        return np.where(whites, scores, -scores)
+
+
+_evaluators = {}
+
+def get_evaluator(width=8, height=8):
+    """Returns the shared default evaluator of a board size"""
+    evaluator = _evaluators.get((width, height))
+    if evaluator is None:
+        evaluator = Evaluator(width, height)
+        _evaluators[(width, height)] = evaluator
+    return evaluator
+
+
+def evaluate(b):
+    """
+    Score in centipawns of the board for the team on turn. The first call on a board attaches
+    the default evaluator of its size, after that the score is kept updated by the board.
+    """
+    evaluator = b.evaluator
+    if evaluator is None:
+        evaluator = get_evaluator(b.geometry.width, b.geometry.height)
+        b.set_evaluator(evaluator)
+    score = evaluator.blend(b.psq_score, b.phase)
+    return score if b.playing == 'W' else -score
+
+
+def evaluate_planes(planes):
+    """Scores of a batch of positions (planes of shape (n, NUM_PLANES, height, width)) with the default evaluator"""
+    planes = np.asarray(planes)
+    return get_evaluator(planes.shape[3], planes.shape[2]).evaluate_planes(planes)
@@ -21,7 +21,7 @@ print(game.to_string() + "\n")
 action = ""
 while action != "exit":
     print("Chose a move: ")
-    action = raw_input()
+    action = input()
     
     if action == "exit":
         continue
@@ -58,3 +58,5 @@ while action != "exit":
         continue
 
     print(game.to_string() + "\n")
+    if game.outcome() is not None:
+        break
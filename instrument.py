@@ -0,0 +1,99 @@
+"""
+Instrumentation of the board: debug logging and per method call counters and timers.
+
+Both are disabled by default and cost nothing then:
+- The debug messages are only built if set_debug() has been called (or CHESSAI_DEBUG is set).
+- The counters are only attached to the boards that enable them with Board.enable_profiling()
+  (or to every board if CHESSAI_PROFILE is set), the methods of other boards are not wrapped.
+"""
+import inspect
+import logging
+import os
+import time
+
+
+logger = logging.getLogger('chessai')
+debug = bool(os.environ.get('CHESSAI_DEBUG'))
+profile = bool(os.environ.get('CHESSAI_PROFILE'))
+
+
+def set_debug(enabled=True, level=logging.DEBUG):
+    """Enables or disables the debug messages of the rule checks, sent to the 'chessai' logger"""
+    global debug
+    debug = enabled
+    if enabled:
+        logger.setLevel(level)
+        if not logger.handlers and not logging.getLogger().handlers:
+            logging.basicConfig()
+
+
+class Profiler:
+    """
+    Counts the calls and the cumulative time of some methods of one or more objects.
+    The time of a method includes the time of the profiled methods it calls.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.seconds = {}
+
+
+    def attach(self, obj, names):
+        """Wraps the methods of the object, the wrappers are kept as instance attributes"""
+        for name in names:
+            if name in vars(obj): continue    # Already wrapped
+            self.calls.setdefault(name, 0)
+            self.seconds.setdefault(name, 0.0)
+            setattr(obj, name, self.wrap(getattr(obj, name), name))
+
+
+    def detach(self, obj, names):
+        for name in names:
+            if name in vars(obj): delattr(obj, name)
+
+
+    def wrap(self, method, name):
+        calls = self.calls
+        seconds = self.seconds
+        timer = time.perf_counter
+
+        if inspect.isgeneratorfunction(method):
+            # Calling a generator only creates it, the time is the one spent producing its values
+            def wrapper(*args, **kwargs):
+                calls[name] += 1
+                values = method(*args, **kwargs)
+                while True:
+                    start = timer()
+                    try:
+                        value = next(values)
+                    except StopIteration:
+                        return
+                    finally:
+                        seconds[name] += timer() - start
+                    yield value
+            wrapper.__doc__ = method.__doc__
+            return wrapper
+
+        def wrapper(*args, **kwargs):
+            start = timer()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                seconds[name] += timer() - start
+                calls[name] += 1
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+
+    def reset(self):
+        for name in self.calls:
+            self.calls[name] = 0
+            self.seconds[name] = 0.0
+
+
+    def snapshot(self):
+        """Dictionary with the calls, total seconds and mean microseconds per call of each method"""
+        return {name: {
+                'calls': calls,
+                'seconds': self.seconds[name],
+                'mean_us': self.seconds[name] / calls * 1e6 if calls else 0.0,
+            } for name, calls in self.calls.items()}
@@ -0,0 +1,361 @@
+"""
+Monte Carlo Tree Search for neural network agents (AlphaZero style).
+
+The leaves reached by several simulations are queued and evaluated together with one call of the model,
+virtual losses spread the simulations of a batch over different branches.
+The nodes are kept in numpy arrays (about 30 bytes per node) and the tree is reused between moves.
+
+The actions are the ones of batch.BoardBatch: from_square * num_squares + to_square,
+pawns reaching the last rank become queens.
+"""
+import board
+
+import math
+import time
+
+import numpy as np
+
+
+# Node states
+NEW = 0         # Not evaluated yet
+PENDING = 1     # Queued for evaluation in the current batch
+EXPANDED = 2    # Evaluated, its children are created
+TERMINAL = 3    # The game has finished in the node
+
+
+def uniform_evaluate(planes):
+    """Evaluation without a model: the same prior for all the actions and a value of 0"""
+    n, _, height, width = planes.shape
+    actions = (width * height) ** 2
+    return np.full((n, actions), 1.0 / actions, dtype=np.float32), np.zeros(n, dtype=np.float32)
+
+
+class MCTS:
+    """
+    Search tree with PUCT selection and batched leaf evaluation.
+
+    evaluate is called with an array of planes of shape (batch, NUM_PLANES, height, width) (see Board.to_planes)
+    and returns (policy, value): the policy of shape (batch, num_squares ** 2) with the prior of every action
+    (probabilities or non negative weights, the illegal actions are ignored) and the value of shape (batch,)
+    in [-1, 1] for the team on turn in each position.
+
+    batch_size is the number of leaves evaluated per call, virtual_loss the loss temporarily added to the nodes
+    of a selected path so the next simulations of the batch prefer other paths. Dirichlet noise is added to the
+    priors of the root if noise_fraction > 0 (for self play).
+    """
+    def __init__(self, evaluate=uniform_evaluate, batch_size=16, c_puct=1.5, virtual_loss=1.0,
+            dirichlet_alpha=0.3, noise_fraction=0.0, capacity=1 << 16, seed=None):
+        self.evaluate = evaluate
+        self.batch_size = batch_size
+        self.c_puct = c_puct
+        self.virtual_loss = virtual_loss
+        self.dirichlet_alpha = dirichlet_alpha
+        self.noise_fraction = noise_fraction
+        self.rng = np.random.default_rng(seed)
+
+        # Node arrays, the children of a node are contiguous from first_child
+        self.capacity = capacity
+        self.parent = np.zeros(capacity, dtype=np.int32)
+        self.move = np.zeros(capacity, dtype=np.int32)              # Move that leads to the node
+        self.first_child = np.zeros(capacity, dtype=np.int32)
+        self.num_children = np.zeros(capacity, dtype=np.int16)
+        self.state = np.zeros(capacity, dtype=np.int8)
+        self.prior = np.zeros(capacity, dtype=np.float32)
+        self.visits = np.zeros(capacity, dtype=np.float32)          # Virtual visits included
+        self.value_sum = np.zeros(capacity, dtype=np.float32)       # For the team that moved into the node
+        self.size = 0
+        self.root_key = None
+        self.planes = None
+        self.evaluations = 0
+        self.batches = 0
+        self.clear()
+
+
+    def clear(self):
+        """Removes all the nodes, the next search starts a new tree"""
+        self.size = 1
+        self.parent[0] = -1
+        self.move[0] = 0
+        self.num_children[0] = 0
+        self.state[0] = NEW
+        self.prior[0] = 1.0
+        self.visits[0] = 0
+        self.value_sum[0] = 0
+        self.root_key = None
+
+
+    def grow(self, needed):
+        """Makes room for at least needed nodes, doubling the capacity"""
+        capacity = self.capacity
+        while capacity < needed: capacity *= 2
+        if capacity == self.capacity: return
+        for name in ('parent', 'move', 'first_child', 'num_children', 'state', 'prior', 'visits', 'value_sum'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+
+    def nbytes(self):
+        """Memory used by the node arrays"""
+        return sum(getattr(self, name).nbytes for name in
+            ('parent', 'move', 'first_child', 'num_children', 'state', 'prior', 'visits', 'value_sum'))
+
+
+    def search(self, b, num_simulations=800):
+        """
+        Runs the simulations from the position of the board, reusing the tree of the previous searches
+        if the position comes from the root with the moves done since then (with push()).
+        The board is left as it was.
+
+        Returns a dictionary with the moves of the root and their visits, the most visited move,
+        the value of the root for the team on turn, and the simulations, nodes, evaluations and seconds.
+        """
+        start = time.perf_counter()
+        self.reuse(b)
+        self.root_key = b.key
+        if self.planes is None or self.planes.shape[2:] != (b.geometry.height, b.geometry.width) \
+                or len(self.planes) < self.batch_size:
+            self.planes = np.zeros((self.batch_size, board.NUM_PLANES, b.geometry.height, b.geometry.width), dtype=np.float32)
+
+        if self.state[0] != EXPANDED:
+            pending = []
+            self.queue_leaf(b, [0], pending, set())
+            if pending: self.evaluate_leaves(pending, b)
+        if self.state[0] == EXPANDED and self.noise_fraction > 0: self.add_noise(0)
+
+        simulations = 0
+        while simulations < num_simulations and self.state[0] == EXPANDED:
+            pending = []
+            queued = set()
+            collisions = 0
+            while len(pending) < self.batch_size and simulations < num_simulations:
+                path = self.select(b)
+                leaf = path[-1]
+                if leaf in queued:
+                    # Another simulation of the batch is waiting for the same leaf
+                    self.remove_virtual_loss(path)
+                    collisions += 1
+                else:
+                    value = self.queue_leaf(b, path, pending, queued)
+                    if value is not None: self.backup(path, value)
+                    simulations += 1
+                for _ in range(len(path) - 1): b.pop()
+                if collisions > self.batch_size: break
+            if pending: self.evaluate_leaves(pending, b)
+
+        children = self.children(0)
+        visits = self.visits[children] if len(children) else np.zeros(0, dtype=np.float32)
+        moves = self.move[children]
+        seconds = time.perf_counter() - start
+        return {
+            'move': int(moves[visits.argmax()]) if len(moves) else 0,
+            'moves': moves.copy(),
+            'visits': visits.astype(np.int32),
+            'value': float(-self.value_sum[0] / self.visits[0]) if self.visits[0] else 0.0,
+            'simulations': simulations,
+            'nodes': self.size,
+            'evaluations': self.evaluations,
+            'seconds': seconds,
+            'simulations_per_sec': simulations / seconds if seconds > 0 else 0.0,
+        }
+
+
+    def children(self, node):
+        first = self.first_child[node]
+        return np.arange(first, first + self.num_children[node])
+
+
+    def select(self, b):
+        """Follows the PUCT scores from the root to a leaf, doing the moves in the board and adding virtual losses"""
+        visits = self.visits
+        value_sum = self.value_sum
+        node = 0
+        path = [0]
+        while self.state[node] == EXPANDED:
+            first = self.first_child[node]
+            last = first + self.num_children[node]
+            child_visits = visits[first:last]
+            q = np.divide(value_sum[first:last], child_visits, out=np.zeros(last - first, dtype=np.float32),
+                where=child_visits > 0)
+            u = self.c_puct * math.sqrt(max(visits[node], 1.0)) * self.prior[first:last] / (1.0 + child_visits)
+            node = first + int((q + u).argmax())
+            b.push(int(self.move[node]))
+            path.append(node)
+        path_array = np.array(path)
+        visits[path_array] += self.virtual_loss
+        value_sum[path_array[1:]] -= self.virtual_loss
+        return path
+
+
+    def remove_virtual_loss(self, path):
+        path = np.array(path)
+        self.visits[path] -= self.virtual_loss
+        self.value_sum[path[1:]] += self.virtual_loss
+
+
+    def backup(self, path, value):
+        """
+        Adds the value of the leaf (for the team on turn in the leaf) to the nodes of the path,
+        alternating the sign as the teams alternate, and removes the virtual losses.
+        """
+        path = np.array(path)
+        signs = np.where(np.arange(len(path))[::-1] % 2 == 0, -1.0, 1.0).astype(np.float32)
+        self.visits[path] += 1.0 - self.virtual_loss
+        self.value_sum[path[1:]] += signs[1:] * value + self.virtual_loss
+        self.value_sum[0] += signs[0] * value
+
+
+    def queue_leaf(self, b, path, pending, queued):
+        """
+        Checks if the game has finished in the leaf (the board is in its position). Returns its value for the team
+        on turn if it has, otherwise writes its planes in the batch, adds it to pending and returns None.
+        """
+        leaf = path[-1]
+        result = b.outcome()
+        if result is not None:
+            self.state[leaf] = TERMINAL
+            return float(result[0] if b.playing == 'W' else -result[0])
+        moves = b.legal_move_array()
+        moves = moves[((moves >> 16) == 0) | ((moves >> 16) == board.PROMOTION_CODES['Q'])]
+        b.to_planes(dtype=np.float32, out=self.planes[len(pending)])
+        self.state[leaf] = PENDING
+        pending.append((path, moves))
+        queued.add(leaf)
+        return None
+
+
+    def evaluate_leaves(self, pending, b):
+        """Evaluates the queued leaves with one call of the model, expands them and backs up their values"""
+        policy, value = self.evaluate(self.planes[:len(pending)])
+        policy = np.asarray(policy, dtype=np.float32).reshape(len(pending), -1)
+        value = np.asarray(value, dtype=np.float32).reshape(-1)
+        self.evaluations += len(pending)
+        self.batches += 1
+        n = b.geometry.num_squares
+        for i, (path, moves) in enumerate(pending):
+            leaf = path[-1]
+            actions = (moves & 0xFF) * n + ((moves >> 8) & 0xFF)
+            priors = policy[i, actions]
+            total = priors.sum()
+            priors = priors / total if total > 0 else np.full(len(moves), 1.0 / len(moves), dtype=np.float32)
+            self.expand(leaf, moves, priors)
+            if len(path) == 1:
+                # The root is evaluated alone, without virtual loss
+                self.visits[0] += 1
+                self.value_sum[0] -= value[i]
+            else: self.backup(path, float(value[i]))
+
+
+    def expand(self, node, moves, priors):
+        count = len(moves)
+        if self.size + count > self.capacity: self.grow(self.size + count)
+        first = self.size
+        last = first + count
+        self.parent[first:last] = node
+        self.move[first:last] = moves
+        self.num_children[first:last] = 0
+        self.state[first:last] = NEW
+        self.prior[first:last] = priors
+        self.visits[first:last] = 0
+        self.value_sum[first:last] = 0
+        self.first_child[node] = first
+        self.num_children[node] = count
+        self.state[node] = EXPANDED
+        self.size = last
+
+
+    def add_noise(self, node):
+        children = self.children(node)
+        if not len(children): return
+        noise = self.rng.dirichlet([self.dirichlet_alpha] * len(children)).astype(np.float32)
+        self.prior[children] = (1 - self.noise_fraction) * self.prior[children] + self.noise_fraction * noise
+
+
+    def reuse(self, b):
+        """
+        Moves the root to the position of the board if it's reached from the current root with the last moves
+        of the board history, keeping that subtree. Otherwise the tree is cleared.
+        """
+        if self.root_key is None or b.key == self.root_key: return
+        history = b.history
+        for i in range(len(history) - 1, max(-1, len(history) - 9), -1):
+            if history[i][7] == self.root_key:
+                node = 0
+                for entry in history[i:]:
+                    node = self.find_child(node, entry[0])
+                    if node < 0: break
+                if node >= 0:
+                    self.advance_to(node)
+                    return
+                break
+        self.clear()
+
+
+    def find_child(self, node, move):
+        if self.state[node] != EXPANDED: return -1
+        children = self.children(node)
+        found = np.flatnonzero(self.move[children] == move)
+        return int(children[found[0]]) if len(found) else -1
+
+
+    def advance(self, move):
+        """Makes the child of the root reached with the move the new root, discarding the rest of the tree"""
+        node = self.find_child(0, move)
+        if node < 0:
+            self.clear()
+            return
+        self.advance_to(node)
+        self.root_key = None    # The next search trusts the board is in the position of the new root
+
+
+    def advance_to(self, root):
+        """Keeps only the subtree of the node, compacted at the start of the arrays with the node as the root"""
+        # Breadth first order keeps the children of every node contiguous
+        levels = [np.array([root], dtype=np.int64)]
+        while True:
+            level = levels[-1]
+            level = level[self.state[level] == EXPANDED]
+            counts = self.num_children[level].astype(np.int64)
+            if not counts.sum(): break
+            starts = np.repeat(self.first_child[level].astype(np.int64), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            levels.append(starts + offsets)
+        order = np.concatenate(levels)
+
+        mapping = np.full(self.size, -1, dtype=np.int32)
+        mapping[order] = np.arange(len(order), dtype=np.int32)
+        for name in ('parent', 'move', 'first_child', 'num_children', 'state', 'prior', 'visits', 'value_sum'):
+            array = getattr(self, name)
+            array[:len(order)] = array[order]
+        size = len(order)
+        self.parent[1:size] = mapping[self.parent[1:size]]
+        self.parent[0] = -1
+        expanded = np.flatnonzero(self.num_children[:size] > 0)
+        self.first_child[expanded] = mapping[self.first_child[expanded]]
+        self.size = size
+
+
+    def action_policy(self, num_squares, temperature=1.0):
+        """
+        Distribution of the visits of the root over all the actions (training target of the policy).
+        With temperature 0 all the probability goes to the most visited action.
+        """
+        policy = np.zeros(num_squares * num_squares, dtype=np.float32)
+        children = self.children(0)
+        if not len(children): return policy
+        moves = self.move[children]
+        actions = (moves & 0xFF) * num_squares + ((moves >> 8) & 0xFF)
+        visits = self.visits[children]
+        if temperature == 0:
+            policy[actions[visits.argmax()]] = 1.0
+        else:
+            weights = visits ** (1.0 / temperature)
+            policy[actions] = weights / weights.sum() if weights.sum() > 0 else 1.0 / len(actions)
+        return policy
+
+
+    def choose_move(self, b, num_simulations=800):
+        """Agent interface: returns the most visited move after searching the position"""
+        return self.search(b, num_simulations)['move']
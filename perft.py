@@ -0,0 +1,173 @@
+"""
+Move generation correctness suite (perft) and benchmark of the board.
+
+The perft of a position is the number of positions reached playing all the legal moves up to a depth.
+The reference positions have known node counts, so any difference means a bug in the rules.
+
+Usage:
+    python perft.py                         Runs the correctness suite
+    python perft.py --divide FEN DEPTH      Nodes after each move, to find where a count differs
+    python perft.py --bench out.json        Benchmark saved to a JSON file
+    python perft.py --bench new.json --compare old.json
+"""
+import board
+import piece
+
+import json
+import os
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+
+# (name, FEN, node counts from depth 1)
+POSITIONS = (
+    ('start', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+        (20, 400, 8902, 197281)),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+        (48, 2039, 97862)),
+    ('endgame', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+        (14, 191, 2812, 43238)),
+    ('promotions', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+        (6, 264, 9467)),
+    ('castling', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+        (44, 1486, 62379)),
+    ('middlegame', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+        (46, 2079, 89890)),
+)
+
+
+def run_suite(max_depth=None, verbose=True):
+    """
+    Checks the perft of all the reference positions up to max_depth (all the known depths by default).
+    Returns a list with (name, depth, expected, found, seconds) for every check.
+    """
+    results = []
+    for name, fen, counts in POSITIONS:
+        b = board.Board.from_fen(fen)
+        for depth, expected in enumerate(counts, 1):
+            if max_depth is not None and depth > max_depth: break
+            start = time.perf_counter()
+            found = b.perft(depth)
+            seconds = time.perf_counter() - start
+            results.append((name, depth, expected, found, seconds))
+            if verbose:
+                print("%-11s depth %d: %9d %s (%.2fs)" % (name, depth, found, "OK" if found == expected else
+                    "WRONG, expected " + str(expected), seconds))
+    return results
+
+
+def latency(function, calls, repeat=3):
+    """Minimum mean time in nanoseconds of calling the function with every argument tuple in calls"""
+    def run():
+        for args in calls: function(*args)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return best / len(calls) * 1e9
+
+
+def hot_method_latencies(b):
+    """Latency per call of the hot methods of the board in the given position"""
+    coords = b.square_coords
+    own = [c for c in coords if b.is_piece_on_turn(c)]
+    pairs = [(f, t) for f in own for t in coords if f != t]
+    lines = []
+    for f in own:
+        for dx, dy in ((1,0), (0,1), (1,1), (-1,1)):
+            steps = 1
+            while b.is_in_boundaries(piece.Vec2(f.x + dx * steps, f.y + dy * steps)): steps += 1
+            if steps > 1: lines.append((f, piece.Vec2(dx, dy), steps))
+    moves = b.legal_move_list()
+
+    def push_pop(move):
+        b.push(move)
+        b.pop()
+
+    return {
+        'get_piece_at': latency(b.get_piece_at, [(c,) for c in coords]),
+        'is_under_attack': latency(b.is_under_attack, [(c, t) for c in coords for t in 'WB']),
+        'is_valid_piece_movement': latency(b.is_valid_piece_movement, pairs),
+        'check_in_path': latency(b.check_in_path, lines),
+        'legal_move_list': latency(b.legal_move_list, [()] * 20),
+        'push_pop': latency(push_pop, [(m,) for m in moves]),
+    }
+
+
+def benchmark(depth=3):
+    """
+    Measures the nodes per second of perft in the reference positions, the latency of the hot methods
+    and the peak memory. Returns a dictionary ready to be saved as JSON.
+    """
+    result = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'depth': depth,
+        'python': sys.version.split()[0], 'positions': {}}
+
+    nodes = seconds = 0
+    for name, fen, counts in POSITIONS:
+        b = board.Board.from_fen(fen)
+        d = min(depth, len(counts))
+        start = time.perf_counter()
+        found = b.perft(d)
+        elapsed = time.perf_counter() - start
+        nodes += found
+        seconds += elapsed
+        result['positions'][name] = {
+            'depth': d, 'nodes': found, 'correct': found == counts[d - 1],
+            'nodes_per_sec': found / elapsed, 'latency_ns': hot_method_latencies(b)}
+    result['nodes_per_sec'] = nodes / seconds
+
+    # Peak of python allocations during a perft, tracemalloc slows it down so it's measured apart
+    tracemalloc.start()
+    board.Board.from_fen(POSITIONS[1][1]).perft(2)
+    result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    try:
+        import resource
+        result['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+    return result
+
+
+def compare(new, old):
+    """Prints the ratio new / old of the speeds and latencies of two benchmark results"""
+    print("nodes/sec: %.0f -> %.0f (x%.2f)" % (old['nodes_per_sec'], new['nodes_per_sec'],
+        new['nodes_per_sec'] / old['nodes_per_sec']))
+    for name, position in new['positions'].items():
+        if name not in old['positions']: continue
+        before = old['positions'][name]['latency_ns']
+        for method, ns in position['latency_ns'].items():
+            if method in before:
+                print("  %-11s %-24s %9.0f ns -> %9.0f ns (x%.2f)" % (name, method, before[method], ns, ns / before[method]))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Perft correctness suite and benchmark")
+    parser.add_argument('--depth', type=int, default=None, help="Maximum depth")
+    parser.add_argument('--divide', nargs=2, metavar=('FEN', 'DEPTH'), help="Nodes after each move of a position")
+    parser.add_argument('--bench', metavar='JSON', help="Runs the benchmark and saves it to the file")
+    parser.add_argument('--compare', metavar='JSON', help="Previous benchmark to compare with")
+    args = parser.parse_args()
+
+    if args.divide:
+        divided = board.Board.from_fen(args.divide[0]).divide(int(args.divide[1]))
+        for move, nodes in sorted(divided.items()): print(move, nodes)
+        print("Total:", sum(divided.values()))
+    elif args.bench:
+        result = benchmark(args.depth or 3)
+        with open(args.bench, 'w') as f: json.dump(result, f, indent=2)
+        print("%.0f nodes/sec, peak memory %d bytes" % (result['nodes_per_sec'], result['peak_memory_bytes']))
+        if args.compare:
+            with open(args.compare) as f: compare(result, json.load(f))
+    else:
+        failed = [r for r in run_suite(args.depth) if r[2] != r[3]]
+        sys.exit(1 if failed else 0)
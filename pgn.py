@@ -0,0 +1,200 @@
+"""
+Streaming reader of games in PGN format and replay of the games in the board.
+
+The files are read line by line, so files of any size (plain, .gz or .bz2) can be replayed in bounded memory.
+This is the way the simulator is tested: real games are replayed and any move that can't be done is reported.
+
+Usage: python pgn.py games.pgn.bz2 [-p processes]
+"""
+import board
+
+import bz2
+import collections
+import gzip
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+HEADER_PATTERN = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+# Comments, variations (non nested), NAGs and move numbers
+MOVETEXT_NOISE = re.compile(r'\{[^}]*\}|;[^\n]*|\$\d+|\d+\.(\.\.)?')
+
+
+class Game:
+    """A game read from a PGN file: the headers, the moves in standard notation and the result"""
+    def __init__(self, headers, moves, result):
+        self.headers = headers
+        self.moves = moves
+        self.result = result
+
+    def __str__(self):
+        return self.headers.get('White', '?') + " - " + self.headers.get('Black', '?') + " " + self.result
+
+
+def open_pgn(path):
+    """Opens a PGN file as text, decompressing it if its name ends in .gz or .bz2"""
+    if path.endswith('.gz'): return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    if path.endswith('.bz2'): return bz2.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+
+def iter_game_texts(source):
+    """
+    Yields the text of every game in the source (a path or an open text file) without parsing it.
+    Only one game is kept in memory at a time.
+    """
+    f = open_pgn(source) if isinstance(source, str) else source
+    try:
+        lines = []
+        in_moves = False
+        for line in f:
+            if line.startswith('['):
+                if in_moves:
+                    yield ''.join(lines)
+                    lines = []
+                    in_moves = False
+            elif line.strip():
+                in_moves = True
+            lines.append(line)
+        if in_moves: yield ''.join(lines)
+    finally:
+        if isinstance(source, str): f.close()
+
+
+def parse_game(text):
+    """Builds a Game from its PGN text"""
+    headers = {}
+    movetext = []
+    for line in text.splitlines():
+        match = HEADER_PATTERN.match(line)
+        if match: headers[match.group(1)] = match.group(2)
+        elif not line.startswith('%'): movetext.append(line)
+
+    movetext = MOVETEXT_NOISE.sub(' ', '\n'.join(movetext))
+    # Variations can be nested, they are removed from the inside out
+    while '(' in movetext:
+        reduced = re.sub(r'\([^()]*\)', ' ', movetext)
+        if reduced == movetext: break
+        movetext = reduced
+
+    moves = []
+    result = headers.get('Result', '*')
+    for token in movetext.split():
+        if token in RESULTS: result = token
+        else: moves.append(token)
+    return Game(headers, moves, result)
+
+
+def iter_games(source):
+    """Yields the games of the source (a path or an open text file) one by one"""
+    for text in iter_game_texts(source):
+        yield parse_game(text)
+
+
+def replay_game(game, validate=True):
+    """
+    Replays the moves of the game in a new board and returns the number of positions reached.
+    With validate=True every move is also checked with Board.is_legal_movement.
+    Raises ValueError if a move can't be done.
+    """
+    b = board.Board(silent=True)
+    for i, san in enumerate(game.moves):
+        try:
+            move = b.parse_san(san)
+        except ValueError as e:
+            raise ValueError("Move " + str(i // 2 + 1) + " (" + san + "): " + str(e))
+        if validate:
+            if not b.is_legal_movement(b.square_coords[move & 0xFF], b.square_coords[(move >> 8) & 0xFF]):
+                raise ValueError("Move " + str(i // 2 + 1) + " (" + san + "): rejected by is_legal_movement")
+        b.push(move)
+    return len(game.moves) + 1
+
+
+def replay_texts(texts, validate=True, max_errors=10):
+    """Parses and replays a list of game texts. Returns (games, positions, errors, error messages)."""
+    games = positions = errors = 0
+    messages = []
+    for text in texts:
+        game = parse_game(text)
+        try:
+            positions += replay_game(game, validate)
+            games += 1
+        except ValueError as e:
+            errors += 1
+            if len(messages) < max_errors: messages.append(str(game) + ": " + str(e))
+    return games, positions, errors, messages
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+
+def replay_file(path, processes=None, chunk_size=64, validate=True, max_errors=10, report=None):
+    """
+    Replays all the games of a PGN file, sharding them in chunks over a pool of processes.
+    Only a few chunks per process are read ahead, so the memory is bounded whatever the size of the file.
+
+    processes=None uses all the cores and processes=1 replays in this process.
+    report is an optional function called with the stats dictionary after each chunk.
+
+    Returns a dictionary with the games, positions, errors (and their first messages), seconds,
+    games per second and positions per second.
+    """
+    stats = {'games': 0, 'positions': 0, 'errors': 0, 'messages': []}
+    start = time.perf_counter()
+
+    def add(result):
+        games, positions, errors, messages = result
+        stats['games'] += games
+        stats['positions'] += positions
+        stats['errors'] += errors
+        stats['messages'] += messages[:max(0, max_errors - len(stats['messages']))]
+        seconds = time.perf_counter() - start
+        stats['seconds'] = seconds
+        stats['games_per_sec'] = stats['games'] / seconds if seconds > 0 else 0.0
+        stats['positions_per_sec'] = stats['positions'] / seconds if seconds > 0 else 0.0
+        if report is not None: report(stats)
+
+    chunks = chunked(iter_game_texts(path), chunk_size)
+    if processes == 1:
+        for chunk in chunks: add(replay_texts(chunk, validate, max_errors))
+    else:
+        processes = processes or os.cpu_count() or 1
+        with multiprocessing.Pool(processes) as pool:
+            max_pending = 2 * processes
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(replay_texts, (chunk, validate, max_errors)))
+                while len(pending) >= max_pending: add(pending.popleft().get())
+            while pending: add(pending.popleft().get())
+
+    if 'seconds' not in stats: add((0, 0, 0, []))
+    return stats
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Replays the games of a PGN file (.pgn, .pgn.gz or .pgn.bz2)")
+    parser.add_argument('path')
+    parser.add_argument('-p', '--processes', type=int, default=None, help="Worker processes (all the cores by default)")
+    parser.add_argument('-c', '--chunk-size', type=int, default=64, help="Games sent to a worker at once")
+    parser.add_argument('--no-validate', action='store_true', help="Don't check the moves with is_legal_movement")
+    args = parser.parse_args()
+
+    def report(stats):
+        sys.stderr.write("\r%d games, %d positions, %d errors | %.1f games/s, %.0f positions/s" % (
+            stats['games'], stats['positions'], stats['errors'], stats['games_per_sec'], stats['positions_per_sec']))
+
+    stats = replay_file(args.path, args.processes, args.chunk_size, not args.no_validate, report=report)
+    sys.stderr.write("\n")
+    for message in stats['messages']: print(message)
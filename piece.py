@@ -1,4 +1,6 @@
 class Vec2:
+    __slots__ = ('x', 'y')
+
     def __init__(self,x,y):
         self.x = x
         self.y = y
@@ -13,9 +15,11 @@ class Vec2:
     def __mul__(self, o):
         if type(o) is int:
             return Vec2(self.x * o, self.y * o)
-        return Vec2(self.x * o.x, self.y - o.y)
+        return Vec2(self.x * o.x, self.y * o.y)
     def __div__(self, o):
         return Vec2(self.x / o.x, self.y / o.y)
+    def __floordiv__(self, o):
+        return Vec2(self.x // o.x, self.y // o.y)
     def __eq__(self, o):
         return self.x == o.x and self.y == o.y
     def __abs__(o):
@@ -30,6 +34,8 @@ class Piece:
 
     piece_type should be 'P'(pawn), 'T'(tower/rook), 'H'(horse/knight), 'B'(Bishop), 'Q'(Queen) or 'K'(King)
     """
+    __slots__ = ('pos', 'is_alive', 'piece_type', 'first_move', 'team')
+
     def __init__(self, x, y, piece_type, is_whites):
         self.pos = Vec2(x,y)
         self.is_alive = True
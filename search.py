@@ -0,0 +1,471 @@
+"""
+Alpha-beta search engine playing on the board with push() and pop(), without copying it.
+
+Negamax with iterative deepening and principal variation search, a quiescence search of the captures,
+move ordering (transposition table move, MVV-LVA captures, killer moves and history heuristic)
+and a budget of depth, nodes or time. The engine can play as an agent with choose_move().
+
+Usage: python search.py [FEN] [--depth D] [--time SECONDS] [--nodes N] [-p processes] [--benchmark]
+"""
+import board
+import evaluation
+import tablebase
+import transposition
+
+import multiprocessing
+import os
+import queue
+import random
+import time
+
+
+# Value of the pieces to sort the captures: most valuable victim first, then least valuable attacker
+ORDER_VALUES = {'P':1, 'H':3, 'B':3, 'T':5, 'Q':9, 'K':20}
+
+MATE = 30000                # Score of being checkmated now, mates further away are closer to 0
+MATE_BOUND = MATE - 1000    # Scores beyond this are mates
+INFINITY = 32000
+MAX_PLY = 128
+HELPER_TIMEOUT = 1.0    # Seconds between the checks of the helpers of ParallelEngine while waiting for them
+
+# Move ordering scores
+TT_MOVE_ORDER = 1 << 30
+CAPTURE_ORDER = 1 << 24
+KILLER_ORDER = (1 << 23, (1 << 23) - 1)
+HISTORY_MAX = (1 << 22)
+
+# Positions of the parallel search benchmark: the start, an open middlegame, a closed one and an endgame
+BENCHMARK_FENS = (
+    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+    'r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4',
+    'r2q1rk1/pp1nbppp/2p1pn2/3p4/2PP4/2N1PN2/PPQ1BPPP/R1B2RK1 w - - 0 9',
+    '8/5pk1/6p1/3R4/5P2/6K1/r5P1/8 w - - 0 40',
+)
+
+
+class SearchAborted(Exception):
+    """Raised inside the search when the node or time budget runs out"""
+
+
+def score_to_tt(score, ply):
+    """Mate scores are saved relative to the position, not to the root"""
+    if score >= MATE_BOUND: return score + ply
+    if score <= -MATE_BOUND: return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score >= MATE_BOUND: return score - ply
+    if score <= -MATE_BOUND: return score + ply
+    return score
+
+
+class Engine:
+    """
+    Search engine. The limits given here are the default budget of search() and choose_move():
+    max_depth in plies, max_time in seconds and max_nodes. Without any limit the search goes to depth 4.
+
+    evaluate is the function scoring a quiet position from the point of view of the team on turn
+    (evaluation.evaluate by default, material and piece-square tables kept updated by the board).
+    The transposition table (size in megabytes) is kept between searches, another one can be given with tt
+    (e.g. a transposition.SharedTranspositionTable). With a tablebase (see tablebase.Tablebase) the positions with few pieces are scored exactly instead of searched.
+    """
+    def __init__(self, max_depth=None, max_time=None, max_nodes=None, tt_size_mb=16, evaluate=evaluation.evaluate,
+            tablebase=None, tt=None):
+        self.max_depth = max_depth
+        self.max_time = max_time
+        self.max_nodes = max_nodes
+        self.evaluate = evaluate
+        self.tablebase = tablebase
+        self.tt = tt if tt is not None else transposition.TranspositionTable(tt_size_mb)
+        self.killers = [[0, 0] for _ in range(MAX_PLY + 1)]
+        self.history = ({}, {})    # Indexed by team and move & 0xFFFF, only the moves with a score are kept
+        self.pv = [[] for _ in range(MAX_PLY + 2)]
+        self.nodes = 0
+        self.deadline = None
+        self.node_limit = None
+        self.stop_event = None      # The search is aborted when it's set (multiprocessing.Event)
+        self.depth_offset = 0       # Added to the depth of every iteration (helpers of ParallelEngine)
+
+
+    def search(self, b, max_depth=None, max_time=None, max_nodes=None, info=None):
+        """
+        Searches the best move of the team on turn. The limits default to the ones of the engine.
+        info is an optional function called with the result of every completed iteration.
+
+        Returns a dictionary with the best move (0 if there are no legal moves), its principal variation,
+        the score in centipawns for the team on turn, the depth completed, the nodes, seconds and nodes per second.
+        The board is left as it was.
+        """
+        max_depth = max_depth or self.max_depth
+        max_time = max_time or self.max_time
+        max_nodes = max_nodes or self.max_nodes
+        if not (max_depth or max_time or max_nodes): max_depth = 4
+        max_depth = min(max_depth or MAX_PLY, MAX_PLY)
+
+        start = time.perf_counter()
+        self.deadline = start + max_time if max_time else None
+        self.node_limit = max_nodes
+        self.nodes = 0
+        self.tt.new_search()
+        for killers in self.killers: killers[0] = killers[1] = 0
+        self.history = tuple({move: value >> 3 for move, value in table.items() if value >> 3} for table in self.history)
+
+        moves = b.legal_move_list()
+        result = {'move': moves[0] if moves else 0, 'pv': moves[:1], 'score': 0, 'depth': 0,
+            'nodes': 0, 'seconds': 0.0, 'nps': 0.0}
+        if not moves:
+            result['score'] = -MATE if b.in_check() else 0
+            return result
+
+        history_length = len(b.history)
+        for depth in range(1, max_depth + 1):
+            try:
+                score = self.negamax(b, depth + self.depth_offset, -INFINITY, INFINITY, 0)
+            except SearchAborted:
+                while len(b.history) > history_length: b.pop()
+                break
+            seconds = time.perf_counter() - start
+            pv = self.pv[0][:]
+            if pv:
+                result['move'] = pv[0]
+                result['pv'] = pv
+            result['score'] = score
+            result['depth'] = depth + self.depth_offset
+            if info is not None: info(self.finish(result, start))
+            if score >= MATE_BOUND or score <= -MATE_BOUND:
+                if MATE - abs(score) <= depth: break    # The shortest mate has been found
+            # Another iteration takes longer than all the previous ones, it's not started if there's no time
+            if self.deadline is not None and seconds > max_time / 2: break
+        return self.finish(result, start)
+
+
+    def finish(self, result, start):
+        result['nodes'] = self.nodes
+        result['seconds'] = time.perf_counter() - start
+        result['nps'] = self.nodes / result['seconds'] if result['seconds'] > 0 else 0.0
+        return result
+
+
+    def check_budget(self):
+        if self.node_limit is not None and self.nodes >= self.node_limit: raise SearchAborted()
+        if self.deadline is not None and time.perf_counter() >= self.deadline: raise SearchAborted()
+        if self.stop_event is not None and self.stop_event.is_set(): raise SearchAborted()
+
+
+    def choose_move(self, b):
+        """Agent interface: returns the move to play in the board (encoded, see board.encode_move)"""
+        return self.search(b)['move']
+
+
+    def negamax(self, b, depth, alpha, beta, ply):
+        self.nodes += 1
+        if not self.nodes & 1023: self.check_budget()
+        self.pv[ply] = []
+        if ply and (b.halfmove_clock >= 100 or b.is_repetition(2)): return 0
+        if ply >= MAX_PLY: return self.evaluate(b)
+        if ply and self.tablebase is not None:
+            value = self.tablebase.probe(b)
+            if value is not None and value != tablebase.ILLEGAL:
+                # Plies to mate from the tablebase turned into a mate score from the root
+                if value > 0: return MATE - ply - (tablebase.TB_MATE - value)
+                if value < 0: return -(MATE - ply - (tablebase.TB_MATE + value))
+                return 0
+
+        in_check = b.in_check()
+        if in_check: depth += 1     # Check extension
+        if depth <= 0: return self.quiescence(b, alpha, beta, ply)
+
+        key = b.key
+        tt_move = 0
+        entry = self.tt.probe(key)
+        if entry is not None:
+            tt_move, tt_score, tt_depth, flag = entry
+            if ply and tt_depth >= depth:
+                tt_score = score_from_tt(tt_score, ply)
+                if flag == transposition.EXACT: return tt_score
+                if flag == transposition.LOWER and tt_score >= beta: return tt_score
+                if flag == transposition.UPPER and tt_score <= alpha: return tt_score
+
+        moves = b.legal_move_list()
+        if not moves: return -MATE + ply if in_check else 0
+        if len(moves) > 1: self.order_moves(b, moves, tt_move, ply)
+
+        alpha_start = alpha
+        best_score = -INFINITY
+        best_move = 0
+        for i, move in enumerate(moves):
+            b.push(move)
+            if i == 0:
+                score = -self.negamax(b, depth - 1, -beta, -alpha, ply + 1)
+            else:
+                # Null window to prove the move is worse than the best one, searched again if it isn't
+                score = -self.negamax(b, depth - 1, -alpha - 1, -alpha, ply + 1)
+                if alpha < score < beta: score = -self.negamax(b, depth - 1, -beta, -alpha, ply + 1)
+            b.pop()
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                    self.pv[ply] = [move] + self.pv[ply + 1]
+                    if score >= beta:
+                        if not self.is_tactical(b, move):
+                            killers = self.killers[ply]
+                            if killers[0] != move:
+                                killers[1] = killers[0]
+                                killers[0] = move
+                            table = self.history[0 if b.playing == 'W' else 1]
+                            table[move & 0xFFFF] = min(table.get(move & 0xFFFF, 0) + depth * depth, HISTORY_MAX)
+                        break
+
+        if best_score >= beta: flag = transposition.LOWER
+        elif best_score > alpha_start: flag = transposition.EXACT
+        else: flag = transposition.UPPER
+        self.tt.store(key, best_move, score_to_tt(best_score, ply), depth, flag)
+        return best_score
+
+
+    def quiescence(self, b, alpha, beta, ply):
+        """Searches only the captures and promotions until the position is quiet, so the evaluation is reliable"""
+        self.nodes += 1
+        if not self.nodes & 1023: self.check_budget()
+        self.pv[ply] = []
+        if ply >= MAX_PLY: return self.evaluate(b)
+
+        if b.in_check():
+            # There's no standing pat in check, all the evasions are searched
+            moves = b.legal_move_list()
+            if not moves: return -MATE + ply
+            best_score = -INFINITY
+        else:
+            best_score = self.evaluate(b)
+            if best_score >= beta: return best_score
+            if best_score > alpha: alpha = best_score
+            moves = list(b.legal_moves(True))
+        if len(moves) > 1: self.order_moves(b, moves, 0, ply)
+
+        for move in moves:
+            b.push(move)
+            score = -self.quiescence(b, -beta, -alpha, ply + 1)
+            b.pop()
+            if score > best_score:
+                best_score = score
+                if score > alpha:
+                    alpha = score
+                    if score >= beta: break
+        return best_score
+
+
+    def is_tactical(self, b, move):
+        """Returns True if the move is a capture or a promotion"""
+        to_sq = (move >> 8) & 0xFF
+        return b.squares[to_sq] >= 0 or move >> 16 != 0 or (to_sq == b.ep_square
+            and b.piece_list[b.squares[move & 0xFF]].piece_type == 'P')
+
+
+    def order_moves(self, b, moves, tt_move, ply):
+        """Sorts the moves from the most to the least promising"""
+        squares = b.squares
+        pieces = b.piece_list
+        killers = self.killers[ply]
+        history = self.history[0 if b.playing == 'W' else 1]
+        ep = b.ep_square
+
+        def order(move):
+            if move == tt_move: return TT_MOVE_ORDER
+            to_sq = (move >> 8) & 0xFF
+            victim = squares[to_sq]
+            promotion = move >> 16
+            if victim >= 0 or promotion:
+                attacker = pieces[squares[move & 0xFF]].piece_type
+                value = ORDER_VALUES[pieces[victim].piece_type] if victim >= 0 else 0
+                if promotion: value += ORDER_VALUES[board.PROMOTION_TYPES[promotion]]
+                return CAPTURE_ORDER + value * 32 - ORDER_VALUES[attacker]
+            if to_sq == ep and pieces[squares[move & 0xFF]].piece_type == 'P':
+                return CAPTURE_ORDER + 31
+            if move == killers[0]: return KILLER_ORDER[0]
+            if move == killers[1]: return KILLER_ORDER[1]
+            return history.get(move & 0xFFFF, 0)
+
+        moves.sort(key=order, reverse=True)
+
+
+def game_record(b):
+    """Starting position (FEN) and moves of the game of the board, to set up the same game in another process"""
+    moves = [entry[0] for entry in b.history]
+    for _ in moves: b.pop()
+    fen = b.to_fen()
+    for move in moves: b.push(move)
+    return fen, moves
+
+
+def helper(index, tt, tasks, done, stop, options):
+    """Helper process of ParallelEngine: searches the positions it's given until stop is set"""
+    engine = Engine(tt=tt, **options)
+    engine.stop_event = stop
+    engine.depth_offset = index % 2     # Half of the helpers search one ply deeper
+    while True:
+        task = tasks.get()
+        if task is None: break
+        search_id, fen, moves, max_time = task
+        b = board.Board.from_fen(fen)
+        for move in moves: b.push(move)
+        engine.search(b, MAX_PLY, max_time)
+        done.put((os.getpid(), search_id, engine.nodes))
+
+
+class ParallelEngine(Engine):
+    """
+    Lazy SMP: the engine searches as usual while processes - 1 helper processes search the same position
+    (half of them one ply deeper) with the same transposition table in shared memory. The helpers only fill
+    the table, which makes the moves of the main search better ordered and cuts its branches; they are stopped
+    when the main search finishes. With processes=1 it's the same as Engine.
+
+    The helpers are started once and kept between searches, close() stops them. The helpers that die are left
+    out of the next searches, without any of them the search is the one of Engine.
+    """
+    def __init__(self, processes=None, max_depth=None, max_time=None, max_nodes=None, tt_size_mb=16,
+            evaluate=evaluation.evaluate, tablebase=None):
+        super().__init__(max_depth, max_time, max_nodes, tt_size_mb, evaluate, tablebase,
+            transposition.SharedTranspositionTable(tt_size_mb))
+        self.processes = processes or os.cpu_count() or 1
+        self.stop_event = multiprocessing.Event()
+        self.done = multiprocessing.Queue()
+        self.tasks = [multiprocessing.Queue() for _ in range(self.processes - 1)]
+        options = {'evaluate': evaluate, 'tablebase': tablebase}
+        self.helpers = [multiprocessing.Process(target=helper, daemon=True,
+            args=(i + 1, self.tt, tasks, self.done, self.stop_event, options)) for i, tasks in enumerate(self.tasks)]
+        for p in self.helpers: p.start()
+        self.searches = 0
+
+
+    def search(self, b, max_depth=None, max_time=None, max_nodes=None, info=None):
+        """Same as Engine.search, the nodes are the ones of all the processes"""
+        self.stop_event.clear()     # Set at the end of the previous search to stop the helpers
+        self.drop_dead_helpers()
+        if not self.helpers: return super().search(b, max_depth, max_time, max_nodes, info)
+        fen, moves = game_record(b)
+        self.searches += 1
+        for tasks in self.tasks: tasks.put((self.searches, fen, moves, max_time or self.max_time))
+        try:
+            result = super().search(b, max_depth, max_time, max_nodes, info)
+        finally:
+            self.stop_event.set()
+            helper_nodes = self.wait_helpers()
+        result['nodes'] += helper_nodes
+        result['nps'] = result['nodes'] / result['seconds'] if result['seconds'] > 0 else 0.0
+        return result
+
+
+    def wait_helpers(self):
+        """Waits for the helpers to finish the current search and returns their nodes. The dead ones aren't waited."""
+        nodes = 0
+        waiting = {p.pid for p in self.helpers}
+        while waiting:
+            try:
+                pid, search_id, helper_nodes = self.done.get(timeout=HELPER_TIMEOUT)
+            except queue.Empty:
+                waiting &= {p.pid for p in self.helpers if p.is_alive()}
+                continue
+            if search_id != self.searches: continue     # Late answer of an older search
+            nodes += helper_nodes
+            waiting.discard(pid)
+        return nodes
+
+
+    def drop_dead_helpers(self):
+        alive = [i for i, p in enumerate(self.helpers) if p.is_alive()]
+        self.helpers = [self.helpers[i] for i in alive]
+        self.tasks = [self.tasks[i] for i in alive]
+
+
+    def close(self):
+        for tasks in self.tasks: tasks.put(None)
+        for p in self.helpers: p.join()
+        self.helpers = []
+        self.tt.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def benchmark(processes=None, depth=5, fens=BENCHMARK_FENS, tt_size_mb=64):
+    """
+    Speedup of the parallel search: the seconds to search the positions to the depth with Engine
+    and with a ParallelEngine of the given processes (all the cores by default).
+    """
+    processes = processes or os.cpu_count() or 1
+    result = {'processes': processes, 'depth': depth}
+    for name, count in (('single', 1), ('parallel', processes)):
+        engine = ParallelEngine(count, max_depth=depth, tt_size_mb=tt_size_mb)
+        start = time.perf_counter()
+        nodes = sum(engine.search(board.Board.from_fen(fen))['nodes'] for fen in fens)
+        result[name + '_seconds'] = time.perf_counter() - start
+        result[name + '_nodes'] = nodes
+        engine.close()
+    result['speedup'] = result['single_seconds'] / result['parallel_seconds']
+    return result
+
+
+class RandomAgent:
+    """Agent playing random legal moves, the baseline opponent"""
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+
+
+    def choose_move(self, b):
+        return self.random.choice(b.legal_move_list())
+
+
+def play_game(white, black, b=None, max_plies=400):
+    """
+    Plays a game between two agents (objects with a choose_move(board) method) from the given board
+    or from the starting position. Returns the outcome (see Board.outcome, None if max_plies is reached)
+    and the list of moves played.
+    """
+    if b is None: b = board.Board(silent=True)
+    moves = []
+    while len(moves) < max_plies:
+        result = b.outcome()
+        if result is not None: return result, moves
+        move = (white if b.playing == 'W' else black).choose_move(b)
+        b.push(move)
+        moves.append(move)
+    return b.outcome(), moves
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Searches the best move of a position")
+    parser.add_argument('fen', nargs='?', default=None, help="Position in FEN notation (the starting position by default)")
+    parser.add_argument('--depth', type=int, default=None)
+    parser.add_argument('--time', type=float, default=None, help="Seconds")
+    parser.add_argument('--nodes', type=int, default=None)
+    parser.add_argument('-p', '--processes', type=int, default=1, help="Processes of the parallel search")
+    parser.add_argument('--benchmark', action='store_true', help="Compares the parallel search with one process")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        result = benchmark(args.processes if args.processes > 1 else None, args.depth or 5)
+        print("depth %d | 1 process %.2fs %d nodes | %d processes %.2fs %d nodes | speedup %.2f" % (result['depth'],
+            result['single_seconds'], result['single_nodes'], result['processes'], result['parallel_seconds'],
+            result['parallel_nodes'], result['speedup']))
+        raise SystemExit
+
+    b = board.Board.from_fen(args.fen) if args.fen else board.Board(silent=True)
+
+    def info(result):
+        print("depth %d score %d nodes %d nps %.0f pv %s" % (result['depth'], result['score'], result['nodes'],
+            result['nps'], ' '.join(b.move_to_uci(m) for m in result['pv'])))
+
+    engine = ParallelEngine(args.processes) if args.processes > 1 else Engine()
+    result = engine.search(b, args.depth, args.time, args.nodes, info=info)
+    if args.processes > 1: engine.close()
+    print("bestmove", b.move_to_uci(result['move']) if result['move'] else "(none)")
@@ -0,0 +1,348 @@
+"""
+Headless self-play: worker processes play games with pluggable agents and write the samples into a replay buffer
+in shared memory, so no sample is pickled between processes.
+
+Every sample is a packed position (see Board.pack), the policy of the agent in that position (the probabilities of
+up to MAX_POLICY_MOVES actions, the actions of batch.BoardBatch) and the outcome of the game for the team on turn.
+
+    runner = selfplay.SelfPlay(agent_factory, workers=8)
+    runner.run(seconds=60)
+    positions, policies, outcomes = runner.buffer.sample(256)
+
+Usage: python selfplay.py [--workers M] [--seconds S] [--agent random|search|mcts]
+"""
+import board
+import dataset
+import search
+
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from multiprocessing import shared_memory
+
+
+MAX_POLICY_MOVES = 64
+
+SAMPLE_DTYPE = np.dtype([('position', dataset.POSITION_DTYPE), ('actions', '<i2', MAX_POLICY_MOVES),
+    ('probs', '<f2', MAX_POLICY_MOVES), ('outcome', 'i1'), ('sequence', '<i8')])
+
+# Columns of the per worker stats
+STAT_GAMES = 0
+STAT_POSITIONS = 1
+STAT_BUSY = 2           # Seconds playing
+STAT_WRITING = 3        # Seconds waiting for and writing to the buffer
+STAT_STARTED = 4        # Start time (time.time)
+STAT_ALIVE = 5
+NUM_STATS = 6
+
+
+class ReplayBuffer:
+    """
+    Ring buffer of samples in shared memory. The writers reserve consecutive slots under a lock and fill them;
+    the sequence number of a slot is written last, so the readers skip the slots that are being written.
+    """
+    def __init__(self, capacity, width=8, height=8, name=None):
+        self.capacity = capacity
+        self.width = width
+        self.height = height
+        size = capacity * SAMPLE_DTYPE.itemsize
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.samples = np.ndarray(capacity, dtype=SAMPLE_DTYPE, buffer=self.memory.buf)
+        if self.owner: self.samples['sequence'] = 0
+        self.counter = multiprocessing.Value('q', 0)    # Samples written since the start, with its lock
+
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['memory'], state['samples']
+        state['memory_name'] = self.memory.name
+        return state
+
+
+    def __setstate__(self, state):
+        # Attached again by name in processes started with spawn
+        name = state.pop('memory_name')
+        self.__dict__.update(state)
+        self.memory = shared_memory.SharedMemory(name=name)
+        self.owner = False
+        self.samples = np.ndarray(self.capacity, dtype=SAMPLE_DTYPE, buffer=self.memory.buf)
+
+
+    @property
+    def name(self):
+        return self.memory.name
+
+
+    def __len__(self):
+        return min(self.counter.value, self.capacity)
+
+
+    def write(self, samples):
+        """Copies an array of samples (SAMPLE_DTYPE) into the next slots, overwriting the oldest ones"""
+        n = len(samples)
+        if n == 0: return
+        with self.counter.get_lock():
+            first = self.counter.value
+            self.counter.value = first + n
+        sequence = np.arange(first, first + n)
+        slots = sequence % self.capacity
+        fields = [name for name in SAMPLE_DTYPE.names if name != 'sequence']
+        self.samples['sequence'][slots] = 0
+        for name in fields: self.samples[name][slots] = samples[name]
+        self.samples['sequence'][slots] = sequence + 1
+
+
+    def sample(self, batch_size, rng=None):
+        """
+        Random samples of the buffer: the packed positions (see dataset.decode_planes), the dense policies
+        (batch_size, num_squares ** 2) and the outcomes. Slots overwritten while being read are left out.
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        available = len(self)
+        if available == 0: raise ValueError("The replay buffer is empty")
+        slots = rng.integers(0, available, size=batch_size)
+        records = self.samples[slots].copy()
+        valid = (records['sequence'] > 0) & (records['sequence'] == self.samples['sequence'][slots])
+        records = records[valid]
+
+        num_actions = (self.width * self.height) ** 2
+        policies = np.zeros((len(records), num_actions), dtype=np.float32)
+        rows = np.repeat(np.arange(len(records)), MAX_POLICY_MOVES)
+        actions = records['actions'].reshape(-1).astype(np.int64)
+        used = actions >= 0
+        policies[rows[used], actions[used]] = records['probs'].reshape(-1)[used]
+        return records['position'], policies, records['outcome'].astype(np.float32)
+
+
+    def close(self):
+        self.samples = None
+        self.memory.close()
+        if self.owner: self.memory.unlink()
+
+
+def sparse_policy(agent, b, move):
+    """
+    Actions and probabilities of the policy of the agent after choosing the move: the visits of the root
+    for agents with action_policy (e.g. mcts.MCTS), the move played otherwise. At most MAX_POLICY_MOVES are kept.
+    """
+    n = b.geometry.num_squares
+    actions = np.full(MAX_POLICY_MOVES, -1, dtype=np.int16)
+    probs = np.zeros(MAX_POLICY_MOVES, dtype=np.float16)
+    if hasattr(agent, 'action_policy'):
+        dense = agent.action_policy(n)
+        nonzero = np.flatnonzero(dense)
+        if len(nonzero) > MAX_POLICY_MOVES:
+            nonzero = nonzero[np.argsort(dense[nonzero])[::-1][:MAX_POLICY_MOVES]]
+        if len(nonzero):
+            actions[:len(nonzero)] = nonzero
+            probs[:len(nonzero)] = dense[nonzero] / dense[nonzero].sum()
+            return actions, probs
+    actions[0] = (move & 0xFF) * n + ((move >> 8) & 0xFF)
+    probs[0] = 1.0
+    return actions, probs
+
+
+def play_game(agents, b, max_plies, stop=None):
+    """
+    Plays a game with the agents (white, black) from the board and returns its samples (SAMPLE_DTYPE)
+    and the result (1 whites won, -1 blacks won, 0 draw), or None if stop was set during the game.
+    """
+    samples = np.zeros(max_plies, dtype=SAMPLE_DTYPE)
+    teams = np.zeros(max_plies, dtype=np.int8)
+    plies = 0
+    result = b.outcome()
+    while result is None and plies < max_plies:
+        if stop is not None and stop.is_set(): return None, None
+        agent = agents[0 if b.playing == 'W' else 1]
+        move = agent.choose_move(b)
+        sample = samples[plies]
+        sample['position'] = np.frombuffer(b.pack(), dtype=dataset.POSITION_DTYPE)[0]
+        sample['actions'], sample['probs'] = sparse_policy(agent, b, move)
+        teams[plies] = 1 if b.playing == 'W' else -1
+        b.push(move)
+        plies += 1
+        result = b.outcome()
+    value = result[0] if result is not None else 0
+    samples = samples[:plies]
+    samples['outcome'] = teams[:plies] * value
+    return samples, value
+
+
+def worker(index, agent_factory, buffer, stats, stop, width, height, max_plies, max_games):
+    """Plays games until stop is set (or max_games are played) writing their samples to the buffer"""
+    np.random.seed((os.getpid() * 7919 + index) % 2**32)
+    row = np.frombuffer(stats, dtype=np.float64).reshape(-1, NUM_STATS)[index]
+    row[STAT_STARTED] = time.time()
+    row[STAT_ALIVE] = 1
+    try:
+        agents = agent_factory(index)
+        if not isinstance(agents, (tuple, list)): agents = (agents, agents)
+        games = 0
+        while not stop.is_set() and (max_games is None or games < max_games):
+            start = time.perf_counter()
+            samples, result = play_game(agents, board.Board(width, height, silent=True), max_plies, stop)
+            if samples is None: break
+            played = time.perf_counter()
+            buffer.write(samples)
+            row[STAT_BUSY] += played - start
+            row[STAT_WRITING] += time.perf_counter() - played
+            row[STAT_GAMES] += 1
+            row[STAT_POSITIONS] += len(samples)
+            games += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        row[STAT_ALIVE] = 0
+
+
+class SelfPlay:
+    """
+    Runs self-play in worker processes.
+
+    agent_factory(worker_index) is called in every worker and returns the agent playing both sides, or a pair
+    (white, black). Agents have a choose_move(board) method (see search.py and mcts.py) and optionally
+    action_policy(num_squares) giving the policy of the last move. It must be picklable (a module level function
+    or class) with the spawn start method.
+    """
+    def __init__(self, agent_factory, workers=None, capacity=1 << 16, width=8, height=8, max_plies=400):
+        self.agent_factory = agent_factory
+        self.workers = workers or os.cpu_count() or 1
+        self.width = width
+        self.height = height
+        self.max_plies = max_plies
+        self.buffer = ReplayBuffer(capacity, width, height)
+        self.stats_shared = multiprocessing.RawArray('d', self.workers * NUM_STATS)
+        self.stats_array = np.frombuffer(self.stats_shared, dtype=np.float64).reshape(self.workers, NUM_STATS)
+        self.stop_event = multiprocessing.Event()
+        self.processes = []
+        self.started = None
+
+
+    def start(self, max_games=None):
+        """Starts the workers. max_games is the number of games of each worker (until stop() by default)."""
+        self.stop_event.clear()
+        self.started = time.time()
+        self.processes = [multiprocessing.Process(target=worker, daemon=True, args=(i, self.agent_factory, self.buffer,
+            self.stats_shared, self.stop_event, self.width, self.height, self.max_plies, max_games))
+            for i in range(self.workers)]
+        for p in self.processes: p.start()
+
+
+    def stop(self, timeout=10.0):
+        """Asks the workers to finish (the games being played are discarded) and waits for them"""
+        self.stop_event.set()
+        deadline = time.time() + timeout
+        for p in self.processes:
+            p.join(max(0.0, deadline - time.time()))
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        self.processes = []
+
+
+    def running(self):
+        return any(p.is_alive() for p in self.processes)
+
+
+    def stats(self):
+        """Games, positions, games per second, positions per second and the utilization of every worker"""
+        now = time.time()
+        seconds = now - self.started if self.started else 0.0
+        rows = self.stats_array
+        games = int(rows[:, STAT_GAMES].sum())
+        positions = int(rows[:, STAT_POSITIONS].sum())
+        workers = []
+        for row in rows:
+            elapsed = now - float(row[STAT_STARTED]) if row[STAT_STARTED] else 0.0
+            workers.append({'games': int(row[STAT_GAMES]), 'positions': int(row[STAT_POSITIONS]),
+                'utilization': row[STAT_BUSY] / elapsed if elapsed > 0 else 0.0,
+                'writing': row[STAT_WRITING] / elapsed if elapsed > 0 else 0.0, 'alive': bool(row[STAT_ALIVE])})
+        return {'games': games, 'positions': positions, 'seconds': seconds,
+            'games_per_sec': games / seconds if seconds > 0 else 0.0,
+            'positions_per_sec': positions / seconds if seconds > 0 else 0.0,
+            'buffered': len(self.buffer), 'workers': workers}
+
+
+    def run(self, seconds=None, games=None, report=None, interval=1.0):
+        """
+        Runs the workers for some seconds (or until each one has played games games) and stops them.
+        report is an optional function called with stats() every interval seconds. Returns the final stats.
+        """
+        self.start(games)
+        try:
+            end = time.time() + seconds if seconds is not None else None
+            while self.running() and (end is None or time.time() < end):
+                time.sleep(interval if end is None else max(0.0, min(interval, end - time.time())))
+                if report is not None: report(self.stats())
+        finally:
+            self.stop()
+        return self.stats()
+
+
+    def close(self):
+        """Stops the workers and frees the shared memory"""
+        self.stop()
+        self.buffer.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def random_agent(index):
+    return search.RandomAgent()
+
+
+def search_agent(index):
+    return search.Engine(max_depth=2)
+
+
+class MCTSAgent:
+    """MCTS with a fixed number of simulations per move and exploration noise at the root"""
+    def __init__(self, num_simulations=64, **options):
+        import mcts
+        options.setdefault('noise_fraction', 0.25)
+        self.tree = mcts.MCTS(**options)
+        self.num_simulations = num_simulations
+
+
+    def choose_move(self, b):
+        return self.tree.choose_move(b, self.num_simulations)
+
+
+    def action_policy(self, num_squares):
+        return self.tree.action_policy(num_squares)
+
+
+def mcts_agent(index):
+    return MCTSAgent(batch_size=8)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Runs self-play games in worker processes")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (all the cores by default)")
+    parser.add_argument('--seconds', type=float, default=30.0)
+    parser.add_argument('--agent', choices=('random', 'search', 'mcts'), default='random')
+    parser.add_argument('--capacity', type=int, default=1 << 16, help="Samples kept in the replay buffer")
+    args = parser.parse_args()
+
+    factory = {'random': random_agent, 'search': search_agent, 'mcts': mcts_agent}[args.agent]
+
+    def report(stats):
+        print("%d games, %d positions | %.2f games/s, %.0f positions/s | utilization %s" % (stats['games'],
+            stats['positions'], stats['games_per_sec'], stats['positions_per_sec'],
+            ' '.join("%.0f%%" % (100 * w['utilization']) for w in stats['workers'])))
+
+    with SelfPlay(factory, args.workers, args.capacity) as runner:
+        try:
+            report(runner.run(args.seconds, report=report))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,359 @@
+"""
+Game server: many games (sessions) hosted by one asyncio process, played with a line protocol similar to UCI
+over TCP or a Unix socket. The searches run in a pool of processes so they don't block the other sessions.
+
+Every command is a line, the answers are lines starting with the same session id so the commands of many
+sessions can be sent through one connection without waiting (the searches answer when they finish):
+
+    new [startpos | fen FEN]            ->  session ID
+    position ID startpos | fen FEN [moves M1 M2 ...]  ->  ok ID
+    move ID M                           ->  ok ID | error ID illegal move M
+    go ID [depth D] [movetime MS] [nodes N]  ->  bestmove ID M score S depth D nodes N   (the move isn't played)
+    play ID [depth D] [movetime MS] [nodes N]  ->  bestmove ID ... after playing it,
+                                            error ID position changed if a move was made during the search
+    legal ID                            ->  legal ID M1 M2 ...
+    fen ID                              ->  fen ID FEN
+    status ID                           ->  status ID ongoing | status ID 1-0 checkmate | ...
+    close ID                            ->  ok ID
+    metrics                             ->  metric COMMAND count N mean_ms X p50_ms X p99_ms X max_ms X, then end
+    uci / isready / quit
+
+Wrong commands are answered with error [ID] MESSAGE. The sessions created by a connection are closed when it's closed. Moves are in coordinates notation (e.g. e2e4).
+
+Usage: python server.py [--host 127.0.0.1] [--port 5000 | --unix PATH] [-p processes] [--depth D]
+"""
+import board
+import search
+
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import os
+import time
+
+import numpy as np
+
+
+START_FEN = board.Board(silent=True).to_fen()
+LATENCY_SAMPLES = 4096      # Latencies kept per command for the percentiles
+
+# Arguments required by the commands and their usage, sent back when they are missing
+USAGE = {
+    'position': (2, "position ID startpos | fen FEN [moves M1 M2 ...]"),
+    'move': (2, "move ID MOVE"),
+    'go': (1, "go ID [depth D] [movetime MS] [nodes N]"),
+    'play': (1, "play ID [depth D] [movetime MS] [nodes N]"),
+    'legal': (1, "legal ID"),
+    'fen': (1, "fen ID"),
+    'status': (1, "status ID"),
+    'close': (1, "close ID"),
+}
+
+_engine = None
+
+
+def init_worker(engine_options):
+    global _engine
+    _engine = search.Engine(**engine_options)
+
+
+def search_position(fen, moves, depth=None, seconds=None, nodes=None):
+    """Runs in the pool: searches the position after the moves, returns the result with the moves as text"""
+    b = board.Board.from_fen(fen)
+    for move in moves: b.push(b.parse_uci(move))
+    result = _engine.search(b, depth, seconds, nodes)
+    result['move'] = b.move_to_uci(result['move']) if result['move'] else '(none)'
+    result['pv'] = [b.move_to_uci(m) for m in result['pv']]
+    return result
+
+
+class Session:
+    """A game: the board, and its starting position and moves to send the searches to the pool"""
+    def __init__(self, fen=START_FEN, moves=()):
+        try:
+            self.board = board.Board.from_fen(fen)
+        except (ValueError, IndexError, KeyError):
+            raise ValueError("invalid fen")
+        self.fen = fen
+        self.moves = []
+        for move in moves: self.push(move)
+
+
+    def push(self, text):
+        try:
+            move = self.board.parse_uci(text)
+        except ValueError:
+            raise ValueError("illegal move " + text)
+        self.board.push(move)
+        self.moves.append(self.board.move_to_uci(move))
+
+
+class Latency:
+    """Latencies of a command: the count, the total and the last LATENCY_SAMPLES for the percentiles"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = collections.deque(maxlen=LATENCY_SAMPLES)
+
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+
+    def summary(self):
+        p50, p99 = np.percentile(self.samples, (50, 99)) if self.samples else (0.0, 0.0)
+        return {'count': self.count, 'mean_ms': 1000 * self.total / max(self.count, 1), 'p50_ms': 1000 * p50,
+            'p99_ms': 1000 * p99, 'max_ms': 1000 * self.max}
+
+
+class Server:
+    """
+    Hosts the sessions. processes is the size of the search pool (all the cores by default),
+    engine_options are the arguments of search.Engine in every process (e.g. max_depth, tt_size_mb).
+    """
+    def __init__(self, processes=None, **engine_options):
+        engine_options.setdefault('max_depth', 4)
+        self.engine_options = engine_options
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = None
+        self.sessions = {}
+        self.ids = itertools.count(1)
+        self.latency = collections.defaultdict(Latency)
+        self.searching = 0
+        self.servers = []
+        self.commands = {'new': self.cmd_new, 'position': self.cmd_position, 'move': self.cmd_move,
+            'go': self.cmd_go, 'play': self.cmd_play, 'legal': self.cmd_legal, 'fen': self.cmd_fen,
+            'status': self.cmd_status, 'close': self.cmd_close, 'metrics': self.cmd_metrics,
+            'uci': self.cmd_uci, 'isready': self.cmd_isready}
+
+
+    async def start(self, host='127.0.0.1', port=5000, path=None):
+        """Starts listening on the TCP port, or on the Unix socket if a path is given"""
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.processes, initializer=init_worker,
+                initargs=(self.engine_options,))
+        if path is not None: server = await asyncio.start_unix_server(self.handle, path)
+        else: server = await asyncio.start_server(self.handle, host, port)
+        self.servers.append(server)
+        return server
+
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers = []
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+
+    async def handle(self, reader, writer):
+        """Reads the commands of a connection. Searches run as tasks so the next commands don't wait for them."""
+        owned = set()
+        tasks = set()
+
+        def send(lines):
+            if not writer.is_closing(): writer.write(''.join(line + '\n' for line in lines).encode())
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                words = line.decode(errors='replace').split()
+                if not words: continue
+                if words[0] == 'quit': break
+                command = self.commands.get(words[0])
+                if command is None:
+                    send(["error unknown command " + words[0]])
+                    continue
+                if words[0] in ('go', 'play'):
+                    task = asyncio.ensure_future(self.run(command, words, owned, send))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    await asyncio.sleep(0)      # Starts it, so it searches the position before the next commands
+                else:
+                    await self.run(command, words, owned, send)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            for task in tasks: task.cancel()
+            for session_id in owned: self.sessions.pop(session_id, None)
+            writer.close()
+
+
+    async def run(self, command, words, owned, send):
+        """Runs a command and adds its latency, the errors are answered to the client"""
+        start = time.perf_counter()
+        session_id = words[1:2] if words[0] in USAGE else []   # The commands with a session id
+        try:
+            required, usage = USAGE.get(words[0], (0, None))
+            if len(words) - 1 < required: raise ValueError("usage: " + usage)
+            lines = await command(words[1:], owned)
+        except ValueError as e:
+            lines = [' '.join(['error'] + session_id + [str(e)])]
+        except Exception:
+            lines = [' '.join(['error'] + session_id + ['internal error'])]
+        self.latency[words[0]].add(time.perf_counter() - start)
+        send(lines)
+
+
+    def session(self, args):
+        session = self.sessions.get(args[0])
+        if session is None: raise ValueError("unknown session")
+        return session
+
+
+    @staticmethod
+    def parse_position(args):
+        """FEN and moves of 'startpos | fen FEN [moves M1 M2 ...]'"""
+        moves = args.index('moves') if 'moves' in args else len(args)
+        if not args or args[0] == 'startpos': fen = START_FEN
+        elif args[0] == 'fen': fen = ' '.join(args[1:moves])
+        else: raise ValueError("expected startpos or fen")
+        return fen, args[moves + 1:]
+
+
+    @staticmethod
+    def parse_limits(args):
+        """Depth, seconds and nodes of 'depth D movetime MS nodes N', all optional"""
+        options = dict(zip(args[::2], args[1::2]))
+        if len(args) % 2 or not set(options) <= {'depth', 'movetime', 'nodes'}: raise ValueError("invalid limits")
+        try:
+            depth = int(options['depth']) if 'depth' in options else None
+            seconds = int(options['movetime']) / 1000 if 'movetime' in options else None
+            nodes = int(options['nodes']) if 'nodes' in options else None
+        except ValueError:
+            raise ValueError("invalid limits")
+        return depth, seconds, nodes
+
+
+    async def cmd_new(self, args, owned):
+        session = Session(*self.parse_position(args))
+        session_id = str(next(self.ids))
+        self.sessions[session_id] = session
+        owned.add(session_id)
+        return ["session " + session_id]
+
+
+    async def cmd_position(self, args, owned):
+        self.session(args)
+        session = Session(*self.parse_position(args[1:]))
+        self.sessions[args[0]] = session
+        return ["ok " + args[0]]
+
+
+    async def cmd_move(self, args, owned):
+        self.session(args).push(args[1])
+        return ["ok " + args[0]]
+
+
+    async def search(self, session, args):
+        self.searching += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, search_position, session.fen, list(session.moves),
+                *self.parse_limits(args))
+        finally:
+            self.searching -= 1
+
+
+    @staticmethod
+    def bestmove(session_id, result):
+        return "bestmove %s %s score %d depth %d nodes %d" % (session_id, result['move'], result['score'],
+            result['depth'], result['nodes'])
+
+
+    async def cmd_go(self, args, owned):
+        session = self.session(args)
+        return [self.bestmove(args[0], await self.search(session, args[1:]))]
+
+
+    async def cmd_play(self, args, owned):
+        session = self.session(args)
+        plies = len(session.moves)
+        result = await self.search(session, args[1:])
+        # The session may have been closed, replaced or moved during the search, the move is for the old position
+        if self.sessions.get(args[0]) is not session or len(session.moves) != plies:
+            raise ValueError("position changed")
+        if result['move'] != '(none)': session.push(result['move'])
+        return [self.bestmove(args[0], result)]
+
+
+    async def cmd_legal(self, args, owned):
+        b = self.session(args).board
+        return [' '.join(['legal', args[0]] + [b.move_to_uci(m) for m in b.legal_moves()])]
+
+
+    async def cmd_fen(self, args, owned):
+        return ["fen %s %s" % (args[0], self.session(args).board.to_fen())]
+
+
+    async def cmd_status(self, args, owned):
+        outcome = self.session(args).board.outcome()
+        if outcome is None: return ["status %s ongoing" % args[0]]
+        result, reason = outcome
+        return ["status %s %s %s" % (args[0], {1: '1-0', -1: '0-1', 0: '1/2-1/2'}[result], reason)]
+
+
+    async def cmd_close(self, args, owned):
+        self.session(args)
+        del self.sessions[args[0]]
+        owned.discard(args[0])
+        return ["ok " + args[0]]
+
+
+    def metrics(self):
+        """Sessions, searches running or waiting for the pool and the latency of every command"""
+        return {'sessions': len(self.sessions), 'searching': self.searching,
+            'latency': {name: latency.summary() for name, latency in self.latency.items()}}
+
+
+    async def cmd_metrics(self, args, owned):
+        metrics = self.metrics()
+        lines = ["sessions %d searching %d" % (metrics['sessions'], metrics['searching'])]
+        for name, summary in sorted(metrics['latency'].items()):
+            lines.append("metric %s count %d mean_ms %.3f p50_ms %.3f p99_ms %.3f max_ms %.3f" % (name,
+                summary['count'], summary['mean_ms'], summary['p50_ms'], summary['p99_ms'], summary['max_ms']))
+        return lines + ["end"]
+
+
+    async def cmd_uci(self, args, owned):
+        return ["id name chess server", "uciok"]
+
+
+    async def cmd_isready(self, args, owned):
+        return ["readyok"]
+
+
+async def serve(host, port, path, processes, **engine_options):
+    server = Server(processes, **engine_options)
+    listener = await server.start(host, port, path)
+    print("Listening on", path or "%s:%d" % (host, port))
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Serves games with a line protocol over TCP or a Unix socket")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--unix', default=None, help="Path of a Unix socket (instead of TCP)")
+    parser.add_argument('-p', '--processes', type=int, default=None, help="Search processes (all the cores by default)")
+    parser.add_argument('--depth', type=int, default=4, help="Default search depth")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.processes, max_depth=args.depth))
+    except KeyboardInterrupt:
+        pass
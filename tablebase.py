@@ -0,0 +1,396 @@
+"""
+Endgame tablebases: every position of a small set of pieces solved by retrograde analysis.
+
+The material is written with the letters of the standard notation, the side with the extra pieces first:
+'KQK', 'KRK', 'KPK'... The positions with the colors swapped are probed with the board mirrored.
+
+A table has one int16 value per position: 0 is a draw, a positive value is a win for the team
+on turn in TB_MATE - value plies and a negative one a loss in TB_MATE + value plies. The index of a position is
+turn + 2 * (sq_0 + N * sq_1 + N^2 * sq_2 ...), the squares of the pieces in the order of the material name, so
+probing is O(1). Castling and the fifty moves rule are not taken into account.
+The tables are saved as MATERIAL-WIDTHxHEIGHT.tb (see table_name), one per board size.
+
+Usage: python tablebase.py KQK KRK KPK [-d directory] [-p processes] [--width 8] [--height 8]
+"""
+import board
+import bitboard
+
+import multiprocessing
+import os
+import struct
+import time
+
+import numpy as np
+
+
+TB_MATE = 32000         # Value of being checkmated (as a loss in 0 plies), same scale as the search mate scores
+ILLEGAL = -32768        # Positions that can't happen: pieces together, the team not on turn in check...
+
+MAGIC = b'CHESSTB1'
+HEADER_FORMAT = '<8s8sHH'   # Magic, material name, width and height
+HEADER_SIZE = 32
+
+# Letters of the material names
+LETTER_TYPES = {'K':'K', 'Q':'Q', 'R':'T', 'B':'B', 'N':'H', 'P':'P'}
+LETTER_ORDER = 'KQRBNP'
+
+# Results of the retrograde analysis
+UNKNOWN = 0
+WIN = 1
+LOSS = 2
+DRAW = 3
+
+
+def split_material(material):
+    """Pieces of the whites and the blacks of a material name, e.g. 'KQK' -> ('KQ', 'K')"""
+    material = material.upper()
+    second = material.find('K', 1)
+    if not material.startswith('K') or second < 0 or any(letter not in LETTER_TYPES for letter in material):
+        raise ValueError("Invalid material: " + material)
+    return material[:second], material[second:]
+
+
+def canonical_side(letters):
+    return ''.join(sorted(letters, key=LETTER_ORDER.index))
+
+
+def material_of(b):
+    """Pieces of the whites and the blacks in the board, in the order of the material names"""
+    sides = []
+    for team in (0, 1):
+        own = b.team_bb[team]
+        sides.append(''.join(letter * bitboard.popcount(b.piece_bb[LETTER_TYPES[letter]] & own) for letter in LETTER_ORDER))
+    return sides[0], sides[1]
+
+
+def slot_pieces(material):
+    """(piece_type, team) of every slot of the index"""
+    whites, blacks = split_material(material)
+    return [(LETTER_TYPES[letter], 0) for letter in whites] + [(LETTER_TYPES[letter], 1) for letter in blacks]
+
+
+def slot_squares(slots, b, flip):
+    """
+    Squares of the pieces of the board in the order of the slots. With flip the teams are swapped
+    and the board mirrored vertically. Identical pieces are taken from the lowest square.
+    """
+    g = b.geometry
+    taken = {}
+    squares = []
+    for piece_type, team in slots:
+        team_bb = b.team_bb[1 - team if flip else team]
+        bb = b.piece_bb[piece_type] & team_bb & ~taken.get((piece_type, team), 0)
+        low = bb & -bb
+        taken[(piece_type, team)] = taken.get((piece_type, team), 0) | low
+        sq = low.bit_length() - 1
+        if flip: sq = (g.height - 1 - sq // g.width) * g.width + sq % g.width
+        squares.append(sq)
+    return squares
+
+
+def position_index(squares, turn, num_squares):
+    index = 0
+    for sq in reversed(squares): index = index * num_squares + sq
+    return turn + 2 * index
+
+
+def table_name(material, width=8, height=8):
+    return '%s-%dx%d.tb' % (material, width, height)
+
+
+def write_table(path, material, width, height, values):
+    with open(path, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, material.encode().ljust(8, b'\0'), width, height).ljust(HEADER_SIZE, b'\0'))
+        f.write(values.astype('<i2').tobytes())
+
+
+class Tablebase:
+    """
+    Tables of a directory, opened with numpy.memmap when first needed.
+    probe(board) gives the value of a position if there is a table for its material.
+    """
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self.tables = {}        # (whites, blacks, width, height) -> memmapped values, None if there's no file
+        self.slots = {}         # Material name -> slot_pieces()
+        self.max_pieces = 0
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            if name.endswith('.tb'):
+                self.max_pieces = max(self.max_pieces, len(name.split('-')[0]))
+
+
+    def table(self, whites, blacks, width=8, height=8):
+        """Values of the table of the material for the board size, None if there isn't one"""
+        key = (whites, blacks, width, height)
+        if key not in self.tables:
+            path = os.path.join(self.directory, table_name(whites + blacks, width, height))
+            values = None
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    magic, name, table_width, table_height = struct.unpack(HEADER_FORMAT,
+                        f.read(struct.calcsize(HEADER_FORMAT)))
+                if magic != MAGIC: raise ValueError("Not a tablebase file: " + path)
+                if (name.rstrip(b'\0').decode(), table_width, table_height) != (whites + blacks, width, height):
+                    raise ValueError("The tablebase file %s is for %s in %dx%d" % (path, name.rstrip(b'\0').decode(),
+                        table_width, table_height))
+                values = np.memmap(path, dtype='<i2', mode='r', offset=HEADER_SIZE)
+                self.max_pieces = max(self.max_pieces, len(whites + blacks))
+            self.tables[key] = values
+        return self.tables[key]
+
+
+    def probe(self, b):
+        """
+        Value of the position for the team on turn (see TB_MATE), or None if there is no table for its material.
+        Positions with castling rights or an "en passant" square are not probed.
+        """
+        occupied = b.team_bb[0] | b.team_bb[1]
+        if bitboard.popcount(occupied) > self.max_pieces or b.castling or b.ep_square >= 0: return None
+        whites, blacks = material_of(b)
+        flip = False
+        g = b.geometry
+        values = self.table(whites, blacks, g.width, g.height)
+        if values is None:
+            flip = True
+            whites, blacks = blacks, whites
+            values = self.table(whites, blacks, g.width, g.height)
+            if values is None: return None
+        turn = 0 if b.playing == 'W' else 1
+        if flip: turn = 1 - turn
+        slots = self.slots.get(whites + blacks)
+        if slots is None: slots = self.slots[whites + blacks] = slot_pieces(whites + blacks)
+        squares = slot_squares(slots, b, flip)
+        return int(values[position_index(squares, turn, b.geometry.num_squares)])
+
+
+    def probe_dtm(self, b):
+        """Result of the position for the team on turn: (1 win, 0 draw or -1 loss, plies to mate) or None"""
+        value = self.probe(b)
+        if value is None or value == ILLEGAL: return None
+        if value > 0: return 1, TB_MATE - value
+        if value < 0: return -1, TB_MATE + value
+        return 0, 0
+
+
+# Per process state of the workers: the board used to set the positions and the tables of the conversions
+_worker = {}
+
+def worker_state(material, width, height, directory):
+    key = (material, width, height, directory)
+    if _worker.get('key') != key:
+        slots = slot_pieces(material)
+        # Any position with the pieces apart, they are moved to every position later
+        placed = [(i % width, (i // width) % (height - 2) + 1, piece_type, team == 0) for i, (piece_type, team) in
+            enumerate(slots)]
+        b = board.Board.from_position(width, height, placed)
+        piece_slots = {}
+        for i, (x, y, piece_type, is_whites) in enumerate(placed):
+            piece_slots[b.squares[y * width + x]] = i
+        slot_indices = [0] * len(slots)
+        for ind, slot in piece_slots.items(): slot_indices[slot] = ind
+        _worker.clear()
+        _worker.update(key=key, board=b, slots=slots, slot_indices=slot_indices, piece_slots=piece_slots,
+            tablebase=Tablebase(directory))
+    return _worker
+
+
+def successors(material, width, height, directory, start, stop):
+    """
+    Legal moves of the positions with index in [start, stop) of the table. Returns the arrays:
+    counts (moves of each position, -1 if it's illegal), in_check (0 or 1), targets (index of the position after
+    each move, -1 if the move changes the material) and external (value of the position after those moves).
+    """
+    state = worker_state(material, width, height, directory)
+    b = state['board']
+    slots = state['slots']
+    slot_indices = state['slot_indices']
+    piece_slots = state['piece_slots']
+    tablebase = state['tablebase']
+    g = b.geometry
+    n = g.num_squares
+    num_slots = len(slots)
+
+    counts = np.full(stop - start, -1, dtype=np.int32)
+    in_check = np.zeros(stop - start, dtype=np.int8)
+    targets = []
+    external = []
+    for index in range(start, stop):
+        turn = index % 2
+        rest = index // 2
+        squares = []
+        for _ in range(num_slots):
+            squares.append(rest % n)
+            rest //= n
+        if len(set(squares)) < num_slots: continue
+        if any(piece_type == 'P' and squares[i] // g.width in (0, g.height - 1) for i, (piece_type, team) in enumerate(slots)):
+            continue
+
+        # Moves the pieces of the board to the position
+        for i, ind in enumerate(slot_indices):
+            p = b.piece_list[ind]
+            if p.is_alive:
+                b.remove_square(g.square(p.pos.x, p.pos.y))
+                p.kill()
+        for i, ind in enumerate(slot_indices): b.revive_square(ind, squares[i])
+        b.set_turn(turn)
+        b.history = []
+        b.castling = 0
+        b.ep_square = -1
+        b.halfmove_clock = 0
+
+        # The team that has just moved can't be in check
+        kings = b.piece_bb['K'] & b.team_bb[1 - turn]
+        if b.attacked_by(turn) & kings: continue
+
+        moves = b.legal_move_list()
+        counts[index - start] = len(moves)
+        in_check[index - start] = b.in_check()
+        for move in moves:
+            from_sq = move & 0xFF
+            to_sq = (move >> 8) & 0xFF
+            if b.squares[to_sq] < 0 and not move >> 16:
+                child = list(squares)
+                child[piece_slots[b.squares[from_sq]]] = to_sq
+                targets.append(position_index(child, 1 - turn, n))
+                external.append(0)
+                continue
+            # Captures and promotions lead to another table
+            b.push(move)
+            if b.is_insufficient_material(): value = 0
+            else:
+                value = tablebase.probe(b)
+                if value is None:
+                    b.pop()
+                    raise ValueError("Missing table for " + ''.join(material_of(b)) + " (needed by " + material + ")")
+            b.pop()
+            targets.append(-1)
+            external.append(value)
+    return counts, in_check, np.array(targets, dtype=np.int64), np.array(external, dtype=np.int16)
+
+
+def conversions(material):
+    """Materials reached from the material with a capture or a promotion, the side with more pieces first"""
+    whites, blacks = split_material(material)
+    result = set()
+    for side, other, swap in ((whites, blacks, False), (blacks, whites, True)):
+        for i, letter in enumerate(side):
+            if letter == 'K': continue
+            # Captured
+            reduced = side[:i] + side[i + 1:]
+            result.add((reduced, other) if not swap else (other, reduced))
+            if letter == 'P':
+                for promoted in 'QRBN':
+                    changed = canonical_side(reduced + promoted)
+                    result.add((changed, other) if not swap else (other, changed))
+    named = set()
+    for w, b in result:
+        if len(w) < len(b) or (len(w) == len(b) and w < b): w, b = b, w
+        named.add(w + b)
+    return named
+
+
+def is_drawn_material(material):
+    """Only kings and at most one knight or bishop: no checkmate is possible"""
+    whites, blacks = split_material(material)
+    rest = whites[1:] + blacks[1:]
+    return len(rest) == 0 or (len(rest) == 1 and rest in 'BN')
+
+
+def generate(material, directory='.', width=8, height=8, processes=None, chunks=64, verbose=False):
+    """
+    Builds the table of the material for the board size (and the ones it converts to, if they are missing)
+    into the directory.
+    The moves of the positions are generated in a pool of processes, then the positions are solved from the
+    checkmates backwards: a position is won in d plies if a move leads to a position lost in d - 1, and lost
+    in d plies if all the moves lead to won positions, the longest in d - 1. The rest are draws.
+
+    Returns the path of the table.
+    """
+    whites, blacks = split_material(material)
+    material = canonical_side(whites) + canonical_side(blacks)
+    path = os.path.join(directory, table_name(material, width, height))
+    if os.path.exists(path): return path
+    os.makedirs(directory, exist_ok=True)
+    for needed in conversions(material):
+        if not is_drawn_material(needed): generate(needed, directory, width, height, processes, chunks, verbose)
+
+    start = time.perf_counter()
+    n = width * height
+    size = 2 * n ** len(slot_pieces(material))
+    bounds = np.linspace(0, size, chunks + 1).astype(np.int64)
+    tasks = [(material, width, height, directory, int(bounds[i]), int(bounds[i + 1])) for i in range(chunks)]
+    if processes == 1:
+        results = [successors(*task) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes or os.cpu_count() or 1) as pool:
+            results = pool.starmap(successors, tasks)
+    counts = np.concatenate([r[0] for r in results])
+    in_check = np.concatenate([r[1] for r in results]).astype(bool)
+    targets = np.concatenate([r[2] for r in results])
+    external = np.concatenate([r[3] for r in results])
+
+    values = solve(counts, in_check, targets, external)
+    write_table(path, material, width, height, values)
+    if verbose:
+        legal = counts >= 0
+        print("%s: %d positions, %d won, %d lost, %d drawn in %.1fs" % (material, legal.sum(),
+            (values[legal] > 0).sum(), (values[legal] < 0).sum(), (values[legal] == 0).sum(), time.perf_counter() - start))
+    return path
+
+
+def solve(counts, in_check, targets, external):
+    """Retrograde analysis over the moves of all the positions, returns the int16 values"""
+    size = len(counts)
+    status = np.full(size, UNKNOWN, dtype=np.int8)
+    distance = np.zeros(size, dtype=np.int32)
+    status[(counts == 0) & in_check] = LOSS           # Checkmate
+    status[(counts == 0) & ~in_check] = DRAW          # Stalemate
+
+    # Edges of the positions with moves, the rest are already solved or illegal
+    moves = np.maximum(counts, 0)
+    active = np.flatnonzero(moves > 0)
+    starts = (np.cumsum(moves) - moves)[active]
+    internal = targets >= 0
+    internal_targets = np.where(internal, targets, 0)
+    external_status = np.where(external > 0, WIN, np.where(external < 0, LOSS, DRAW)).astype(np.int8)
+    external_distance = np.where(external > 0, TB_MATE - external.astype(np.int32),
+        np.where(external < 0, TB_MATE + external.astype(np.int32), 0))
+    longest = int(external_distance.max()) if len(external_distance) else 0
+
+    depth = 1
+    while True:
+        child_status = np.where(internal, status[internal_targets], external_status)
+        child_distance = np.where(internal, distance[internal_targets], external_distance)
+        undecided = status[active] == UNKNOWN
+        wins = np.add.reduceat(((child_status == LOSS) & (child_distance == depth - 1)).astype(np.int32), starts) > 0
+        all_won = np.add.reduceat((child_status == WIN).astype(np.int32), starts) == moves[active]
+        longest_win = np.maximum.reduceat(np.where(child_status == WIN, child_distance, -1), starts)
+        losses = all_won & (longest_win == depth - 1)
+
+        won = active[undecided & wins]
+        lost = active[undecided & ~wins & losses]
+        status[won] = WIN
+        distance[won] = depth
+        status[lost] = LOSS
+        distance[lost] = depth
+        if not len(won) and not len(lost) and depth > longest + 1: break
+        depth += 1
+
+    values = np.zeros(size, dtype=np.int16)
+    values[status == WIN] = TB_MATE - distance[status == WIN]
+    values[status == LOSS] = -(TB_MATE - distance[status == LOSS])
+    values[counts < 0] = ILLEGAL
+    return values
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Generates endgame tablebases")
+    parser.add_argument('materials', nargs='+', help="Materials, e.g. KQK KRK KPK")
+    parser.add_argument('-d', '--directory', default='.', help="Directory of the tables")
+    parser.add_argument('-p', '--processes', type=int, default=None, help="Worker processes (all the cores by default)")
+    parser.add_argument('--width', type=int, default=8)
+    parser.add_argument('--height', type=int, default=8)
+    args = parser.parse_args()
+    for material in args.materials:
+        print(generate(material, args.directory, args.width, args.height, processes=args.processes, verbose=True))
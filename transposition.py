@@ -0,0 +1,180 @@
+"""
+Transposition table to reuse the results of positions already searched.
+"""
+import numpy as np
+from multiprocessing import shared_memory
+
+
+EXACT = 0
+LOWER = 1   # The score is a lower bound (fail high)
+UPPER = 2   # The score is an upper bound (fail low)
+
+
+class TranspositionTable:
+    """
+    Fixed size hash table indexed by the zobrist key of the positions (Board.key).
+
+    The memory is given in megabytes and every entry takes 16 bytes: the key and the packed data
+    (move, score, depth, bound flag and search age). The number of entries is rounded down to a power of two.
+
+    Replacement policy: an entry is overwritten if it's empty, if it belongs to the same position,
+    if it was stored in an older search (see new_search) or if the new result has the same or more depth.
+    With policy='always' the new result always replaces the old one.
+
+    The hits, misses, stores and rejected stores are counted, see stats().
+    """
+    def __init__(self, size_mb=16, policy='depth'):
+        if policy not in ('depth', 'always'):
+            raise ValueError("Unknown replacement policy: " + str(policy))
+        self.policy = policy
+        entries = max(1, int(size_mb * 2**20) // 16)
+        self.size = 1 << (entries.bit_length() - 1)
+        self.mask = self.size - 1
+        self.keys = np.zeros(self.size, dtype=np.uint64)
+        self.data = np.zeros(self.size, dtype=np.uint64)
+        self.age = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.rejected = 0
+
+
+    @staticmethod
+    def pack(move, score, depth, flag, age):
+        """Packs the entry data in 64 bits: move (24), score (16, signed), depth (8), flag (2) and age (6)"""
+        return (move & 0xFFFFFF) | ((score + 32768) & 0xFFFF) << 24 | (depth & 0xFF) << 40 | flag << 48 | (age & 0x3F) << 50
+
+
+    @staticmethod
+    def unpack(data):
+        """Returns the tuple (move, score, depth, flag, age) of some packed data"""
+        return (data & 0xFFFFFF, ((data >> 24) & 0xFFFF) - 32768, (data >> 40) & 0xFF, (data >> 48) & 0x3, (data >> 50) & 0x3F)
+
+
+    def probe(self, key):
+        """Returns the tuple (move, score, depth, flag) stored for the key, or None if there isn't one"""
+        i = key & self.mask
+        if int(self.keys[i]) == key:
+            data = int(self.data[i])
+            self.hits += 1
+            return (data & 0xFFFFFF, ((data >> 24) & 0xFFFF) - 32768, (data >> 40) & 0xFF, (data >> 48) & 0x3)
+        self.misses += 1
+        return None
+
+
+    def store(self, key, move, score, depth, flag):
+        """Saves a search result following the replacement policy. Returns True if it was stored."""
+        i = key & self.mask
+        if self.policy == 'depth':
+            old_key = int(self.keys[i])
+            if old_key != 0 and old_key != key:
+                old = int(self.data[i])
+                if (old >> 50) & 0x3F == self.age & 0x3F and (old >> 40) & 0xFF > depth:
+                    self.rejected += 1
+                    return False
+        self.keys[i] = key
+        self.data[i] = self.pack(move, score, depth, flag, self.age)
+        self.stores += 1
+        return True
+
+
+    def new_search(self):
+        """Marks the current entries as old, so they are replaced first"""
+        self.age = (self.age + 1) & 0x3F
+
+
+    def clear(self):
+        self.keys[:] = 0
+        self.data[:] = 0
+        self.age = 0
+        self.hits = self.misses = self.stores = self.rejected = 0
+
+
+    def hashfull(self):
+        """Permille of the entries used in the current search (sampled from the first 1000)"""
+        n = min(1000, self.size)
+        used = (self.keys[:n] != 0) & (((self.data[:n] >> np.uint64(50)) & np.uint64(0x3F)) == self.age)
+        return int(used.sum()) * 1000 // n
+
+
+    def stats(self):
+        probes = self.hits + self.misses
+        return {
+            'entries': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / probes if probes else 0.0,
+            'stores': self.stores,
+            'rejected': self.rejected,
+            'hashfull': self.hashfull(),
+        }
+
+
+class SharedTranspositionTable(TranspositionTable):
+    """
+    Transposition table in shared memory, used by several processes searching at the same time (see
+    search.ParallelEngine). There are no locks: every entry saves key ^ data instead of the key, so an entry
+    written by two processes at once (the key of one and the data of the other) doesn't match any key and is
+    ignored. The counters of stats() are the ones of each process.
+
+    It's created by one process, the owner, and attached by name when it's sent to other processes.
+    """
+    def __init__(self, size_mb=16, policy='depth'):
+        super().__init__(size_mb, policy)
+        self.owner = True
+        self.memory = shared_memory.SharedMemory(create=True, size=self.size * 16)
+        self.attach()
+        self.clear()
+
+
+    def attach(self):
+        self.keys = np.ndarray(self.size, dtype=np.uint64, buffer=self.memory.buf)
+        self.data = np.ndarray(self.size, dtype=np.uint64, buffer=self.memory.buf, offset=self.size * 8)
+
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['memory'], state['keys'], state['data']
+        state['memory_name'] = self.memory.name
+        return state
+
+
+    def __setstate__(self, state):
+        name = state.pop('memory_name')
+        self.__dict__.update(state)
+        self.owner = False
+        self.memory = shared_memory.SharedMemory(name=name)
+        self.attach()
+
+
+    def probe(self, key):
+        i = key & self.mask
+        data = int(self.data[i])
+        if int(self.keys[i]) ^ data == key:
+            self.hits += 1
+            return (data & 0xFFFFFF, ((data >> 24) & 0xFFFF) - 32768, (data >> 40) & 0xFF, (data >> 48) & 0x3)
+        self.misses += 1
+        return None
+
+
+    def store(self, key, move, score, depth, flag):
+        i = key & self.mask
+        if self.policy == 'depth':
+            old = int(self.data[i])
+            old_key = int(self.keys[i]) ^ old
+            if old_key != 0 and old_key != key:
+                if (old >> 50) & 0x3F == self.age & 0x3F and (old >> 40) & 0xFF > depth:
+                    self.rejected += 1
+                    return False
+        data = self.pack(move, score, depth, flag, self.age)
+        self.data[i] = data
+        self.keys[i] = key ^ data
+        self.stores += 1
+        return True
+
+
+    def close(self):
+        """Detaches the memory, the owner frees it too"""
+        self.keys = self.data = None
+        self.memory.close()
+        if self.owner: self.memory.unlink()
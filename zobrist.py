@@ -0,0 +1,39 @@
+"""
+Zobrist keys to identify a position with a 64 bit integer.
+
+The key of a position is the xor of a random number for every piece in its square, the team on turn,
+the castling rights and the "en passant" column. The board updates it on every change (see Board.key),
+so it is always available without recomputing it.
+
+The random numbers are generated from a fixed seed, so the keys are the same between processes and runs.
+"""
+import bitboard
+
+import numpy as np
+
+SEED = 20240501
+
+
+class ZobristKeys:
+    """Random numbers for a board of a given size. Use get_keys() so they are shared."""
+    def __init__(self, width, height):
+        num_squares = width * height
+        rng = np.random.default_rng(SEED)
+        rand = lambda n: [int(k) for k in rng.integers(0, 2**64, size=n, dtype=np.uint64)]
+
+        # pieces[team][piece_type][square]
+        self.pieces = tuple({t: rand(num_squares) for t in bitboard.PIECE_TYPES} for team in (0, 1))
+        self.blacks_turn = rand(1)[0]
+        self.castling = [0] + rand(15)
+        self.ep = rand(width)     # Per column
+
+
+_keys = {}
+
+def get_keys(width, height):
+    """Returns the shared zobrist keys for the given board size, building them the first time"""
+    keys = _keys.get((width, height))
+    if keys is None:
+        keys = ZobristKeys(width, height)
+        _keys[(width, height)] = keys
+    return keys